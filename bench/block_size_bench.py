@@ -0,0 +1,94 @@
+"""Benchmark for download and upload throughput by maxNumberOfBlockLength.
+
+Starts the asyncio server in a separate process with one ECU per block length behind a
+gateway, then downloads an image to each ECU with DoIPClient.download_from_file() and reads
+it back with upload_to_file(), over loopback TCP. The client takes its block length from the
+RequestDownload/RequestUpload responses. Run from the repository root:
+
+    python3 bench/block_size_bench.py [image size in MB]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.client import DoIPClient
+
+PORT = 13499
+VIN = "L6T7854Z4ND000050"
+BLOCK_LENGTHS = [0x400, 0x1000, 0x4000, 0x10000, 0x40000, 0x100000]
+MEMORY_ADDRESS = 0x00080000
+
+
+def ecu_address(index):
+    return 0x1001 + index
+
+
+def serve(directory, block_lengths=BLOCK_LENGTHS):
+    import logging
+
+    import server
+    from lib.ecu import EcuModel, Gateway
+
+    logging.disable(logging.WARNING)
+    # Images land in the working directory
+    os.chdir(directory)
+    ecus = [
+        EcuModel(f"ECU_{length:X}", ecu_address(index), VIN, max_number_of_block_length=length)
+        for index, length in enumerate(block_lengths)
+    ]
+    asyncio.run(
+        server.serve_asyncio(
+            VIN,
+            0x1000,
+            b"\x02\x00\x00\x00\x01\x00",
+            b"\x00" * 6,
+            PORT,
+            announce=False,
+            host="127.0.0.1",
+            discovery=False,
+            gateway=Gateway(0x1000, ecus),
+        )
+    )
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 20_000_000
+    with tempfile.TemporaryDirectory() as directory:
+        image = os.path.join(directory, "image.bin")
+        with open(image, "wb") as file:
+            file.write(os.urandom(size))
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(target=serve, args=(directory,), daemon=True)
+        process.start()
+        try:
+            time.sleep(2)
+            print(f"{size / 1e6:.0f} MB image")
+            print(f"{'block length':>14} {'download MB/s':>14} {'upload MB/s':>14}")
+            for index, length in enumerate(BLOCK_LENGTHS):
+                client = DoIPClient(
+                    "127.0.0.1",
+                    ecu_address(index),
+                    tcp_port=PORT,
+                    client_logical_address=0x0E80,
+                    zero_copy=True,
+                )
+                start = time.perf_counter()
+                client.download_from_file(image, MEMORY_ADDRESS, timeout=10)
+                download = time.perf_counter() - start
+                start = time.perf_counter()
+                client.upload_to_file(os.path.join(directory, "upload.bin"), MEMORY_ADDRESS, size, timeout=10)
+                upload = time.perf_counter() - start
+                client.close()
+                print(f"{length:>14} {size / download / 1e6:>14.1f} {size / upload / 1e6:>14.1f}")
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
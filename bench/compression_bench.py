@@ -0,0 +1,86 @@
+"""Benchmark for compressed downloads (dataFormatIdentifier compressionMethod).
+
+Downloads an image to the asyncio server once per compression method with
+DoIPClient.download_from_file(), which compresses on the fly, and reads the image back to
+check it. Loopback is far faster than an automotive link, so besides the measured time the
+table estimates the time on a 100 Mbit/s link (100BASE-T1): the measured time plus the time
+the bytes on the wire take at that rate. Pass a real firmware image for realistic ratios,
+otherwise a synthetic one (code-like random data, lookup tables and erased flash) is used.
+Run from the repository root:
+
+    python3 bench/compression_bench.py [image] [block length]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block_size_bench import MEMORY_ADDRESS, PORT, ecu_address, serve
+from lib.client import DoIPClient, read_blocks
+
+LINK_BITS_PER_SECOND = 100e6
+SIZE = 20_000_000
+
+
+def synthetic_image(path):
+    table = bytes(range(256)) * 64
+    with open(path, "wb") as file:
+        file.write(os.urandom(SIZE // 2))
+        file.write(table * (SIZE // 4 // len(table)))
+        file.write(b"\xff" * (SIZE - file.tell()))
+
+
+def wire_bytes(path, block_length, compression):
+    with open(path, "rb") as file:
+        return sum(len(block) for block in read_blocks(file, block_length, compression))
+
+
+def main():
+    block_length = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0x10000
+    with tempfile.TemporaryDirectory() as directory:
+        if len(sys.argv) > 1:
+            image = sys.argv[1]
+        else:
+            image = os.path.join(directory, "image.bin")
+            synthetic_image(image)
+        size = os.path.getsize(image)
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(target=serve, args=(directory, [block_length]), daemon=True)
+        process.start()
+        try:
+            time.sleep(2)
+            print(f"{size / 1e6:.1f} MB image, {block_length} bytes maxNumberOfBlockLength")
+            print(
+                f"{'compression':>12} {'on wire MB':>11} {'ratio':>6} {'loopback s':>11}"
+                f" {'100 Mbit/s s':>13}"
+            )
+            with open(image, "rb") as file:
+                original = file.read()
+            for compression in (None, "zlib", "lzma"):
+                on_wire = wire_bytes(image, block_length - 2, compression)
+                client = DoIPClient(
+                    "127.0.0.1", ecu_address(0), tcp_port=PORT, client_logical_address=0x0E80
+                )
+                start = time.perf_counter()
+                client.download_from_file(image, MEMORY_ADDRESS, timeout=30, compression=compression)
+                seconds = time.perf_counter() - start
+                upload = os.path.join(directory, "upload.bin")
+                client.upload_to_file(upload, MEMORY_ADDRESS, size, timeout=10)
+                client.close()
+                with open(upload, "rb") as file:
+                    assert file.read() == original, "uploaded image differs"
+                link_seconds = seconds + on_wire * 8 / LINK_BITS_PER_SECOND
+                print(
+                    f"{compression or 'none':>12} {on_wire / 1e6:>11.1f} {size / on_wire:>6.2f}"
+                    f" {seconds:>11.2f} {link_seconds:>13.2f}"
+                )
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
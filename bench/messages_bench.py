@@ -0,0 +1,84 @@
+"""Microbenchmark for the DoIP message layer.
+
+Measures pack/unpack/compare throughput for the messages exchanged on every diagnostic
+request, and the memory held by a batch of message objects. Run from the repository root:
+
+    python3 bench/messages_bench.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.messages import *
+
+NUMBER = 200000
+OBJECTS = 100000
+
+
+def frame(message, protocol_version=0x02):
+    pack_frame = getattr(message, "pack_frame", None)
+    if pack_frame is not None:
+        return pack_frame(protocol_version)
+    payload_data = message.pack()
+    return (
+        struct.pack(
+            "!BBHL",
+            protocol_version,
+            0xFF ^ protocol_version,
+            payload_message_to_type[type(message)],
+            len(payload_data),
+        )
+        + payload_data
+    )
+
+
+def report(name, statement):
+    seconds = min(timeit.repeat(statement, number=NUMBER, repeat=3))
+    print(f"{name:<45} {NUMBER / seconds / 1000:10.1f} kops/s")
+
+
+def main():
+    ack = DiagnosticMessagePositiveAcknowledgement(0x1001, 0x0E80, 0)
+    ack_bytes = ack.pack()
+    activation = RoutingActivationResponse(0x0E80, 0x1001, 0x10)
+    announcement = VehicleIdentificationResponse(
+        "L6T7854Z4ND000050", 0x1001, b"\x02\x00\x00\x00\x01\x00", b"\x00" * 6, 0
+    )
+    diagnostic = DiagnosticMessage(0x0E80, 0x1001, b"\x36\x01" + bytes(4094))
+    diagnostic_bytes = diagnostic.pack()
+    other = DiagnosticMessage(0x0E80, 0x1001, b"\x36\x01" + bytes(4094))
+
+    report("DiagnosticMessagePositiveAck pack", ack.pack)
+    report("DiagnosticMessagePositiveAck frame", lambda: frame(ack))
+    report(
+        "DiagnosticMessagePositiveAck unpack",
+        lambda: DiagnosticMessagePositiveAcknowledgement.unpack(ack_bytes, 5),
+    )
+    report("RoutingActivationResponse frame", lambda: frame(activation))
+    report("VehicleIdentificationResponse frame", lambda: frame(announcement))
+    report("DiagnosticMessage (4K) frame", lambda: frame(diagnostic))
+    report(
+        "DiagnosticMessage (4K) unpack",
+        lambda: DiagnosticMessage.unpack(diagnostic_bytes, len(diagnostic_bytes)),
+    )
+    report("DiagnosticMessage (4K) __eq__", lambda: diagnostic == other)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    messages = [
+        DiagnosticMessagePositiveAcknowledgement(0x1001, i & 0xFFFF, 0)
+        for i in range(OBJECTS)
+    ]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print(
+        f"{'DiagnosticMessagePositiveAck memory':<45} {allocated / len(messages):10.1f} bytes/object"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark for the cost of auto_reconnect_tcp on a flash.
+
+Starts the asyncio server in a separate process with one ECU, then downloads the same image
+with DoIPClient.download_from_file() with auto_reconnect_tcp off and on, over loopback TCP.
+With it on, the client checks the connection for a FIN or an RST before and after every
+send. Also times sends the ECU doesn't answer (alive check responses), which is where a
+check that waits for an RST would show. Run from the repository root:
+
+    python3 bench/reconnect_bench.py [image size in MB] [block length]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.client import DoIPClient
+from lib.messages import AliveCheckResponse
+
+PORT = 13498
+VIN = "L6T7854Z4ND000050"
+ECU_ADDRESS = 0x1001
+MEMORY_ADDRESS = 0x00080000
+ROUNDS = 3
+UNANSWERED_SENDS = 500
+
+
+def serve(directory, block_length):
+    import logging
+
+    import server
+    from lib.ecu import EcuModel, Gateway
+
+    logging.disable(logging.WARNING)
+    # Images land in the working directory
+    os.chdir(directory)
+    ecu = EcuModel("ECU", ECU_ADDRESS, VIN, max_number_of_block_length=block_length)
+    asyncio.run(
+        server.serve_asyncio(
+            VIN,
+            0x1000,
+            b"\x02\x00\x00\x00\x01\x00",
+            b"\x00" * 6,
+            PORT,
+            announce=False,
+            host="127.0.0.1",
+            discovery=False,
+            gateway=Gateway(0x1000, [ecu]),
+        )
+    )
+
+
+def connect(auto_reconnect_tcp):
+    return DoIPClient(
+        "127.0.0.1",
+        ECU_ADDRESS,
+        tcp_port=PORT,
+        client_logical_address=0x0E80,
+        auto_reconnect_tcp=auto_reconnect_tcp,
+        zero_copy=True,
+    )
+
+
+def flash(image, auto_reconnect_tcp):
+    client = connect(auto_reconnect_tcp)
+    start = time.perf_counter()
+    client.download_from_file(image, MEMORY_ADDRESS, timeout=10)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+def unanswered_sends(auto_reconnect_tcp):
+    client = connect(auto_reconnect_tcp)
+    message = AliveCheckResponse(0x0E80)
+    start = time.perf_counter()
+    for _ in range(UNANSWERED_SENDS):
+        client.send_doip_message(message)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed / UNANSWERED_SENDS
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 10_000_000
+    block_length = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0x1000
+    with tempfile.TemporaryDirectory() as directory:
+        image = os.path.join(directory, "image.bin")
+        with open(image, "wb") as file:
+            file.write(os.urandom(size))
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(target=serve, args=(directory, block_length), daemon=True)
+        process.start()
+        try:
+            time.sleep(2)
+            print(f"{size / 1e6:.0f} MB image, {block_length} byte blocks, best of {ROUNDS}")
+            print(f"{'auto reconnect':>14} {'seconds':>10} {'MB/s':>10} {'unanswered send us':>20}")
+            for auto_reconnect_tcp in (False, True):
+                elapsed = min(flash(image, auto_reconnect_tcp) for _ in range(ROUNDS))
+                send = unanswered_sends(auto_reconnect_tcp)
+                print(
+                    f"{'on' if auto_reconnect_tcp else 'off':>14} {elapsed:>10.2f} {size / elapsed / 1e6:>10.1f}"
+                    f" {send * 1e6:>20.0f}"
+                )
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
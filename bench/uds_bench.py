@@ -0,0 +1,72 @@
+"""Benchmark for UDS request handling in the TCP server.
+
+Feeds framed diagnostic requests straight into DoIPTCPServer.dataReceived() over a transport
+that discards what is written, so the numbers cover framing, dispatch, the handler and packing
+the acknowledgement and response, but no socket I/O. For reference, it also times building
+and serializing the udsoncan Request/Response objects for each request, which the dispatcher
+avoids. Run from the repository root:
+
+    python3 bench/uds_bench.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from udsoncan.Request import Request
+from udsoncan.Response import Response
+
+from lib.messages import DiagnosticMessage
+from server import DoIPTCPServer
+
+NUMBER = 20000
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writeSequence(self, buffers):
+        pass
+
+    def doWrite(self):
+        pass
+
+    def getPeer(self):
+        return type("Peer", (), {"host": "127.0.0.1", "port": 0})()
+
+
+def make_server():
+    server = DoIPTCPServer("L6T7854Z4ND000050", 0x1001, b"\x02\x00\x00\x00\x01\x00", b"\x00" * 6)
+    server.makeConnection(NullTransport())
+    server.append_file_name = os.devnull
+    return server
+
+
+def udsoncan_objects(payload):
+    request = Request.from_payload(payload)
+    return Response(request.service, Response.Code.PositiveResponse, b"").get_payload()
+
+
+def report(name, statement):
+    seconds = min(timeit.repeat(statement, number=NUMBER, repeat=3))
+    print(f"{name:<50} {NUMBER / seconds / 1000:10.1f} k requests/s")
+
+
+def main():
+    server = make_server()
+    requests = [
+        ("TesterPresent", b"\x3e\x00"),
+        ("ReadDataByIdentifier (VIN)", b"\x22\xf1\x90"),
+        ("DiagnosticSessionControl", b"\x10\x03"),
+        ("TransferData (4K)", b"\x36\x01" + bytes(4094)),
+    ]
+    for name, payload in requests:
+        frame = DiagnosticMessage(0x0E80, 0x1001, payload).pack_frame()
+        report(f"{name} dispatch", lambda: server.dataReceived(frame))
+        report(f"{name} udsoncan objects only", lambda: udsoncan_objects(payload))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from lib.client import DoIPClient
+from lib.client import DoIPClient, read_blocks
+from lib.constants import COMPRESSION_METHODS
 
 from doipclient.connectors import DoIPClientUDSConnector
 from udsoncan.client import Client
@@ -113,7 +114,7 @@ def routine():
         except Exception as e:
             print(f"An error occurred: {str(e)}")
 
-def requeset_download(pkg_size):
+def requeset_download(pkg_size, compression=None):
     with Client(uds_connection, config=config) as uds_client:
         try:
             # The memory address and size
@@ -121,8 +122,8 @@ def requeset_download(pkg_size):
             print(f"Package size: {hex(pkg_size)}")
             memory_location = MemoryLocation(address=0x1234, memorysize=pkg_size, address_format=32, memorysize_format=32)
 
-            # Data format
-            data_format = DataFormatIdentifier(compression=0, encryption=0)
+            # Data format (compression: None, "zlib" or "lzma")
+            data_format = DataFormatIdentifier(compression=COMPRESSION_METHODS.get(compression, 0), encryption=0)
 
             # Send download request
             response = uds_client.request_download(memory_location, data_format)
@@ -130,7 +131,9 @@ def requeset_download(pkg_size):
             # Check the response
             if response.positive:
                 print("Download request accepted")
-                # perform data transfer ...
+                # TransferData requests may be as long as the server allows
+                print(f"Max number of block length: {hex(response.service_data.max_length)}")
+                return response.service_data.max_length
             else:
                 print("Download request was not accepted")
 
@@ -165,25 +168,22 @@ def transfer_data():
         except Exception as e:
             print(f"An error occurred: {str(e)}")
 
-def transfer_data2(pkg_file_path):
+def transfer_data2(pkg_file_path, max_number_of_block_length=None, compression=None):
     config['request_timeout'] = 2  # Request timeout(seconds)
-    #max_number_of_block_length = 0x0fa2 - 2
-    max_number_of_block_length = 0x1000 - 2  # 4K
-    #max_number_of_block_length = 0x4000 - 2   # 16K
-    #max_number_of_block_length = 0x10000 - 2 # 64K
+    # maxNumberOfBlockLength from the RequestDownload response includes the SID and the
+    # block sequence counter
+    max_number_of_block_length = (max_number_of_block_length or 0x1000) - 2
     with Client(uds_connection, config=config) as uds_client:
         print("Data transfer start !")
         try:
             with open(pkg_file_path, 'rb') as file:
                 block_sequence_counter = 1  # Initialize the data block sequence counter
                 t_s = time.time()
-                while True:
-                    data_to_transfer = file.read(max_number_of_block_length)  # Read the file content according to the maximum length
-                    if not data_to_transfer:
-                        break  # If there is no data, end the loop
-
-                    # Send a request to transfer data
-                    response = uds_client.transfer_data(block_sequence_counter, data_to_transfer)
+                # Read the file content according to the maximum length, compressed on the fly
+                # when the download was requested with compression
+                for data_to_transfer in read_blocks(file, max_number_of_block_length, compression):
+                    # Send a request to transfer data (udsoncan only takes bytes)
+                    response = uds_client.transfer_data(block_sequence_counter, bytes(data_to_transfer))
                     block_sequence_counter += 1  # Update the data block sequence counter
 
                     # block_sequence_counter => [00~FF]
@@ -226,6 +226,20 @@ def transfer_data_exit():
             print(f"An error occurred: {str(e)}")
 
 
+def request_upload(file_path, memory_address, memory_size):
+    # Read-out: RequestUpload, TransferData and RequestTransferExit on the raw DoIP client,
+    # blocks are written to the file as they arrive
+    print("Upload start !")
+    try:
+        t_s = time.time()
+        received = client.upload_to_file(file_path, memory_address, memory_size, timeout=2)
+        t_e = time.time()
+        print(f"Upload file: {file_path}")
+        print(f"Upload elapsed time(s): {t_e-t_s} ({received / (t_e-t_s) / 1e6:.1f} MB/s)")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+
+
 def main():
     # [1] Session Control (default[1] -> extended[3])
     sess_change(DiagnosticSessionControl.Session.extendedDiagnosticSession)
@@ -248,11 +262,11 @@ def main():
     file_size = os.path.getsize(pkg_file_path)
 
     # [4] Request download
-    requeset_download(file_size)
+    max_number_of_block_length = requeset_download(file_size)
     time.sleep(1)
 
     # [5] Transfer data
-    transfer_data2(pkg_file_path)
+    transfer_data2(pkg_file_path, max_number_of_block_length)
     time.sleep(1)
 
     # [6] Transfer data exit
@@ -284,11 +298,11 @@ def main_debug():
     file_size = os.path.getsize(pkg_file_path)
 
     # [4] Request download
-    requeset_download(file_size)
+    max_number_of_block_length = requeset_download(file_size)
     time.sleep(1)
 
     # [5] Transfer data
-    transfer_data2(pkg_file_path)
+    transfer_data2(pkg_file_path, max_number_of_block_length)
     time.sleep(1)
 
     # [6] Transfer data exit
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import logging
+import random
+
+from lib.constants import A_DOIP_ACCOUNCE_MAX_WAIT, A_DOIP_ANNOUNCE_INTERVAL, A_DOIP_ANNOUNCE_NUM
+
+logger = logging.getLogger("doipserver.announce")
+
+# Announcements due within a tick of each other are sent together
+TICK = 0.01
+
+# Random delays spread over 0..max_wait, by name. ISO 13400-2 asks for uniform ones, the
+# others are for studying how testers cope with discovery storms shaped differently
+JITTER = {
+    "none": lambda max_wait: 0.0,
+    "uniform": lambda max_wait: random.uniform(0, max_wait),
+    "normal": lambda max_wait: min(max_wait, max(0.0, random.gauss(max_wait / 2, max_wait / 6))),
+    "exponential": lambda max_wait: min(max_wait, random.expovariate(4 / max_wait)),
+}
+
+
+class _Announcement:
+    __slots__ = ("datagram", "due", "left")
+
+    def __init__(self, datagram, due, left):
+        self.datagram = datagram
+        self.due = due
+        self.left = left
+
+
+class AnnouncementScheduler:
+    """Sends the vehicle announcements of any number of DoIP entities from one timer.
+
+    Every entity starts after a random delay of up to A_DoIP_Announce_Wait and sends
+    A_DoIP_Announce_Num announcements A_DoIP_Announce_Interval apart. Unless `interval` is
+    None, one more follows every `interval` seconds plus another random delay after that,
+    for testers that start listening later. The next due times are kept in a heap, and the
+    single call scheduled on the clock is for the earliest one. Everything that falls due
+    within a TICK of it is handed to `send` as one batch.
+
+    :param clock: Provides callLater() and seconds(), the twisted reactor or an
+        AsyncioClock
+    :param send: Called with a list of datagrams to send, the objects given to add()
+    :param interval: Seconds between the announcements that follow the initial ones
+    :type interval: float, optional
+    :param jitter: Distribution of the random delays, a key of JITTER
+    :type jitter: str, optional
+    """
+
+    def __init__(self, clock, send, interval=None, jitter="uniform"):
+        self.clock = clock
+        self.send = send
+        self.interval = interval
+        self.jitter = JITTER[jitter]
+        self._heap = []
+        # Breaks ties between equal due times, announcements aren't comparable
+        self._order = itertools.count()
+        self._call = None
+        self._call_due = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, datagram):
+        """Start announcing a datagram, typically a framed VehicleIdentificationResponse"""
+        due = self.clock.seconds() + self.jitter(A_DOIP_ACCOUNCE_MAX_WAIT)
+        self._push(_Announcement(datagram, due, A_DOIP_ANNOUNCE_NUM))
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._heap.clear()
+
+    def _push(self, announcement):
+        heapq.heappush(self._heap, (announcement.due, next(self._order), announcement))
+        if self._call is None or announcement.due < self._call_due:
+            self._wake(announcement.due)
+
+    def _wake(self, due):
+        if self._call is not None:
+            self._call.cancel()
+        self._call_due = due
+        self._call = self.clock.callLater(max(0.0, due - self.clock.seconds()), self._run)
+
+    def _run(self):
+        self._call = None
+        heap = self._heap
+        now = self.clock.seconds()
+        due = []
+        while heap and heap[0][0] <= now + TICK:
+            due.append(heapq.heappop(heap)[2])
+        try:
+            self.send([announcement.datagram for announcement in due])
+        except OSError as e:
+            # The schedule goes on, the next batches may well go out
+            logger.error(f"Failed to send {len(due)} vehicle announcements: {e}")
+        for announcement in due:
+            announcement.left -= 1
+            if announcement.left > 0:
+                announcement.due += A_DOIP_ANNOUNCE_INTERVAL
+            elif self.interval is not None:
+                announcement.due += self.interval + self.jitter(A_DOIP_ACCOUNCE_MAX_WAIT)
+            else:
+                continue
+            # After a stall, carry on from now instead of sending the missed ones in a burst
+            announcement.due = max(announcement.due, now)
+            heapq.heappush(heap, (announcement.due, next(self._order), announcement))
+        if heap:
+            self._wake(heap[0][0])
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU cache of framed replies to idempotent UDS requests.
+
+    Keys are whatever identifies the reply (tester address, session state and the raw request
+    for the server), values are the bytes to write back plus anything needed to replay the
+    request. Entries are evicted least recently used first once `maxsize` is reached, and
+    clear() drops everything when the data behind the replies changes.
+
+    :param maxsize: Maximum number of entries, 0 disables the cache
+    :type maxsize: int
+    """
+
+    __slots__ = ("maxsize", "_entries")
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """Drop the entries whose key matches `predicate`"""
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
@@ -1,9 +1,14 @@
 import logging
 import ipaddress
+import lzma
+import os
+import selectors
 import socket
 import struct
 import time
 import ssl
+import zlib
+from collections import deque
 from enum import IntEnum
 from typing import Union
 from lib.constants import (
@@ -12,99 +17,90 @@ from lib.constants import (
     UDP_DISCOVERY,
     A_PROCESSING_TIME,
     LINK_LOCAL_MULTICAST_ADDRESS,
+    COMPRESSION_METHODS,
 )
 from lib.messages import *
 
 logger = logging.getLogger("doipclient")
 
+# Bytes read from the TCP socket at a time. Large enough that TransferData blocks of 64K and
+# more arrive in a few reads
+TCP_RECV_SIZE = 0x40000
+
+
+def read_blocks(file, block_length, compression=None):
+    """Read a file as TransferData blocks of `block_length` bytes, the last one shorter.
+
+    With a compression method (see lib.constants.COMPRESSION_METHODS) the file is compressed
+    on the fly and the compressed stream is cut into blocks. Uncompressed blocks are
+    memoryviews over a buffer that is reused for the next block.
+    """
+    if compression is None:
+        buffer = memoryview(bytearray(block_length))
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                return
+            yield buffer[:count]
+
+    if compression == "zlib":
+        compressor = zlib.compressobj()
+    elif compression == "lzma":
+        compressor = lzma.LZMACompressor()
+    else:
+        raise ValueError(f"Unknown compression method: {compression}")
+    pending = bytearray()
+    while True:
+        data = file.read(max(block_length, 0x10000))
+        pending += compressor.compress(data) if data else compressor.flush()
+        while len(pending) >= block_length:
+            yield bytes(pending[:block_length])
+            del pending[:block_length]
+        if not data:
+            if pending:
+                yield bytes(pending)
+            return
+
 
 class Parser:
-    """Implements state machine for DoIP transport layer.
+    """Implements framing for the DoIP transport layer.
 
     See Table 16 "Generic DoIP header structure" of ISO 13400-2:2019 (E). While TCP transport
-    is reliable, the UDP broadcasts are not, so the state machine is a little more defensive
+    is reliable, the UDP broadcasts are not, so the framing is a little more defensive
     than one might otherwise expect. When using TCP, reads from the socket aren't guaranteed
-    to be exactly one DoIP message, so the running buffer needs to be maintained across reads
-    """
+    to be exactly one DoIP message, so the running buffer needs to be maintained across reads.
 
-    class ParserState(IntEnum):
-        READ_PROTOCOL_VERSION = 1
-        READ_INVERSE_PROTOCOL_VERSION = 2
-        READ_PAYLOAD_TYPE = 3
-        READ_PAYLOAD_SIZE = 4
-        READ_PAYLOAD = 5
+    Every complete message in the buffer is decoded in one decode_all() pass and queued, so
+    subsequent read_message() calls hand them out without touching the buffer again.
 
-    def __init__(self):
+    :param zero_copy: Decode DiagnosticMessage user data as memoryviews instead of copies.
+        A decoded buffer is never modified afterwards, the tail goes into a new one.
+    :type zero_copy: bool, optional
+    """
+
+    def __init__(self, zero_copy=False):
+        self._zero_copy = zero_copy
         self.reset()
 
     def reset(self):
         self.rx_buffer = bytearray()
-        self.protocol_version = None
-        self.payload_type = None
-        self.payload_size = None
-        self.payload = bytearray()
-        self._state = Parser.ParserState.READ_PROTOCOL_VERSION
+        self._messages = deque()
 
     def push_bytes(self, data_bytes):
         self.rx_buffer += data_bytes
 
     def read_message(self, data_bytes):
         self.rx_buffer += data_bytes
-        if self._state == Parser.ParserState.READ_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                self.payload = bytearray()
-                self.payload_type = None
-                self.payload_size = None
-                self.protocol_version = int(self.rx_buffer.pop(0))
-                self._state = Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION
-
-        if self._state == Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                inverse_protocol_version = int(self.rx_buffer.pop(0))
-                if inverse_protocol_version != (0xFF ^ self.protocol_version):
-                    logger.warning(
-                        "Bad DoIP Header - Inverse protocol version does not match. Ignoring."
-                    )
-                    # Bad protocol version inverse - shift the buffer forward
-                    self.protocol_version = inverse_protocol_version
-                else:
-                    self._state = Parser.ParserState.READ_PAYLOAD_TYPE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_TYPE:
-            if len(self.rx_buffer) >= 2:
-                self.payload_type = self.rx_buffer.pop(0) << 8
-                self.payload_type |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD_SIZE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_SIZE:
-            if len(self.rx_buffer) >= 4:
-                self.payload_size = self.rx_buffer.pop(0) << 24
-                self.payload_size |= self.rx_buffer.pop(0) << 16
-                self.payload_size |= self.rx_buffer.pop(0) << 8
-                self.payload_size |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD
-
-        if self._state == Parser.ParserState.READ_PAYLOAD:
-            remaining_bytes = self.payload_size - len(self.payload)
-            self.payload += self.rx_buffer[:remaining_bytes]
-            self.rx_buffer = self.rx_buffer[remaining_bytes:]
-            if len(self.payload) == self.payload_size:
-                self._state = Parser.ParserState.READ_PROTOCOL_VERSION
-                logger.debug(
-                    "Received DoIP Message. Type: 0x{:X}, Payload Size: {} bytes, Payload: {}".format(
-                        self.payload_type,
-                        self.payload_size,
-                        " ".join(f"{byte:02X}" for byte in self.payload),
-                    )
-                )
-                try:
-                    return payload_type_to_message[self.payload_type].unpack(
-                        self.payload, self.payload_size
-                    )
-                except KeyError:
-                    return ReservedMessage.unpack(
-                        self.payload_type, self.payload, self.payload_size
-                    )
+        if not self._messages and len(self.rx_buffer) >= DOIP_HEADER.size:
+            decoded, consumed = decode_all(self.rx_buffer, self._zero_copy)
+            if consumed:
+                # Only the (partial) tail is carried over, into a fresh buffer
+                self.rx_buffer = bytearray(memoryview(self.rx_buffer)[consumed:])
+            for _, message in decoded:
+                logger.debug("Received DoIP Message: %s", message)
+                self._messages.append(message)
+        if self._messages:
+            return self._messages.popleft()
 
 
 class DoIPClient:
@@ -149,6 +145,9 @@ class DoIPClient:
     :type log_level: int
     :param auto_reconnect_tcp: Attempt to automatically reconnect TCP sockets that were closed by peer
     :type auto_reconnect_tcp: bool
+    :param zero_copy: Return received diagnostic payloads as memoryviews over the receive buffer instead
+        of copying them. Callers that keep or modify the payload should take a copy with bytes().
+    :type zero_copy: bool
 
     :raises ConnectionRefusedError: If the activation request fails
     :raises ValueError: If the IPAddress is neither an IPv4 nor an IPv6 address
@@ -166,6 +165,7 @@ class DoIPClient:
         client_ip_address=None,
         use_secure=False,
         auto_reconnect_tcp=False,
+        zero_copy=False,
     ):
         self._ecu_logical_address = ecu_logical_address
         self._client_logical_address = client_logical_address
@@ -175,11 +175,17 @@ class DoIPClient:
         self._tcp_port = tcp_port
         self._udp_port = udp_port
         self._activation_type = activation_type
+        self._zero_copy = zero_copy
         self._udp_parser = Parser()
-        self._tcp_parser = Parser()
+        self._tcp_parser = Parser(zero_copy)
         self._protocol_version = protocol_version
         self._auto_reconnect_tcp = auto_reconnect_tcp
         self._tcp_close_detected = False
+        # With auto_reconnect_tcp, the last TCP frame until something comes back, in case the
+        # connection turns out to have been closed under it
+        self._unanswered_frame = None
+        # Readiness of the TCP socket for _tcp_socket_check(), set up by _connect()
+        self._tcp_selector = None
 
         # Check the ECU IP type to determine socket family
         # Will raise ValueError if neither a valid IPv4, nor IPv6 address
@@ -246,17 +252,27 @@ class DoIPClient:
         return sock
 
     @staticmethod
-    def _pack_doip(protocol_version, payload_type, payload_data):
-        data_bytes = struct.pack(
-            "!BBHL",
-            protocol_version,
-            0xFF ^ protocol_version,
-            payload_type,
-            len(payload_data),
-        )
-        data_bytes += payload_data
+    def _send_buffers(sock, buffers):
+        """Writes a DoIP frame given as a list of buffers (see DoIPMessage.pack_buffers()).
 
-        return data_bytes
+        Uses scatter-gather sendmsg() so header and payload go out without being
+        concatenated first. SSL sockets don't support sendmsg(), so they get one joined
+        buffer instead.
+        """
+        if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, "sendmsg"):
+            sock.sendall(b"".join(buffers))
+            return
+        views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        while views:
+            sent = sock.sendmsg(views)
+            # Partial write, drop whatever went out and go again with the rest
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views[0])
+                    del views[0]
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
 
     @classmethod
     def await_vehicle_announcement(
@@ -357,18 +373,8 @@ class DoIPClient:
         else:
             message = VehicleIdentificationRequest()
 
-        payload_data = message.pack()
-        payload_type = payload_message_to_type[type(message)]
-
-        data_bytes = cls._pack_doip(protocol_version, payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP Vehicle Identification Request: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
-            )
-        )
-        sock.sendto(data_bytes, (ecu_ip_address, UDP_DISCOVERY))
+        logger.debug(f"Sending DoIP Vehicle Identification Request: {message}")
+        sock.sendto(message.pack_frame(protocol_version), (ecu_ip_address, UDP_DISCOVERY))
 
         return cls.await_vehicle_announcement(timeout=A_DOIP_CTRL, sock=sock)
 
@@ -393,13 +399,13 @@ class DoIPClient:
         :raises TimeoutException: If ECU fails to respond in time
         """
         start_time = time.time()
-        data = bytearray()
+        data = b""
         while (time.time() - start_time) <= timeout:
             if transport == DoIPClient.TransportType.TRANSPORT_TCP:
                 response = self._tcp_parser.read_message(data)
             else:
                 response = self._udp_parser.read_message(data)
-            data = bytearray()
+            data = b""
             if type(response) == GenericDoIPNegativeAcknowledge:
                 raise IOError(
                     f"DoIP Negative Acknowledge. NACK Code: {response.nack_code}"
@@ -410,6 +416,8 @@ class DoIPClient:
             elif response:
                 # We got a response that might actually be interesting to the caller,
                 # so return it.
+                if transport == DoIPClient.TransportType.TRANSPORT_TCP:
+                    self._unanswered_frame = None
                 return response
             else:
                 # There were no responses in the parser, so we need to read off the network
@@ -418,6 +426,11 @@ class DoIPClient:
                 if (
                     transport == DoIPClient.TransportType.TRANSPORT_TCP
                 ) and self._tcp_close_detected:
+                    if self._resend_unanswered_frame():
+                        # Waiting for the answer starts over, like it would have after a resend
+                        # from send_doip()
+                        start_time = time.time()
+                        continue
                     # The caller is looking for TCP responses, but there were no messages
                     # returned from the parser and the socket has been closed (so no further
                     # responses are expected). It's safe to stop looking early and raise
@@ -426,7 +439,7 @@ class DoIPClient:
                 else:
                     try:
                         if transport == DoIPClient.TransportType.TRANSPORT_TCP:
-                            data = self._tcp_sock.recv(1024)
+                            data = self._tcp_sock.recv(TCP_RECV_SIZE)
                             if len(data) == 0:
                                 logger.debug("Peer has closed the connection.")
                                 self._tcp_close_detected = True
@@ -437,42 +450,61 @@ class DoIPClient:
                             data = self._udp_sock.recv(1024)
                     except socket.timeout:
                         pass
+                    except (ConnectionResetError, BrokenPipeError):
+                        logger.debug("TCP Connection broken")
+                        self._tcp_close_detected = True
         raise TimeoutError("ECU failed to respond in time")
 
-    def _tcp_socket_check(self, first_timeout=0.010):
-        """Helper function to service a TCP socket and check for disconnects.
+    def _tcp_socket_check(self):
+        """Helper function to service a TCP socket and check for disconnects, without waiting.
 
         Called from send_doip() before and after TCP socket sends to detect if reconnect
-        is needed.
-
-        :param first_timeout: Timeout for the first recv() call. This should correspond to
-            how long you expect the ECU to return an RST after sending to the
-            socket if the connection was unexpectedly terminated. Too long
-            and it hurts performance, too short and you run the risk of
-            missing a socket reconnect opportunity. Normally <1ms, but
-            allowing 10ms by default to be safe.
-        :type first_timeout: float
+        is needed. A zero timeout poll tells whether anything arrived. Responses are read into
+        the parser and a FIN or an RST marks the connection as closed. An RST provoked by the
+        send itself usually arrives later, read_doip() sees it while waiting for the answer
+        and sends the frame again then.
         """
-        original_timeout = self._tcp_sock.gettimeout()
+        sock = self._tcp_sock
+        secure = isinstance(sock, ssl.SSLSocket)
+        if secure:
+            # A readable TLS socket may only hold part of a record, which a blocking recv()
+            # would wait for the rest of
+            timeout = sock.gettimeout()
+            sock.settimeout(0)
         try:
-            self._tcp_sock.settimeout(first_timeout)
-            while True:
-                data = self._tcp_sock.recv(1024)
+            # Decrypted TLS data doesn't make the socket readable
+            while self._tcp_selector.select(0) or (secure and sock.pending()):
+                data = sock.recv(TCP_RECV_SIZE)
                 if len(data) == 0:
                     logger.debug("TCP Connection closed by ECU, attempting to reset")
                     self._tcp_close_detected = True
                     break
-                else:
-                    self._tcp_parser.push_bytes(data)
-                # Subsequent reads, go to 0 timeout
-                self._tcp_sock.settimeout(0)
+                self._tcp_parser.push_bytes(data)
         except (BlockingIOError, socket.timeout, ssl.SSLError):
+            # SSLWantReadError when the rest of a TLS record hasn't arrived yet
             pass
         except (ConnectionResetError, BrokenPipeError):
             logger.debug("TCP Connection broken, attempting to reset")
             self._tcp_close_detected = True
         finally:
-            self._tcp_sock.settimeout(original_timeout)
+            if secure:
+                sock.settimeout(timeout)
+
+    def _resend_unanswered_frame(self):
+        """Reconnects and sends the last TCP frame again, when auto_reconnect_tcp is set and
+        the connection closed before anything came back. Once per frame
+
+        :return: Whether the frame was sent again
+        :rtype: bool
+        """
+        buffers = self._unanswered_frame
+        if buffers is None:
+            return False
+        self._unanswered_frame = None
+        logger.warning("TCP connection closed before the ECU answered, reconnecting")
+        self.reconnect()
+        self._send_buffers(self._tcp_sock, buffers)
+        return True
 
     def send_doip(
         self,
@@ -493,17 +525,33 @@ class DoIPClient:
             requests during connect/reconnect.
         :type disable_retry: bool, optional
         """
+        buffers = [
+            pack_doip_header(self._protocol_version, payload_type, len(payload_data)),
+            payload_data,
+        ]
+        self._send_doip_buffers(payload_type, buffers, transport, disable_retry)
+
+    def _send_doip_buffers(self, payload_type, buffers, transport, disable_retry):
+        """Sends a DoIP frame given as a list of buffers, header first"""
 
         retry = self._auto_reconnect_tcp and not disable_retry
 
-        data_bytes = self._pack_doip(self._protocol_version, payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP Message: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
+        if logger.isEnabledFor(logging.DEBUG):
+            payload_data = b"".join(buffers)[DOIP_HEADER.size :]
+            logger.debug(
+                "Sending DoIP Message: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
+                    payload_type,
+                    len(payload_data),
+                    " ".join(f"{byte:02X}" for byte in payload_data),
+                )
+            )
+
+        if transport != DoIPClient.TransportType.TRANSPORT_TCP:
+            # "Only one DoIP message shall be transmitted by any DoIP entity per datagram"
+            self._udp_sock.sendto(
+                b"".join(buffers), (self._ecu_ip_address, self._udp_port)
             )
-        )
+            return
 
         # The ECU is well within its rights to have closed the socket since we last sent it data -
         # particularly if the tester has been quiet for a while. For TCP there's two possibilities
@@ -516,36 +564,32 @@ class DoIPClient:
         # to respond). So, we'll handle before the Tx, but we won't allow it to block.
 
         if retry:
-            self._tcp_socket_check(first_timeout=0)
+            self._tcp_socket_check()
 
-        remaining = len(data_bytes)
         attempted_reconnect = False
+        while True:
+            if retry and self._tcp_close_detected:
+                if not attempted_reconnect:
+                    logger.warning("TCP reconnecting")
+                    self.reconnect()
+                    attempted_reconnect = True
+                else:
+                    logger.warning(
+                        "TCP needs reconnection, but we already attempted once. Send will fail."
+                    )
 
-        # In general, the entire DoIP message should fit in one TCP packet, but it's good practice
-        # to loop until the whole packet has been written, in case the OS write buffers get backed up
-        while remaining > 0:
-            if transport == DoIPClient.TransportType.TRANSPORT_TCP:
-                if retry and self._tcp_close_detected:
-                    if not attempted_reconnect:
-                        logger.warning("TCP reconnecting")
-                        self.reconnect()
-                        attempted_reconnect = True
-                    else:
-                        logger.warning(
-                            "TCP needs reconnection, but we already attempted once. Send will fail."
-                        )
-
-                remaining -= self._tcp_sock.send(data_bytes[-remaining:])
-
-                if retry and not self._tcp_close_detected:
-                    self._tcp_socket_check()
-                    if self._tcp_close_detected:
-                        remaining = len(data_bytes)
+            # Header and payload go out in one scatter-gather write, which loops until the whole
+            # frame has been written in case the OS write buffers get backed up
+            self._send_buffers(self._tcp_sock, buffers)
 
-            else:
-                remaining -= self._udp_sock.sendto(
-                    data_bytes[-remaining:], (self._ecu_ip_address, self._udp_port)
-                )
+            if retry and not self._tcp_close_detected:
+                self._tcp_socket_check()
+                if self._tcp_close_detected and not attempted_reconnect:
+                    # The frame was lost along with the connection, so send it again
+                    continue
+            if retry:
+                self._unanswered_frame = None if attempted_reconnect else buffers
+            break
 
     def send_doip_message(
         self,
@@ -565,10 +609,11 @@ class DoIPClient:
             requests during connect/reconnect.
         :type disable_retry: bool, optional
         """
-        payload_type = payload_message_to_type[type(doip_message)]
-        payload_data = doip_message.pack()
-        self.send_doip(
-            payload_type, payload_data, transport=transport, disable_retry=disable_retry
+        self._send_doip_buffers(
+            doip_message.payload_type,
+            doip_message.pack_buffers(self._protocol_version),
+            transport,
+            disable_retry,
         )
 
     def request_activation(
@@ -700,13 +745,34 @@ class DoIPClient:
         """Send a raw diagnostic payload (ie: UDS) to the ECU.
 
         :param diagnostic_payload: UDS payload to transmit to the ECU
-        :type diagnostic_payload: bytearray
+        :type diagnostic_payload: bytes-like
         :raises IOError: DoIP negative acknowledgement received
         """
         message = DiagnosticMessage(
             self._client_logical_address, self._ecu_logical_address, diagnostic_payload
         )
         self.send_doip_message(message)
+        self._await_diagnostic_acknowledgement(timeout)
+
+    def send_diagnostic_parts(self, parts, timeout=A_PROCESSING_TIME):
+        """Send a raw diagnostic payload made up of several buffers, such as a TransferData
+        header and its data block, without joining them. See send_diagnostic()
+        """
+        buffers = DiagnosticMessage.pack_parts(
+            self._client_logical_address,
+            self._ecu_logical_address,
+            parts,
+            self._protocol_version,
+        )
+        self._send_doip_buffers(
+            DiagnosticMessage.payload_type,
+            buffers,
+            DoIPClient.TransportType.TRANSPORT_TCP,
+            False,
+        )
+        self._await_diagnostic_acknowledgement(timeout)
+
+    def _await_diagnostic_acknowledgement(self, timeout):
         start_time = time.time()
         while True:
             ellapsed_time = time.time() - start_time
@@ -735,7 +801,7 @@ class DoIPClient:
         """Receive a raw diagnostic payload (ie: UDS) from the ECU.
 
         :return: Raw UDS payload
-        :rtype: bytearray
+        :rtype: bytes, or memoryview when the client was created with zero_copy
         :raises TimeoutError: No diagnostic response received in time
         """
         start_time = time.time()
@@ -756,6 +822,129 @@ class DoIPClient:
                     )
                 )
 
+    def _uds_request(self, uds_request, timeout, data=None):
+        """Send a raw UDS request, followed by `data` as a separate buffer if given, and return
+        its positive response, skipping ResponsePending
+
+        :raises IOError: Negative response received
+        """
+        if data is None:
+            self.send_diagnostic(uds_request, timeout=timeout)
+        else:
+            self.send_diagnostic_parts((uds_request, data), timeout=timeout)
+        while True:
+            response = self.receive_diagnostic(timeout=timeout)
+            if response[0] != 0x7F:
+                return response
+            if len(response) >= 3 and response[2] == 0x78:
+                continue
+            raise IOError(
+                "UDS request 0x{:02X} rejected with negative response code 0x{:02X}".format(
+                    uds_request[0], response[2] if len(response) >= 3 else 0
+                )
+            )
+
+    @staticmethod
+    def _max_number_of_block_length(response):
+        # lengthFormatIdentifier: length of maxNumberOfBlockLength in the high nibble
+        length = response[1] >> 4
+        return int.from_bytes(response[2 : 2 + length], byteorder="big")
+
+    def download_from_file(
+        self,
+        file_path,
+        memory_address,
+        address_length=4,
+        size_length=4,
+        timeout=A_PROCESSING_TIME,
+        compression=None,
+    ):
+        """Write a file to the ECU's memory with RequestDownload, TransferData and
+        RequestTransferExit. The blocks are as large as the maxNumberOfBlockLength the ECU
+        answers RequestDownload with, and each goes out straight from the file's buffer.
+        With `compression`, the file is compressed on the fly and announced in the
+        dataFormatIdentifier.
+
+        :param file_path: File to download
+        :type file_path: str
+        :param memory_address: Address to download the file to
+        :type memory_address: int
+        :param address_length: Bytes used to encode memoryAddress in the request
+        :type address_length: int, optional
+        :param size_length: Bytes used to encode memorySize in the request
+        :type size_length: int, optional
+        :param compression: Compression method, see lib.constants.COMPRESSION_METHODS
+        :type compression: str, optional
+        :return: The RequestTransferExit response
+        :rtype: bytes, or memoryview when the client was created with zero_copy
+        :raises IOError: The ECU rejected a request
+        """
+        with open(file_path, "rb") as file:
+            memory_size = os.fstat(file.fileno()).st_size
+            # dataFormatIdentifier: compressionMethod in the high nibble, no encryption.
+            # memorySize is the size of the uncompressed image
+            data_format = COMPRESSION_METHODS[compression] << 4 if compression else 0x00
+            request = (
+                bytes((0x34, data_format, size_length << 4 | address_length))
+                + memory_address.to_bytes(address_length, byteorder="big")
+                + memory_size.to_bytes(size_length, byteorder="big")
+            )
+            response = self._uds_request(request, timeout)
+            # maxNumberOfBlockLength counts the SID and blockSequenceCounter too
+            block_length = self._max_number_of_block_length(response) - 2
+            block_sequence_counter = 1
+            for block in read_blocks(file, block_length, compression):
+                self._uds_request(bytes((0x36, block_sequence_counter)), timeout, block)
+                block_sequence_counter = (block_sequence_counter + 1) & 0xFF
+        return self._uds_request(b"\x37", timeout)
+
+    def upload_to_file(
+        self,
+        file_path,
+        memory_address,
+        memory_size,
+        address_length=4,
+        size_length=4,
+        timeout=A_PROCESSING_TIME,
+    ):
+        """Read memory out of the ECU with RequestUpload, TransferData and RequestTransferExit
+        and stream it into a file as the blocks arrive. The ECU decides the block length. With
+        zero_copy, blocks are written to the file straight from the receive buffer.
+
+        :param file_path: File to write the memory to, created or truncated
+        :type file_path: str
+        :param memory_address: Address of the memory to read
+        :type memory_address: int
+        :param memory_size: Number of bytes to read
+        :type memory_size: int
+        :param address_length: Bytes used to encode memoryAddress in the request
+        :type address_length: int, optional
+        :param size_length: Bytes used to encode memorySize in the request
+        :type size_length: int, optional
+        :return: Number of bytes written
+        :rtype: int
+        :raises IOError: The ECU rejected a request or sent an empty block
+        """
+        request = (
+            bytes((0x35, 0x00, size_length << 4 | address_length))
+            + memory_address.to_bytes(address_length, byteorder="big")
+            + memory_size.to_bytes(size_length, byteorder="big")
+        )
+        self._uds_request(request, timeout)
+        received = 0
+        block_sequence_counter = 1
+        with open(file_path, "wb") as file:
+            while received < memory_size:
+                response = self._uds_request(bytes((0x36, block_sequence_counter)), timeout)
+                block = memoryview(response)[2:]
+                if not block:
+                    raise IOError(f"Empty TransferData block after {received} bytes")
+                file.write(block)
+                received += len(block)
+                block_sequence_counter = (block_sequence_counter + 1) & 0xFF
+        self._uds_request(b"\x37", timeout)
+        return received
+
     def _connect(self):
         """Helper to establish socket communication"""
         self._tcp_sock = socket.socket(self._address_family, socket.SOCK_STREAM)
@@ -780,12 +969,19 @@ class DoIPClient:
                 ssl_context = ssl.create_default_context()
             self._wrap_socket(ssl_context)
 
+        # Readiness of the TCP socket for _tcp_socket_check()
+        self._tcp_selector = selectors.DefaultSelector()
+        self._tcp_selector.register(self._tcp_sock, selectors.EVENT_READ)
+
     def _wrap_socket(self, ssl_context):
         """Wrap the underlying socket in a SSL context."""
         self._tcp_sock = ssl_context.wrap_socket(self._tcp_sock)
 
     def close(self):
         """Close the DoIP client"""
+        if self._tcp_selector is not None:
+            self._tcp_selector.close()
+            self._tcp_selector = None
         self._tcp_sock.close()
         self._udp_sock.close()
 
@@ -799,7 +995,7 @@ class DoIPClient:
         self.close()
         # Reset the parser state machines
         self._udp_parser = Parser()
-        self._tcp_parser = Parser()
+        self._tcp_parser = Parser(self._zero_copy)
         # Allow the ECU time time to cleanup the DoIP session/socket before re-establishing
         time.sleep(close_delay)
         self._connect()
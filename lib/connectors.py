@@ -40,9 +40,13 @@ class DoIPClientUDSConnector(BaseConnection):
         return self.opened
 
     def specific_send(self, payload):
-        self._connection.send_diagnostic(bytearray(payload))
+        # DiagnosticMessage accepts any bytes-like payload, no need for a copy
+        self._connection.send_diagnostic(payload)
 
     def specific_wait_frame(self, timeout=2):
+        # udsoncan hands parts of responses back to callers (e.g. seeds for send_key) and needs
+        # bytes for that. Payloads are already bytes unless the client uses zero_copy, in which
+        # case this is the only copy made
         return bytes(self._connection.receive_diagnostic(timeout=timeout))
 
     def empty_rxqueue(self):
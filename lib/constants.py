@@ -6,6 +6,7 @@ A_DOIP_DIAGNOSTIC_MESSAGE = 2  # 2s
 T_TCP_GENERAL_INACTIVITY = 300  # 5 Min
 T_TCP_INITIAL_INACTIVITY = 2  # 2s
 T_TCP_ALIVE_CHECK = 0.500  # 500ms
+S3_SERVER = 5  # 5s, ISO 14229-2: non-default session timeout
 A_PROCESSING_TIME = 2  # 2s
 A_VEHICLE_DISCOVERY_TIMER = 5  # 5s
 
@@ -16,5 +17,12 @@ UDP_DISCOVERY = 13400
 TCP_DATA_UNSECURED = 13400
 TCP_DATA_SECURED = 3496
 
+# Concurrent TCP_DATA sockets a DoIP entity accepts by default, reported by its entity status
+MAX_CONCURRENT_SOCKETS = 16
+
+# compressionMethod (high nibble of the dataFormatIdentifier) of the compression methods the
+# simulator supports. The values are vehicle manufacturer specific
+COMPRESSION_METHODS = {"zlib": 0x1, "lzma": 0x2}
+
 # link-local scope multicast address (FF02 16 ::1)
 LINK_LOCAL_MULTICAST_ADDRESS = "ff02::1"
@@ -0,0 +1,382 @@
+import os
+
+from udsoncan import DataIdentifier
+
+from lib.cache import ResponseCache
+from lib.constants import COMPRESSION_METHODS, MAX_CONCURRENT_SOCKETS
+from lib.uds import CACHEABLE_SERVICES, DEFAULT_HANDLERS
+
+
+def _did_value(value):
+    """DID values in yaml.conf can be strings, !!binary or integers"""
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, int):
+        return value.to_bytes(max(1, (value.bit_length() + 7) // 8), byteorder="big")
+    return bytes(value)
+
+
+class EcuModel:
+    """Personality of a simulated ECU: its logical address and the data it answers with.
+
+    An EcuModel is shared by every tester connection. Anything a tester can change (security
+    access, ...) lives in the EcuSession of that connection instead. The exception is
+    WriteDataByIdentifier: like the non-volatile memory of a real ECU, written DIDs belong to
+    the ECU, and every tester reads them back (see write_data_by_identifier()).
+
+    :param name: Name used in logs
+    :type name: str
+    :param logical_address: Logical address diagnostic messages are routed to
+    :type logical_address: int
+    :param vin: VIN returned for DataIdentifier.VIN
+    :type vin: str
+    :param dids: Values returned by ReadDataByIdentifier, keyed by data identifier
+    :type dids: dict, optional
+    :param handlers: UDS service handlers to use instead of the defaults from lib.uds, keyed
+        by SID
+    :type handlers: dict, optional
+    :param routines: How long routines take in seconds, keyed by routine ID. Routines that
+        aren't listed take DEFAULT_ROUTINE_DURATION
+    :type routines: dict, optional
+    :param images: Files served by RequestUpload, keyed by the memory address their first byte
+        is at
+    :type images: dict, optional
+    :param max_number_of_block_length: maxNumberOfBlockLength announced by RequestDownload
+        and RequestUpload: the length of TransferData requests and responses, SID and
+        blockSequenceCounter included
+    :type max_number_of_block_length: int, optional
+    :param compression: Compression methods accepted by RequestDownload, by name (see
+        lib.constants.COMPRESSION_METHODS). All of them by default
+    :type compression: list, optional
+    :param response_cache_size: Number of replies to idempotent requests kept ready to send,
+        0 disables the cache
+    :type response_cache_size: int, optional
+    """
+
+    __slots__ = (
+        "name",
+        "logical_address",
+        "vin",
+        "dids",
+        "handlers",
+        "cacheable",
+        "response_cache",
+        "routines",
+        "images",
+        "max_number_of_block_length",
+        "compression_methods",
+    )
+
+    DEFAULT_ROUTINE_DURATION = 0.1
+
+    def __init__(
+        self,
+        name,
+        logical_address,
+        vin,
+        dids=None,
+        handlers=None,
+        routines=None,
+        images=None,
+        max_number_of_block_length=0x1000,
+        compression=None,
+        response_cache_size=256,
+    ):
+        self.name = name
+        self.logical_address = logical_address
+        self.vin = vin
+        self.handlers = dict(DEFAULT_HANDLERS)
+        # SIDs whose reply only depends on the request and the session state
+        self.cacheable = set(CACHEABLE_SERVICES)
+        if handlers:
+            self.handlers.update(handlers)
+            self.cacheable.difference_update(handlers)
+        self.response_cache = ResponseCache(response_cache_size)
+        self.routines = {int(rid): float(duration) for rid, duration in (routines or {}).items()}
+        self.images = {int(address): path for address, path in (images or {}).items()}
+        if max_number_of_block_length < 3:
+            raise ValueError(f"{name}: maxNumberOfBlockLength must leave room for data")
+        self.max_number_of_block_length = max_number_of_block_length
+        if compression is None:
+            compression = COMPRESSION_METHODS
+        # Compression method names by compressionMethod
+        self.compression_methods = {}
+        for method in compression:
+            if method not in COMPRESSION_METHODS:
+                raise ValueError(f"{name}: unknown compression method {method}")
+            self.compression_methods[COMPRESSION_METHODS[method]] = method
+        self.dids = {
+            DataIdentifier.ActiveDiagnosticSession: b"\x02",
+            DataIdentifier.VIN: vin.encode(),
+        }
+        if dids:
+            self.dids.update((int(did), _did_value(value)) for did, value in dids.items())
+
+    def for_vehicle(self, logical_address, vin):
+        """The same ECU in another vehicle: configured like this one, with its own logical
+        address, VIN, DIDs and response cache"""
+        ecu = EcuModel.__new__(EcuModel)
+        for name in self.__slots__:
+            setattr(ecu, name, getattr(self, name))
+        ecu.logical_address = logical_address
+        ecu.vin = vin
+        ecu.handlers = dict(self.handlers)
+        ecu.cacheable = set(self.cacheable)
+        ecu.response_cache = ResponseCache(self.response_cache.maxsize)
+        ecu.dids = dict(self.dids)
+        ecu.dids[DataIdentifier.VIN] = vin.encode()
+        return ecu
+
+    def read_data_by_identifier(self, did):
+        return self.dids.get(did, b"\x00")
+
+    def routine_duration(self, rid):
+        return self.routines.get(rid, self.DEFAULT_ROUTINE_DURATION)
+
+    def find_image(self, memory_address):
+        """Return the path of the image that memory_address falls into (the one starting
+        closest below it) and the offset of the address in it, or None"""
+        starts = [start for start in self.images if start <= memory_address]
+        if not starts:
+            return None
+        start = max(starts)
+        return self.images[start], memory_address - start
+
+    def register_handler(self, sid, handler, cacheable=False):
+        """Handle a UDS service with `handler` on this ECU, replacing any previous handler.
+        See lib.uds for the handler signature.
+
+        :param cacheable: The handler's response and the session state it leaves behind only
+            depend on the request and the session state, so replies can be cached
+        """
+        self.handlers[sid] = handler
+        if cacheable:
+            self.cacheable.add(sid)
+        else:
+            self.cacheable.discard(sid)
+        self.response_cache.clear()
+
+    def write_data_by_identifier(self, did, value):
+        """Store a DID written by a tester. The value is ECU-global: every connection to this
+        ECU reads it from now on, until the server stops. With --workers, each worker process
+        keeps its own values"""
+        self.dids[did] = bytes(value)
+        # Drop the cached ReadDataByIdentifier replies that include the DID
+        did_bytes = did.to_bytes(2, byteorder="big")
+        self.response_cache.invalidate(
+            lambda key: key[2][0] == 0x22
+            and any(key[2][offset : offset + 2] == did_bytes for offset in range(1, len(key[2]), 2))
+        )
+
+    def __repr__(self):
+        return f"EcuModel({self.name!r}, 0x{self.logical_address:04X})"
+
+
+class EcuSession:
+    """State of one ECU as seen by one tester connection"""
+
+    __slots__ = (
+        "ecu",
+        "tester_address",
+        "diagnostic_session",
+        "seed",
+        "auth_flag",
+        "append_file_name",
+        "download",
+        "upload",
+        "image_digest",
+        "last_request",
+        "s3_timer",
+    )
+
+    def __init__(self, ecu, tester_address, append_file_name):
+        self.ecu = ecu
+        # Logical address of the tester the ECU answers to
+        self.tester_address = tester_address
+        self.diagnostic_session = 0x01
+        # [Fix error] due to the python version
+        # self.seed = random.randbytes(3)
+        self.seed = os.urandom(3)
+        self.auth_flag = False
+        self.append_file_name = append_file_name
+        # ImageSink of the RequestDownload in progress
+        self.download = None
+        # ImageSource of the RequestUpload in progress
+        self.upload = None
+        # CRC32 and SHA-256 of the image of the last completed download
+        self.image_digest = None
+        # Timing wheel tick of the last diagnostic request, and the S3server timer running
+        # while the ECU is outside of the default session
+        self.last_request = 0
+        self.s3_timer = None
+
+    @property
+    def state(self):
+        """Everything a cached reply can depend on besides the request itself"""
+        return self.diagnostic_session, self.auth_flag
+
+    @state.setter
+    def state(self, state):
+        self.diagnostic_session, self.auth_flag = state
+
+    def image_file_name(self, memory_address):
+        return f"{self.append_file_name[:-4]}_{memory_address:08X}.bin"
+
+    def close_download(self, callback=None):
+        """Close the image of the current download, see ImageSink.close(). `callback` is
+        called right away if there's no download"""
+        download, self.download = self.download, None
+        if download is not None:
+            download.close(callback)
+        elif callback is not None:
+            callback(None)
+
+    def close_upload(self):
+        upload, self.upload = self.upload, None
+        if upload is not None:
+            upload.close()
+
+    def reset_session(self):
+        """Fall back to the default session, which locks security access again"""
+        self.diagnostic_session = 0x01
+        self.auth_flag = False
+
+    def close(self):
+        if self.s3_timer is not None:
+            self.s3_timer.cancel()
+            self.s3_timer = None
+        self.close_download()
+        self.close_upload()
+
+
+class Gateway:
+    """Routes diagnostic messages to ECU models by their target address.
+
+    In single ECU mode (see Gateway.single()) the one ECU answers every target address, which
+    is how the simulator has always behaved. In gateway mode, targets that don't belong to a
+    configured ECU aren't routed, and the server rejects them with UnknownTargetAddress.
+
+    :param logical_address: Address of the DoIP entity itself, used for routing activation
+        and vehicle identification
+    :type logical_address: int
+    :param ecus: ECU models behind the gateway
+    :type ecus: list
+    :param default: ECU that gets messages for unknown targets, if any
+    :type default: EcuModel, optional
+    :param max_sockets: Concurrent TCP_DATA sockets the entity accepts, 1 to 255
+    :type max_sockets: int, optional
+    :param max_data_size: Largest DoIP payload the entity takes (MDS). By default the largest
+        maxNumberOfBlockLength of the ECUs plus the source and target address
+    :type max_data_size: int, optional
+    """
+
+    def __init__(self, logical_address, ecus, default=None, max_sockets=MAX_CONCURRENT_SOCKETS,
+                 max_data_size=None):
+        self.logical_address = logical_address
+        self.ecus = {ecu.logical_address: ecu for ecu in ecus}
+        self.default = default
+        if not 1 <= max_sockets <= 0xFF:
+            raise ValueError("maxConcurrentSockets must be between 1 and 255")
+        self.max_sockets = max_sockets
+        if max_data_size is None:
+            max_data_size = max(ecu.max_number_of_block_length for ecu in ecus) + 4
+        self.max_data_size = max_data_size
+
+    def route(self, target_address):
+        """Return the ECU model for a target address, or None if there's none"""
+        return self.ecus.get(target_address, self.default)
+
+    def for_vehicle(self, vin, logical_address):
+        """The same gateway in another vehicle, such as one of a fleet. Its ECUs answer with
+        `vin`, and the ECU at the entity's own address moves to `logical_address` along with the
+        entity. The limits stay the same"""
+        ecus = {}
+        for address, ecu in self.ecus.items():
+            ecus[address] = ecu.for_vehicle(
+                logical_address if address == self.logical_address else address, vin)
+        default = None
+        if self.default is not None:
+            default = ecus.get(self.default.logical_address) or self.default.for_vehicle(logical_address, vin)
+        return Gateway(logical_address, list(ecus.values()), default, self.max_sockets, self.max_data_size)
+
+    @classmethod
+    def single(
+        cls,
+        vin,
+        logical_address,
+        routines=None,
+        images=None,
+        max_number_of_block_length=0x1000,
+        compression=None,
+        max_sockets=MAX_CONCURRENT_SOCKETS,
+        max_data_size=None,
+    ):
+        ecu = EcuModel(
+            "ECU",
+            logical_address,
+            vin,
+            routines=routines,
+            images=images,
+            max_number_of_block_length=max_number_of_block_length,
+            compression=compression,
+        )
+        return cls(
+            logical_address,
+            [ecu],
+            default=ecu,
+            max_sockets=max_sockets,
+            max_data_size=max_data_size,
+        )
+
+    @classmethod
+    def from_conf(cls, ecu_conf):
+        """Build the gateway described by yaml.conf.
+
+        Without a Gateway section this is a single ECU gateway for the ECU section. A Gateway
+        section lists the ECUs by name with their logicalAddress and, optionally, their own
+        vin, dids, routines (durations by routine ID), images (files for RequestUpload by
+        memory address), maxNumberOfBlockLength and compression (accepted compression
+        methods). ECUs without a vin, maxNumberOfBlockLength or compression share the one from
+        the ECU section. The defaults are a 0x1000 (4K) maxNumberOfBlockLength and every
+        compression method.
+
+        maxConcurrentSockets and maxDataSize in the ECU section limit the DoIP entity as a
+        whole, see Gateway().
+        """
+        vin = ecu_conf["ECU"]["vin"]
+        block_length = ecu_conf["ECU"].get("maxNumberOfBlockLength", 0x1000)
+        compression = ecu_conf["ECU"].get("compression")
+        max_sockets = ecu_conf["ECU"].get("maxConcurrentSockets", MAX_CONCURRENT_SOCKETS)
+        max_data_size = ecu_conf["ECU"].get("maxDataSize")
+        gateway_conf = ecu_conf.get("Gateway")
+        if not gateway_conf:
+            return cls.single(
+                vin,
+                ecu_conf["ECU"]["logicalAddress"],
+                ecu_conf["ECU"].get("routines"),
+                ecu_conf["ECU"].get("images"),
+                block_length,
+                compression,
+                max_sockets,
+                max_data_size,
+            )
+
+        ecus = [
+            EcuModel(
+                ecu.get("name", f"ECU_{ecu['logicalAddress']:04X}"),
+                ecu["logicalAddress"],
+                ecu.get("vin", vin),
+                ecu.get("dids"),
+                routines=ecu.get("routines"),
+                images=ecu.get("images"),
+                max_number_of_block_length=ecu.get("maxNumberOfBlockLength", block_length),
+                compression=ecu.get("compression", compression),
+            )
+            for ecu in gateway_conf["ECUs"]
+        ]
+        return cls(
+            gateway_conf.get("logicalAddress", ecu_conf["ECU"]["logicalAddress"]),
+            ecus,
+            max_sockets=max_sockets,
+            max_data_size=max_data_size,
+        )
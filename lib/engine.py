@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import socket
+import weakref
+from collections import namedtuple
+
+from lib.mmsg import DatagramReader
+
+logger = logging.getLogger("doipserver.engine")
+
+# Mirrors the fields of twisted's IPv4Address/IPv6Address that the server protocols use
+PeerAddress = namedtuple("PeerAddress", ["type", "host", "port"])
+
+
+def _peer_address(sockaddr):
+    if sockaddr is None:
+        return PeerAddress("TCP", None, None)
+    return PeerAddress("TCP", sockaddr[0], sockaddr[1])
+
+
+class AsyncioClock:
+    """Exposes an asyncio event loop as the callLater() of twisted's IReactorTime and the
+    callFromThread() of IReactorThreads"""
+
+    __slots__ = ("_loop",)
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def callLater(self, delay, callable, *args):
+        return self._loop.call_later(delay, callable, *args)
+
+    def callFromThread(self, callable, *args):
+        self._loop.call_soon_threadsafe(callable, *args)
+
+    def seconds(self):
+        return self._loop.time()
+
+
+# One clock per event loop, so everything keyed on the clock (like timing wheels) is shared by
+# the loop's connections
+_clocks = weakref.WeakKeyDictionary()
+
+
+def loop_clock(loop):
+    clock = _clocks.get(loop)
+    if clock is None:
+        clock = _clocks[loop] = AsyncioClock(loop)
+    return clock
+
+
+class _StreamTransport:
+    """Exposes an asyncio stream transport with the twisted ITCPTransport calls the server
+    protocols make, so the same protocol classes run on both engines"""
+
+    __slots__ = ("_transport",)
+
+    # Unlike twisted's transports, asyncio's take any bytes-like object, memoryviews included
+    writes_buffers = True
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writeSequence(self, buffers):
+        self._transport.writelines(buffers)
+
+    def doWrite(self):
+        # asyncio already tries to send right away in write(), there's nothing to flush
+        pass
+
+    def getPeer(self):
+        return _peer_address(self._transport.get_extra_info("peername"))
+
+    def getHost(self):
+        return _peer_address(self._transport.get_extra_info("sockname"))
+
+    def loseConnection(self):
+        self._transport.close()
+
+    def abortConnection(self):
+        self._transport.abort()
+
+    def pauseProducing(self):
+        self._transport.pause_reading()
+
+    def resumeProducing(self):
+        self._transport.resume_reading()
+
+
+class _DatagramTransport:
+    """Exposes an asyncio datagram transport with the twisted IUDPTransport calls"""
+
+    __slots__ = ("_transport",)
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data, addr=None):
+        self._transport.sendto(data, addr)
+
+    def setBroadcastAllowed(self, enabled):
+        self._transport.get_extra_info("socket").setsockopt(
+            socket.SOL_SOCKET, socket.SO_BROADCAST, int(enabled)
+        )
+
+    def getHost(self):
+        return _peer_address(self._transport.get_extra_info("sockname"))
+
+    def loseConnection(self):
+        self._transport.close()
+
+
+class BatchedDatagramPort:
+    """Serves a twisted style datagram protocol from a bound UDP socket, reading every
+    datagram queued on it when it becomes readable, `count` at a time with recvmmsg().
+
+    Datagram endpoints of both engines read one datagram per wakeup and per system call, so
+    a flood of discovery requests overflows the socket's receive queue. Runs on either
+    engine: it is an IReadDescriptor for twisted's reactor.addReader() (see
+    start_reactor()) and registers its own reader with asyncio (see start_loop()). It is
+    also the protocol's transport.
+
+    :param sock: Bound IPv4 datagram socket, the port owns it from now on
+    :type sock: socket.socket
+    :param protocol: Datagram protocol instance (startProtocol/datagramReceived/stopProtocol)
+    :param count: Datagrams per recvmmsg() call
+    :type count: int, optional
+    """
+
+    # Batches read per wakeup, before the other connections get their turn
+    MAX_BATCHES = 16
+
+    # Socket receive buffer asked for, the kernel caps it at net.core.rmem_max
+    RECEIVE_BUFFER = 4 * 1024 * 1024
+
+    def __init__(self, sock, protocol, count=64):
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+        except OSError as e:
+            logger.warning(f"Can't raise the UDP receive buffer: {e}")
+        self.socket = sock
+        self.protocol = protocol
+        self._reader = DatagramReader(sock, count)
+        self._remove_reader = None
+
+    def start_reactor(self, reactor):
+        """Start reading on a twisted reactor"""
+        reactor.addReader(self)
+        self._remove_reader = lambda: reactor.removeReader(self)
+        self.protocol.makeConnection(self)
+
+    def start_loop(self, loop):
+        """Start reading on an asyncio event loop"""
+        loop.add_reader(self.socket.fileno(), self.doRead)
+        self._remove_reader = lambda: loop.remove_reader(self.socket.fileno())
+        self.protocol.makeConnection(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def logPrefix(self):
+        return self.protocol.__class__.__name__
+
+    def doRead(self):
+        protocol = self.protocol
+        count = self._reader.count
+        for _ in range(self.MAX_BATCHES):
+            try:
+                datagrams = self._reader.read()
+            except OSError as e:
+                logger.warning(f"UDP error: {e}")
+                return
+            for data, addr in datagrams:
+                try:
+                    protocol.datagramReceived(data, addr)
+                except Exception:
+                    logger.exception(f"Error handling a datagram from {addr}")
+            if len(datagrams) < count:
+                return
+
+    def connectionLost(self, reason=None):
+        """Called by the reactor on shutdown, or by loseConnection()"""
+        if self._remove_reader is None:
+            return
+        self._remove_reader()
+        self._remove_reader = None
+        self.protocol.doStop()
+        self.socket.close()
+
+    # The protocol's transport (IUDPTransport)
+
+    def write(self, data, addr):
+        try:
+            self.socket.sendto(data, addr)
+        except BlockingIOError:
+            # Like any lost datagram, the other side asks again
+            pass
+
+    def setBroadcastAllowed(self, enabled):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, int(enabled))
+
+    def getHost(self):
+        host, port = self.socket.getsockname()
+        return PeerAddress("UDP", host, port)
+
+    def loseConnection(self):
+        self.connectionLost()
+
+
+class StreamProtocolAdapter(asyncio.Protocol):
+    """Runs a twisted style stream protocol (connectionMade/dataReceived/connectionLost)
+    on an asyncio transport. The protocol's `clock` is set to the event loop, for protocols
+    that schedule calls with self.clock.callLater()
+
+    :param protocol: Protocol instance, typically built by a twisted Factory. None refuses the
+        connection, like a twisted Factory returning None from buildProtocol()
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def connection_made(self, transport):
+        if self.protocol is None:
+            transport.abort()
+            return
+        self.protocol.clock = loop_clock(asyncio.get_running_loop())
+        self.protocol.makeConnection(_StreamTransport(transport))
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if self.protocol is not None:
+            self.protocol.connectionLost(exc)
+
+
+class DatagramProtocolAdapter(asyncio.DatagramProtocol):
+    """Runs a twisted style datagram protocol (startProtocol/datagramReceived/stopProtocol)
+    on an asyncio datagram transport
+
+    :param protocol: Datagram protocol instance
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def connection_made(self, transport):
+        self.protocol.makeConnection(_DatagramTransport(transport))
+
+    def datagram_received(self, data, addr):
+        self.protocol.datagramReceived(data, addr)
+
+    def error_received(self, exc):
+        logger.warning(f"UDP error: {exc}")
+
+    def connection_lost(self, exc):
+        self.protocol.doStop()
+
+
+def new_event_loop(use_uvloop=False):
+    """Create an event loop for the asyncio engine
+
+    :param use_uvloop: Use uvloop's event loop if the package is installed. Falls back to the
+        default asyncio loop with a warning otherwise
+    :type use_uvloop: bool, optional
+    :return: A new event loop, not yet set as the current one
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+
+            return uvloop.new_event_loop()
+        except ImportError:
+            logger.warning("uvloop is not installed, using the default asyncio event loop")
+    return asyncio.new_event_loop()
@@ -0,0 +1,150 @@
+import csv
+import ipaddress
+from array import array
+
+VIN_LENGTH = 17
+EID_LENGTH = 6
+GID_LENGTH = 6
+
+
+class Fleet:
+    """Identities and bind addresses of many simulated vehicles.
+
+    Vehicles are rows of a few flat tables (one bytearray per identity field, arrays for the
+    numbers) rather than an object per vehicle, so thousands of them take a few hundred KB.
+    Per-connection objects are only created once a tester actually connects to a vehicle.
+
+    Every vehicle gets its own TCP/UDP endpoint, either on consecutive loopback addresses
+    with the same port (Linux routes all of 127.0.0.0/8 to lo, no aliases need configuring)
+    or on consecutive ports of a single address.
+    """
+
+    __slots__ = (
+        "count",
+        "_vins",
+        "_eids",
+        "_gids",
+        "logical_addresses",
+        "hosts",
+        "ports",
+        "_by_vin",
+        "_by_eid",
+    )
+
+    def __init__(self, count):
+        self.count = count
+        self._vins = bytearray(VIN_LENGTH * count)
+        self._eids = bytearray(EID_LENGTH * count)
+        self._gids = bytearray(GID_LENGTH * count)
+        self.logical_addresses = array("H", bytes(2 * count))
+        self.hosts = array("L", bytes(array("L").itemsize * count))
+        self.ports = array("H", bytes(2 * count))
+        # Vehicle indices by VIN and by EID, built on first use
+        self._by_vin = None
+        self._by_eid = None
+
+    def __len__(self):
+        return self.count
+
+    def vin(self, index):
+        start = index * VIN_LENGTH
+        return self._vins[start : start + VIN_LENGTH].decode("ascii")
+
+    def eid(self, index):
+        start = index * EID_LENGTH
+        return bytes(self._eids[start : start + EID_LENGTH])
+
+    def gid(self, index):
+        start = index * GID_LENGTH
+        return bytes(self._gids[start : start + GID_LENGTH])
+
+    def with_vin(self, vin):
+        """Indices of the vehicles with a VIN, usually one or none"""
+        if self._by_vin is None:
+            self._build_index()
+        return self._by_vin.get(vin, ())
+
+    def with_eid(self, eid):
+        """Indices of the vehicles with an EID"""
+        if self._by_eid is None:
+            self._build_index()
+        return self._by_eid.get(bytes(eid), ())
+
+    def _build_index(self):
+        by_vin = {}
+        by_eid = {}
+        for index in range(self.count):
+            by_vin.setdefault(self.vin(index), []).append(index)
+            by_eid.setdefault(self.eid(index), []).append(index)
+        self._by_vin = by_vin
+        self._by_eid = by_eid
+
+    def bind_address(self, index):
+        """(host, port) the vehicle's TCP and UDP endpoints listen on"""
+        return str(ipaddress.IPv4Address(self.hosts[index])), self.ports[index]
+
+    def set_vehicle(self, index, vin, logical_address, eid, gid):
+        if len(vin) != VIN_LENGTH or len(eid) != EID_LENGTH or len(gid) != GID_LENGTH:
+            raise ValueError(f"Vehicle {index}: invalid VIN, EID or GID length")
+        self._vins[index * VIN_LENGTH : (index + 1) * VIN_LENGTH] = vin.encode("ascii")
+        self._eids[index * EID_LENGTH : (index + 1) * EID_LENGTH] = eid
+        self._gids[index * GID_LENGTH : (index + 1) * GID_LENGTH] = gid
+        self.logical_addresses[index] = logical_address
+        self._by_vin = None
+        self._by_eid = None
+
+    def assign_addresses(self, host="127.0.1.1", port=13400, bind="aliases"):
+        """Give every vehicle its endpoint
+
+        :param host: Address of the first vehicle
+        :param port: Port of the first vehicle
+        :param bind: "aliases" for one address per vehicle on the same port, "ports" for
+            one port per vehicle on the same address
+        """
+        first_host = int(ipaddress.IPv4Address(host))
+        for index in range(self.count):
+            if bind == "aliases":
+                self.hosts[index] = first_host + index
+                self.ports[index] = port
+            elif bind == "ports":
+                self.hosts[index] = first_host
+                self.ports[index] = port + index
+            else:
+                raise ValueError(f"Unknown bind mode: {bind}")
+
+    @classmethod
+    def generate(cls, count, vin, logical_address, eid, gid):
+        """Generate `count` vehicles from a template identity. The last 6 characters of the
+        VIN are replaced by a serial number and the EID is incremented per vehicle, so every
+        vehicle can be told apart in vehicle identification. All vehicles share the GID and
+        the logical address.
+        """
+        fleet = cls(count)
+        first_eid = int.from_bytes(eid, byteorder="big")
+        for index in range(count):
+            fleet.set_vehicle(
+                index,
+                f"{vin[:VIN_LENGTH - 6]}{index:06d}",
+                logical_address,
+                ((first_eid + index) % (1 << 48)).to_bytes(EID_LENGTH, byteorder="big"),
+                gid,
+            )
+        return fleet
+
+    @classmethod
+    def load(cls, path, logical_address, gid):
+        """Load vehicles from a CSV file with a `vin` and an `eid` (hex) column, and optionally
+        `logicalAddress` and `gid` (hex) columns overriding the defaults"""
+        with open(path, newline="") as file:
+            rows = list(csv.DictReader(file))
+        fleet = cls(len(rows))
+        for index, row in enumerate(rows):
+            address = row.get("logicalAddress")
+            fleet.set_vehicle(
+                index,
+                row["vin"],
+                int(address, 0) if address else logical_address,
+                bytes.fromhex(row["eid"]),
+                bytes.fromhex(row["gid"]) if row.get("gid") else gid,
+            )
+        return fleet
@@ -0,0 +1,147 @@
+import logging
+from collections import namedtuple
+
+from lib.messages import DOIP_HEADER, decode_all, decode_message
+
+logger = logging.getLogger("doipserver.framer")
+
+# Stands in for a message whose payload is longer than the framer's max_payload_length. The
+# payload is skipped without being buffered
+OversizedMessage = namedtuple("OversizedMessage", ["payload_type", "payload_length"])
+
+
+class DoIPFramer:
+    """Incremental framer for a DoIP TCP stream.
+
+    One framer lives for the whole lifetime of a TCP connection. Every call to feed() returns
+    all of the messages completed by that read, and any trailing partial message is kept for
+    the next read. Complete messages are decoded with decode_all() straight from a memoryview
+    over the received data, so nothing is copied or shifted for the common case of whole
+    messages per read. A message that straddles reads is copied exactly once into a buffer
+    preallocated from its header, which keeps large TransferData blocks (16K/64K and up)
+    linear in their size.
+
+    :param zero_copy: Decode DiagnosticMessage user data as memoryviews over the received
+        data instead of copies. The framer never modifies what it was fed, so the views stay
+        valid as long as the caller doesn't reuse the buffers passed to feed()
+    :type zero_copy: bool, optional
+    :param max_payload_length: Longest payload to buffer. Longer messages are discarded and
+        reported as an OversizedMessage in their place
+    :type max_payload_length: int, optional
+    """
+
+    def __init__(self, zero_copy=False, max_payload_length=None):
+        self._zero_copy = zero_copy
+        self._max_payload_length = max_payload_length
+        self.reset()
+
+    def reset(self):
+        self._header = bytearray()
+        self._frame = None
+        self._frame_filled = 0
+        self._payload_type = None
+        self._skip = 0
+
+    @property
+    def pending(self):
+        """Number of buffered bytes belonging to a message that isn't complete yet"""
+        if self._frame is not None:
+            return DOIP_HEADER.size + self._frame_filled
+        return len(self._header)
+
+    def feed(self, data_bytes):
+        """Consume a chunk of the TCP stream.
+
+        :param data_bytes: Bytes received from the socket
+        :type data_bytes: bytes-like
+        :return: Every DoIP message completed by this chunk, in stream order
+        :rtype: list
+        """
+        messages = []
+        self._feed(memoryview(data_bytes), messages)
+        return messages
+
+    def _feed(self, view, messages):
+        offset = 0
+        end = len(view)
+
+        if self._skip:
+            offset = self._skip_payload(view, offset)
+        elif self._frame is not None:
+            offset = self._fill_frame(view, offset, messages)
+        elif self._header:
+            needed = DOIP_HEADER.size - len(self._header)
+            self._header += view[:needed]
+            offset = min(needed, end)
+            if len(self._header) < DOIP_HEADER.size:
+                return
+            header = self._header
+            self._header = bytearray()
+            protocol_version, inverse_protocol_version, payload_type, payload_size = (
+                DOIP_HEADER.unpack(header)
+            )
+            if inverse_protocol_version != (0xFF ^ protocol_version):
+                logger.warning(
+                    "Bad DoIP Header - Inverse protocol version does not match. Ignoring."
+                )
+                # Shift forward by a single byte and rescan. Only happens on a corrupted
+                # stream, so the copy of the remainder doesn't matter
+                self._feed(memoryview(bytes(header[1:]) + view[offset:]), messages)
+                return
+            offset = self._start_payload(payload_type, payload_size, view, offset, messages)
+
+        if offset == end:
+            return
+
+        decoded, consumed = decode_all(view[offset:], self._zero_copy, self._max_payload_length)
+        messages.extend(message for _, message in decoded)
+        offset += consumed
+
+        # decode_all() stops either short of a full header or at a valid header whose
+        # payload hasn't fully arrived yet or is too long
+        if end - offset < DOIP_HEADER.size:
+            if offset < end:
+                self._header = bytearray(view[offset:])
+            return
+        _, _, payload_type, payload_size = DOIP_HEADER.unpack_from(view, offset)
+        offset = self._start_payload(
+            payload_type, payload_size, view, offset + DOIP_HEADER.size, messages
+        )
+        if offset < end:
+            # Only after skipping an oversized payload, whatever follows is framed as usual
+            self._feed(view[offset:], messages)
+
+    def _start_payload(self, payload_type, payload_size, view, offset, messages):
+        if self._max_payload_length is not None and payload_size > self._max_payload_length:
+            messages.append(OversizedMessage(payload_type, payload_size))
+            self._skip = payload_size
+            return self._skip_payload(view, offset)
+        self._begin_frame(payload_type, payload_size)
+        return self._fill_frame(view, offset, messages)
+
+    def _skip_payload(self, view, offset):
+        count = min(self._skip, len(view) - offset)
+        self._skip -= count
+        return offset + count
+
+    def _begin_frame(self, payload_type, payload_size):
+        self._payload_type = payload_type
+        self._frame = bytearray(payload_size)
+        self._frame_filled = 0
+
+    def _fill_frame(self, view, offset, messages):
+        frame = self._frame
+        count = min(len(frame) - self._frame_filled, len(view) - offset)
+        frame[self._frame_filled : self._frame_filled + count] = view[
+            offset : offset + count
+        ]
+        self._frame_filled += count
+        if self._frame_filled == len(frame):
+            # Hand the buffer over to the message and start afresh, so views into it stay valid
+            self._frame = None
+            messages.append(
+                decode_message(
+                    self._payload_type, memoryview(frame), len(frame), self._zero_copy
+                )
+            )
+        return offset + count
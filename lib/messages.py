@@ -1,17 +1,94 @@
+import operator
 import struct
 from enum import IntEnum
 
 # Quoted descriptions were copied or paraphrased from ISO-13400-2-2019 (E).
 
+# Table 16 "Generic DoIP header structure": protocol version, inverse protocol version,
+# payload type, payload length
+DOIP_HEADER = struct.Struct("!BBHL")
+
+
+_HEADER_PREFIX = struct.Struct("!BBH")
+_PAYLOAD_LENGTH = struct.Struct("!L")
+
+# (protocol version, payload type) -> first four header bytes, filled in below for the known
+# payload types and on demand for anything else
+_header_prefixes = {}
+
+
+def pack_doip_header(protocol_version, payload_type, payload_length):
+    """Packs a generic DoIP header (Table 16) from a prefix cached per protocol version and
+    payload type, so only the payload length is packed per message.
+
+    :return: The 8 byte header
+    :rtype: bytes
+    """
+    prefix = _header_prefixes.get((protocol_version, payload_type))
+    if prefix is None:
+        prefix = _HEADER_PREFIX.pack(
+            protocol_version, 0xFF ^ protocol_version, payload_type
+        )
+        _header_prefixes[protocol_version, payload_type] = prefix
+    return prefix + _PAYLOAD_LENGTH.pack(payload_length)
+
+
+def _frame_struct(body):
+    """Generic header followed by a fixed layout body, so a whole frame packs in one call"""
+    return struct.Struct(DOIP_HEADER.format + body.format[1:])
+
+
+def _ascii(value):
+    """Encodes a VIN for packing. Unpacked messages already hold it as bytes"""
+    if type(value) is str:
+        return value.encode("ascii")
+    return value
+
+
+_NACK_CODE = struct.Struct("!B")
+_NACK_CODE_FRAME = _frame_struct(_NACK_CODE)
+_SOURCE_ADDRESS = struct.Struct("!H")
+_SOURCE_ADDRESS_FRAME = _frame_struct(_SOURCE_ADDRESS)
+_POWER_MODE = struct.Struct("!B")
+_POWER_MODE_FRAME = _frame_struct(_POWER_MODE)
+_ACTIVATION_REQUEST = struct.Struct("!HBL")
+_ACTIVATION_REQUEST_FRAME = _frame_struct(_ACTIVATION_REQUEST)
+_ACTIVATION_REQUEST_VM = struct.Struct("!HBLL")
+_ACTIVATION_REQUEST_VM_FRAME = _frame_struct(_ACTIVATION_REQUEST_VM)
+_EID = struct.Struct("!6s")
+_EID_FRAME = _frame_struct(_EID)
+_VIN = struct.Struct("!17s")
+_VIN_FRAME = _frame_struct(_VIN)
+_ACTIVATION_RESPONSE = struct.Struct("!HHBL")
+_ACTIVATION_RESPONSE_FRAME = _frame_struct(_ACTIVATION_RESPONSE)
+_ACTIVATION_RESPONSE_VM = struct.Struct("!HHBLL")
+_ACTIVATION_RESPONSE_VM_FRAME = _frame_struct(_ACTIVATION_RESPONSE_VM)
+_ADDRESSES = struct.Struct("!HH")
+_ADDRESSES_FRAME = _frame_struct(_ADDRESSES)
+_ACKNOWLEDGEMENT = struct.Struct("!HHB")
+_ACKNOWLEDGEMENT_FRAME = _frame_struct(_ACKNOWLEDGEMENT)
+_ENTITY_STATUS = struct.Struct("!BBB")
+_ENTITY_STATUS_FRAME = _frame_struct(_ENTITY_STATUS)
+_ENTITY_STATUS_MDS = struct.Struct("!BBBL")
+_ENTITY_STATUS_MDS_FRAME = _frame_struct(_ENTITY_STATUS_MDS)
+_VEHICLE_IDENTIFICATION = struct.Struct("!17sH6s6sB")
+_VEHICLE_IDENTIFICATION_FRAME = _frame_struct(_VEHICLE_IDENTIFICATION)
+_VEHICLE_IDENTIFICATION_SYNC = struct.Struct("!17sH6s6sBB")
+_VEHICLE_IDENTIFICATION_SYNC_FRAME = _frame_struct(_VEHICLE_IDENTIFICATION_SYNC)
+
 
 class DoIPMessage:
     """Base class for DoIP messages implementing common features like comparison,
     and representation"""
 
+    __slots__ = ()
+
     def __repr__(self):
         formatted_field_values = []
         for field in self._fields:
             value = getattr(self, "_" + field)
+            if type(value) == memoryview:
+                value = bytes(value)
             if type(value) == str:
                 formatted_field_values.append(f'"{value}"')
             else:
@@ -24,6 +101,8 @@ class DoIPMessage:
         formatted_field_values = []
         for field in self._fields:
             value = getattr(self, field)
+            if type(value) == memoryview:
+                value = bytes(value)
             if type(value) == str:
                 formatted_field_values.append(f'{field}: "{value}"')
             else:
@@ -35,8 +114,57 @@ class DoIPMessage:
         else:
             return f"{classname} (0x{self.payload_type:X})"
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Comparison reads the stored fields directly instead of re-packing both sides
+        cls._values = staticmethod(
+            operator.attrgetter(*["_" + field for field in cls._fields])
+            if cls._fields
+            else lambda message: ()
+        )
+
     def __eq__(self, other):
-        return (type(self) == type(other)) and (self.pack() == other.pack())
+        return (type(self) == type(other)) and (
+            self._values(self) == other._values(other)
+        )
+
+    @classmethod
+    def unpack_view(cls, payload_bytes, payload_length):
+        """Unpacks without copying variable length data out of the receive buffer.
+
+        Only messages carrying bulk data override this; everything else unpacks as usual.
+        """
+        return cls.unpack(payload_bytes, payload_length)
+
+    def pack_frame(self, protocol_version=0x02):
+        """Packs the message including its generic DoIP header
+
+        Messages with a fixed layout override this to pack header and body in one call.
+
+        :param protocol_version: DoIP protocol version for the header
+        :type protocol_version: int
+        :return: The complete DoIP frame
+        :rtype: bytes
+        """
+        payload_data = self.pack()
+        return (
+            pack_doip_header(protocol_version, self.payload_type, len(payload_data))
+            + payload_data
+        )
+
+    def pack_buffers(self, protocol_version=0x02):
+        """Packs the message including its generic DoIP header as a list of buffers, for
+        scatter-gather writes (socket.sendmsg, transport.writeSequence)
+
+        Messages carrying bulk data override this to return the data as its own buffer
+        instead of concatenating it onto the header.
+
+        :param protocol_version: DoIP protocol version for the header
+        :type protocol_version: int
+        :return: Buffers which together make up the complete DoIP frame
+        :rtype: list
+        """
+        return [self.pack_frame(protocol_version)]
 
 
 class ReservedMessage(DoIPMessage):
@@ -45,13 +173,21 @@ class ReservedMessage(DoIPMessage):
 
     @classmethod
     def unpack(cls, payload_type, payload_bytes, payload_length):
-        return ReservedMessage(payload_type, payload_bytes)
+        return ReservedMessage(payload_type, bytes(payload_bytes[:payload_length]))
 
     def pack(self):
-        self._payload
+        return self._payload
+
+    def pack_buffers(self, protocol_version=0x02):
+        return [
+            pack_doip_header(protocol_version, self._payload_type, len(self._payload)),
+            self._payload,
+        ]
 
     _fields = ["payload_type", "payload"]
 
+    __slots__ = ("_payload_type", "_payload")
+
     def __init__(self, payload_type, payload):
         self._payload_type = payload_type
         self._payload = payload
@@ -83,13 +219,24 @@ class GenericDoIPNegativeAcknowledge(DoIPMessage):
 
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
-        return GenericDoIPNegativeAcknowledge(*struct.unpack_from("!B", payload_bytes))
+        return GenericDoIPNegativeAcknowledge(*_NACK_CODE.unpack_from(payload_bytes))
 
     def pack(self):
-        return struct.pack("!B", self._nack_code)
+        return _NACK_CODE.pack(self._nack_code)
+
+    def pack_frame(self, protocol_version=0x02):
+        return _NACK_CODE_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _NACK_CODE.size,
+            self._nack_code,
+        )
 
     _fields = ["nack_code"]
 
+    __slots__ = ("_nack_code",)
+
     def __init__(self, nack_code):
         self._nack_code = nack_code
 
@@ -111,12 +258,19 @@ class AliveCheckRequest(DoIPMessage):
 
     _fields = []
 
+    __slots__ = ()
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return AliveCheckRequest()
 
     def pack(self):
-        return bytearray()
+        return b""
+
+    def pack_frame(self, protocol_version=0x02):
+        return DOIP_HEADER.pack(
+            protocol_version, 0xFF ^ protocol_version, self.payload_type, 0
+        )
 
 
 class AliveCheckResponse(DoIPMessage):
@@ -126,13 +280,24 @@ class AliveCheckResponse(DoIPMessage):
 
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
-        return AliveCheckResponse(*struct.unpack_from("!H", payload_bytes))
+        return AliveCheckResponse(*_SOURCE_ADDRESS.unpack_from(payload_bytes))
 
     def pack(self):
-        return struct.pack("!H", self._source_address)
+        return _SOURCE_ADDRESS.pack(self._source_address)
+
+    def pack_frame(self, protocol_version=0x02):
+        return _SOURCE_ADDRESS_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _SOURCE_ADDRESS.size,
+            self._source_address,
+        )
 
     _fields = ["source_address"]
 
+    __slots__ = ("_source_address",)
+
     def __init__(self, source_address):
         self._source_address = source_address
 
@@ -163,12 +328,19 @@ class DoipEntityStatusRequest(DoIPMessage):
 
     _fields = []
 
+    __slots__ = ()
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return DoipEntityStatusRequest()
 
     def pack(self):
-        return bytearray()
+        return b""
+
+    def pack_frame(self, protocol_version=0x02):
+        return DOIP_HEADER.pack(
+            protocol_version, 0xFF ^ protocol_version, self.payload_type, 0
+        )
 
 
 class DiagnosticPowerModeRequest(DoIPMessage):
@@ -178,12 +350,19 @@ class DiagnosticPowerModeRequest(DoIPMessage):
 
     _fields = []
 
+    __slots__ = ()
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return DiagnosticPowerModeRequest()
 
     def pack(self):
-        return bytearray()
+        return b""
+
+    def pack_frame(self, protocol_version=0x02):
+        return DOIP_HEADER.pack(
+            protocol_version, 0xFF ^ protocol_version, self.payload_type, 0
+        )
 
 
 class DiagnosticPowerModeResponse(DoIPMessage):
@@ -193,6 +372,8 @@ class DiagnosticPowerModeResponse(DoIPMessage):
 
     _fields = ["diagnostic_power_mode"]
 
+    __slots__ = ("_diagnostic_power_mode",)
+
     class DiagnosticPowerMode(IntEnum):
         """Diagnostic power mode - See Table 9"""
 
@@ -202,10 +383,19 @@ class DiagnosticPowerModeResponse(DoIPMessage):
 
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
-        return DiagnosticPowerModeResponse(*struct.unpack_from("!B", payload_bytes))
+        return DiagnosticPowerModeResponse(*_POWER_MODE.unpack_from(payload_bytes))
 
     def pack(self):
-        return struct.pack("!B", self._diagnostic_power_mode)
+        return _POWER_MODE.pack(self._diagnostic_power_mode)
+
+    def pack_frame(self, protocol_version=0x02):
+        return _POWER_MODE_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _POWER_MODE.size,
+            self._diagnostic_power_mode,
+        )
 
     def __init__(self, diagnostic_power_mode):
         self._diagnostic_power_mode = diagnostic_power_mode
@@ -230,6 +420,8 @@ class RoutingActivationRequest(DoIPMessage):
 
     _fields = ["source_address", "activation_type", "reserved", "vm_specific"]
 
+    __slots__ = ("_source_address", "_activation_type", "_reserved", "_vm_specific")
+
     class ActivationType(IntEnum):
         """See Table 47 - Routing activation request activation types"""
 
@@ -240,22 +432,48 @@ class RoutingActivationRequest(DoIPMessage):
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         if payload_length == 7:
-            return RoutingActivationRequest(*struct.unpack_from("!HBL", payload_bytes))
+            return RoutingActivationRequest(
+                *_ACTIVATION_REQUEST.unpack_from(payload_bytes)
+            )
         else:
-            return RoutingActivationRequest(*struct.unpack_from("!HBLL", payload_bytes))
+            return RoutingActivationRequest(
+                *_ACTIVATION_REQUEST_VM.unpack_from(payload_bytes)
+            )
 
     def pack(self):
         if self._vm_specific is not None:
-            return struct.pack(
-                "!HBLL",
+            return _ACTIVATION_REQUEST_VM.pack(
+                self._source_address,
+                self._activation_type,
+                self._reserved,
+                self._vm_specific,
+            )
+        else:
+            return _ACTIVATION_REQUEST.pack(
+                self._source_address, self._activation_type, self._reserved
+            )
+
+    def pack_frame(self, protocol_version=0x02):
+        if self._vm_specific is not None:
+            return _ACTIVATION_REQUEST_VM_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACTIVATION_REQUEST_VM.size,
                 self._source_address,
                 self._activation_type,
                 self._reserved,
                 self._vm_specific,
             )
         else:
-            return struct.pack(
-                "!HBL", self._source_address, self._activation_type, self._reserved
+            return _ACTIVATION_REQUEST_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACTIVATION_REQUEST.size,
+                self._source_address,
+                self._activation_type,
+                self._reserved,
             )
 
     def __init__(self, source_address, activation_type, reserved=0, vm_specific=None):
@@ -311,12 +529,19 @@ class VehicleIdentificationRequest(DoIPMessage):
 
     _fields = []
 
+    __slots__ = ()
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return VehicleIdentificationRequest()
 
     def pack(self):
-        return bytearray()
+        return b""
+
+    def pack_frame(self, protocol_version=0x02):
+        return DOIP_HEADER.pack(
+            protocol_version, 0xFF ^ protocol_version, self.payload_type, 0
+        )
 
 
 class VehicleIdentificationRequestWithEID(DoIPMessage):
@@ -326,14 +551,23 @@ class VehicleIdentificationRequestWithEID(DoIPMessage):
 
     _fields = ["eid"]
 
+    __slots__ = ("_eid",)
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
-        return VehicleIdentificationRequestWithEID(
-            *struct.unpack_from("!6s", payload_bytes)
-        )
+        return VehicleIdentificationRequestWithEID(*_EID.unpack_from(payload_bytes))
 
     def pack(self):
-        return struct.pack("!6s", self._eid)
+        return _EID.pack(self._eid)
+
+    def pack_frame(self, protocol_version=0x02):
+        return _EID_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _EID.size,
+            self._eid,
+        )
 
     def __init__(self, eid):
         self._eid = eid
@@ -356,14 +590,23 @@ class VehicleIdentificationRequestWithVIN(DoIPMessage):
 
     _fields = ["vin"]
 
+    __slots__ = ("_vin",)
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
-        return VehicleIdentificationRequestWithVIN(
-            *struct.unpack_from("!17s", payload_bytes)
-        )
+        return VehicleIdentificationRequestWithVIN(*_VIN.unpack_from(payload_bytes))
 
     def pack(self):
-        return struct.pack("!17s", self._vin.encode("ascii"))
+        return _VIN.pack(_ascii(self._vin))
+
+    def pack_frame(self, protocol_version=0x02):
+        return _VIN_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _VIN.size,
+            _ascii(self._vin),
+        )
 
     def __init__(self, vin):
         self._vin = vin
@@ -398,6 +641,14 @@ class RoutingActivationResponse(DoIPMessage):
         "vm_specific",
     ]
 
+    __slots__ = (
+        "_client_logical_address",
+        "_logical_address",
+        "_response_code",
+        "_reserved",
+        "_vm_specific",
+    )
+
     class ResponseCode(IntEnum):
         """See Table 48"""
 
@@ -415,17 +666,37 @@ class RoutingActivationResponse(DoIPMessage):
     def unpack(cls, payload_bytes, payload_length):
         if payload_length == 9:
             return RoutingActivationResponse(
-                *struct.unpack_from("!HHBL", payload_bytes)
+                *_ACTIVATION_RESPONSE.unpack_from(payload_bytes)
             )
         else:
             return RoutingActivationResponse(
-                *struct.unpack_from("!HHBLL", payload_bytes)
+                *_ACTIVATION_RESPONSE_VM.unpack_from(payload_bytes)
             )
 
     def pack(self):
         if self._vm_specific is not None:
-            return struct.pack(
-                "!HHBLL",
+            return _ACTIVATION_RESPONSE_VM.pack(
+                self._client_logical_address,
+                self._logical_address,
+                self._response_code,
+                self._reserved,
+                self._vm_specific,
+            )
+        else:
+            return _ACTIVATION_RESPONSE.pack(
+                self._client_logical_address,
+                self._logical_address,
+                self._response_code,
+                self._reserved,
+            )
+
+    def pack_frame(self, protocol_version=0x02):
+        if self._vm_specific is not None:
+            return _ACTIVATION_RESPONSE_VM_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACTIVATION_RESPONSE_VM.size,
                 self._client_logical_address,
                 self._logical_address,
                 self._response_code,
@@ -433,8 +704,11 @@ class RoutingActivationResponse(DoIPMessage):
                 self._vm_specific,
             )
         else:
-            return struct.pack(
-                "!HHBL",
+            return _ACTIVATION_RESPONSE_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACTIVATION_RESPONSE.size,
                 self._client_logical_address,
                 self._logical_address,
                 self._response_code,
@@ -520,18 +794,76 @@ class DiagnosticMessage(DoIPMessage):
 
     _fields = ["source_address", "target_address", "user_data"]
 
+    __slots__ = ("_source_address", "_target_address", "_user_data")
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return DiagnosticMessage(
-            *struct.unpack_from("!HH", payload_bytes), payload_bytes[4:payload_length]
+            *_ADDRESSES.unpack_from(payload_bytes),
+            bytes(payload_bytes[4:payload_length]),
+        )
+
+    @classmethod
+    def unpack_view(cls, payload_bytes, payload_length):
+        # user_data stays a memoryview over the receive buffer, which the framers never
+        # modify once a message has been handed out
+        return DiagnosticMessage(
+            *_ADDRESSES.unpack_from(payload_bytes),
+            memoryview(payload_bytes)[4:payload_length],
         )
 
     def pack(self):
         return (
-            struct.pack("!HH", self._source_address, self._target_address)
+            _ADDRESSES.pack(self._source_address, self._target_address)
             + self._user_data
         )
 
+    def pack_frame(self, protocol_version=0x02):
+        # Header and addresses are fixed, so only the user data needs appending
+        return (
+            _ADDRESSES_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ADDRESSES.size + len(self._user_data),
+                self._source_address,
+                self._target_address,
+            )
+            + self._user_data
+        )
+
+    def pack_buffers(self, protocol_version=0x02):
+        # The user data goes out as its own buffer, so large blocks are never copied
+        header = _ADDRESSES_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _ADDRESSES.size + len(self._user_data),
+            self._source_address,
+            self._target_address,
+        )
+        if self._user_data:
+            return [header, self._user_data]
+        return [header]
+
+    @staticmethod
+    def pack_parts(source_address, target_address, parts, protocol_version=0x02):
+        """Packs a diagnostic message whose user data is made up of several buffers, such as
+        a response header and a data block, without joining them
+
+        :return: Buffers which together make up the complete DoIP frame
+        :rtype: list
+        """
+        header = _ADDRESSES_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            DiagnosticMessage.payload_type,
+            _ADDRESSES.size + sum(len(part) for part in parts),
+            source_address,
+            target_address,
+        )
+        return [header, *parts]
+
     def __init__(self, source_address, target_address, user_data):
         self._source_address = source_address
         self._target_address = target_address
@@ -582,10 +914,16 @@ class DiagnosticMessage(DoIPMessage):
         Description: Contains the actual diagnostic data (e.g. ISO 14229-1 diagnostic
         request), which shall be routed to the destination (e.g. the ECM).
 
-        Values: Bytes/Bytearray
+        Values: Bytes/Bytearray, or a memoryview over the receive buffer when the message
+        was decoded in zero-copy mode
         """
         return self._user_data
 
+    @property
+    def user_data_bytes(self):
+        """User data as bytes. Only copies when the message was decoded in zero-copy mode"""
+        return bytes(self._user_data)
+
 
 class DiagnosticMessageNegativeAcknowledgement(DoIPMessage):
     """A negative acknowledgement of the previously received diagnostic (UDS) message.
@@ -600,6 +938,13 @@ class DiagnosticMessageNegativeAcknowledgement(DoIPMessage):
 
     _fields = ["source_address", "target_address", "nack_code", "previous_message_data"]
 
+    __slots__ = (
+        "_source_address",
+        "_target_address",
+        "_nack_code",
+        "_previous_message_data",
+    )
+
     class NackCodes(IntEnum):
         """Diagnostic message negative acknowledge codes (See Table 26)"""
 
@@ -614,17 +959,47 @@ class DiagnosticMessageNegativeAcknowledgement(DoIPMessage):
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return DiagnosticMessageNegativeAcknowledgement(
-            *struct.unpack_from("!HHB", payload_bytes), payload_bytes[5:payload_length]
+            *_ACKNOWLEDGEMENT.unpack_from(payload_bytes),
+            bytes(payload_bytes[5:payload_length]),
         )
 
     def pack(self):
         return (
-            struct.pack(
-                "!HHB", self._source_address, self._target_address, self._nack_code
+            _ACKNOWLEDGEMENT.pack(
+                self._source_address, self._target_address, self._nack_code
             )
             + self._previous_message_data
         )
 
+    def pack_frame(self, protocol_version=0x02):
+        if self._previous_message_data:
+            return super().pack_frame(protocol_version)
+        return _ACKNOWLEDGEMENT_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _ACKNOWLEDGEMENT.size,
+            self._source_address,
+            self._target_address,
+            self._nack_code,
+        )
+
+    def pack_buffers(self, protocol_version=0x02):
+        if not self._previous_message_data:
+            return [self.pack_frame(protocol_version)]
+        return [
+            _ACKNOWLEDGEMENT_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACKNOWLEDGEMENT.size + len(self._previous_message_data),
+                self._source_address,
+                self._target_address,
+                self._nack_code,
+            ),
+            self._previous_message_data,
+        ]
+
     def __init__(
         self,
         source_address,
@@ -700,20 +1075,57 @@ class DiagnosticMessagePositiveAcknowledgement(DoIPMessage):
 
     _fields = ["source_address", "target_address", "ack_code", "previous_message_data"]
 
+    __slots__ = (
+        "_source_address",
+        "_target_address",
+        "_ack_code",
+        "_previous_message_data",
+    )
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         return DiagnosticMessagePositiveAcknowledgement(
-            *struct.unpack_from("!HHB", payload_bytes), payload_bytes[5:payload_length]
+            *_ACKNOWLEDGEMENT.unpack_from(payload_bytes),
+            bytes(payload_bytes[5:payload_length]),
         )
 
     def pack(self):
         return (
-            struct.pack(
-                "!HHB", self._source_address, self._target_address, self._ack_code
+            _ACKNOWLEDGEMENT.pack(
+                self._source_address, self._target_address, self._ack_code
             )
             + self._previous_message_data
         )
 
+    def pack_frame(self, protocol_version=0x02):
+        if self._previous_message_data:
+            return super().pack_frame(protocol_version)
+        return _ACKNOWLEDGEMENT_FRAME.pack(
+            protocol_version,
+            0xFF ^ protocol_version,
+            self.payload_type,
+            _ACKNOWLEDGEMENT.size,
+            self._source_address,
+            self._target_address,
+            self._ack_code,
+        )
+
+    def pack_buffers(self, protocol_version=0x02):
+        if not self._previous_message_data:
+            return [self.pack_frame(protocol_version)]
+        return [
+            _ACKNOWLEDGEMENT_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ACKNOWLEDGEMENT.size + len(self._previous_message_data),
+                self._source_address,
+                self._target_address,
+                self._ack_code,
+            ),
+            self._previous_message_data,
+        ]
+
     def __init__(
         self,
         source_address,
@@ -788,24 +1200,52 @@ class EntityStatusResponse(DoIPMessage):
         "max_data_size",
     ]
 
+    __slots__ = (
+        "_node_type",
+        "_max_concurrent_sockets",
+        "_currently_open_sockets",
+        "_max_data_size",
+    )
+
     @classmethod
     def unpack(cls, payload_bytes, payload_length):
         if payload_length == 3:
-            return EntityStatusResponse(*struct.unpack_from("!BBB", payload_bytes))
+            return EntityStatusResponse(*_ENTITY_STATUS.unpack_from(payload_bytes))
         else:
-            return EntityStatusResponse(*struct.unpack_from("!BBBL", payload_bytes))
+            return EntityStatusResponse(*_ENTITY_STATUS_MDS.unpack_from(payload_bytes))
 
     def pack(self):
-        if self.max_data_size is None:
-            return struct.pack(
-                "!BBB",
+        if self._max_data_size is None:
+            return _ENTITY_STATUS.pack(
+                self._node_type,
+                self._max_concurrent_sockets,
+                self._currently_open_sockets,
+            )
+        else:
+            return _ENTITY_STATUS_MDS.pack(
+                self._node_type,
+                self._max_concurrent_sockets,
+                self._currently_open_sockets,
+                self._max_data_size,
+            )
+
+    def pack_frame(self, protocol_version=0x02):
+        if self._max_data_size is None:
+            return _ENTITY_STATUS_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ENTITY_STATUS.size,
                 self._node_type,
                 self._max_concurrent_sockets,
                 self._currently_open_sockets,
             )
         else:
-            return struct.pack(
-                "!BBBL",
+            return _ENTITY_STATUS_MDS_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _ENTITY_STATUS_MDS.size,
                 self._node_type,
                 self._max_concurrent_sockets,
                 self._currently_open_sockets,
@@ -889,6 +1329,15 @@ class VehicleIdentificationResponse(DoIPMessage):
         "vin_sync_status",
     ]
 
+    __slots__ = (
+        "_vin",
+        "_logical_address",
+        "_eid",
+        "_gid",
+        "_further_action_required",
+        "_vin_sync_status",
+    )
+
     class SynchronizationStatusCodes(IntEnum):
         """VIN/GID synchronization status code values (Table 7)
 
@@ -916,18 +1365,17 @@ class VehicleIdentificationResponse(DoIPMessage):
     def unpack(cls, payload_bytes, payload_length):
         if payload_length == 33:
             return VehicleIdentificationResponse(
-                *struct.unpack_from("!17sH6s6sBB", payload_bytes)
+                *_VEHICLE_IDENTIFICATION_SYNC.unpack_from(payload_bytes)
             )
         else:
             return VehicleIdentificationResponse(
-                *struct.unpack_from("!17sH6s6sB", payload_bytes)
+                *_VEHICLE_IDENTIFICATION.unpack_from(payload_bytes)
             )
 
     def pack(self):
         if self._vin_sync_status is not None:
-            return struct.pack(
-                "!17sH6s6sBB",
-                self._vin.encode("ascii"),
+            return _VEHICLE_IDENTIFICATION_SYNC.pack(
+                _ascii(self._vin),
                 self._logical_address,
                 self._eid,
                 self._gid,
@@ -935,9 +1383,35 @@ class VehicleIdentificationResponse(DoIPMessage):
                 self._vin_sync_status,
             )
         else:
-            return struct.pack(
-                "!17sH6s6sB",
-                self._vin.encode("ascii"),
+            return _VEHICLE_IDENTIFICATION.pack(
+                _ascii(self._vin),
+                self._logical_address,
+                self._eid,
+                self._gid,
+                self._further_action_required,
+            )
+
+    def pack_frame(self, protocol_version=0x02):
+        if self._vin_sync_status is not None:
+            return _VEHICLE_IDENTIFICATION_SYNC_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _VEHICLE_IDENTIFICATION_SYNC.size,
+                _ascii(self._vin),
+                self._logical_address,
+                self._eid,
+                self._gid,
+                self._further_action_required,
+                self._vin_sync_status,
+            )
+        else:
+            return _VEHICLE_IDENTIFICATION_FRAME.pack(
+                protocol_version,
+                0xFF ^ protocol_version,
+                self.payload_type,
+                _VEHICLE_IDENTIFICATION.size,
+                _ascii(self._vin),
                 self._logical_address,
                 self._eid,
                 self._gid,
@@ -1068,3 +1542,70 @@ payload_type_to_message = {
 payload_message_to_type = {
     message: payload_type for payload_type, message in payload_type_to_message.items()
 }
+
+# 0x01-0x03 are the ISO 13400 versions, 0xFF is the default for vehicle identification requests
+for _protocol_version in (0x01, 0x02, 0x03, 0xFF):
+    for _payload_type in payload_type_to_message:
+        pack_doip_header(_protocol_version, _payload_type, 0)
+
+
+def decode_message(payload_type, payload_bytes, payload_length, zero_copy=False):
+    """Unpacks one payload using the payload type table. Unknown types become a ReservedMessage"""
+    message_class = payload_type_to_message.get(payload_type)
+    if message_class is None:
+        return ReservedMessage.unpack(payload_type, payload_bytes, payload_length)
+    if zero_copy:
+        return message_class.unpack_view(payload_bytes, payload_length)
+    return message_class.unpack(payload_bytes, payload_length)
+
+
+def decode_all(buffer, zero_copy=False, max_payload_length=None):
+    """Decodes every complete DoIP message framed in a buffer in a single pass.
+
+    Bytes which can't start a valid generic header (inverse protocol version mismatch) are
+    skipped one at a time, the same way the parsers resynchronize. Decoding stops at the first
+    message that isn't complete yet; ``memoryview(buffer)[consumed:]`` is the unconsumed tail,
+    which holds at most one partial message.
+
+    :param buffer: Received bytes, starting on a message boundary
+    :type buffer: bytes-like
+    :param zero_copy: Leave bulk data (DiagnosticMessage user data) as memoryviews into
+        ``buffer`` instead of copying it out. The caller must not modify ``buffer`` while
+        the messages are in use
+    :type zero_copy: bool, optional
+    :param max_payload_length: Stop at a message with a longer payload, as if it was
+        incomplete, and leave it to the caller
+    :type max_payload_length: int, optional
+    :return: ``(messages, consumed)`` where messages is a list of ``(offset, message)`` tuples,
+        offset being the position of each message's header in the buffer, and consumed is
+        the number of bytes that were decoded or skipped
+    :rtype: tuple
+    """
+    view = memoryview(buffer)
+    end = len(view)
+    header_size = DOIP_HEADER.size
+    unpack_header = DOIP_HEADER.unpack_from
+    message_classes = payload_type_to_message
+    messages = []
+    offset = 0
+    while end - offset >= header_size:
+        protocol_version, inverse_protocol_version, payload_type, payload_size = (
+            unpack_header(view, offset)
+        )
+        if inverse_protocol_version != (0xFF ^ protocol_version):
+            offset += 1
+            continue
+        start = offset + header_size
+        stop = start + payload_size
+        if stop > end or (max_payload_length is not None and payload_size > max_payload_length):
+            break
+        message_class = message_classes.get(payload_type)
+        if message_class is None:
+            message = ReservedMessage.unpack(payload_type, view[start:stop], payload_size)
+        elif zero_copy:
+            message = message_class.unpack_view(view[start:stop], payload_size)
+        else:
+            message = message_class.unpack(view[start:stop], payload_size)
+        messages.append((offset, message))
+        offset = stop
+    return messages, offset
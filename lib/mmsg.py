@@ -0,0 +1,285 @@
+"""Batched UDP sends and receives with sendmmsg(2) and recvmmsg(2), which Python's socket
+module doesn't expose.
+
+Where libc has neither (anything but Linux), the same calls fall back to one sendmsg() or
+recvfrom() per datagram.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+
+# Missing from the socket module before Python 3.12
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+
+# Datagrams per sendmmsg() call, the kernel's UIO_MAXIOV
+MAX_BATCH = 1024
+
+# struct in_pktinfo: interface index, source address, (unused) header destination address
+_IN_PKTINFO = struct.Struct("=i4s4s")
+
+# An in_addr as the integer ctypes stores in network byte order
+_IN_ADDR = struct.Struct("=I")
+
+
+def _in_addr(host):
+    return _IN_ADDR.unpack(socket.inet_aton(host))[0]
+
+
+def routable_source(source, destination):
+    """`source` if a datagram sent from it (IP_PKTINFO) can reach `destination`, otherwise
+    None to let the kernel pick one. Linux refuses to send from a loopback address to any
+    other network (EINVAL)"""
+    if source is not None and source.startswith("127.") and not destination.startswith("127."):
+        return None
+    return source
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint32),
+        ("sin_zero", ctypes.c_char * 8),
+    ]
+
+
+class _pktinfo_cmsg(ctypes.Structure):
+    """A cmsghdr carrying an in_pktinfo, padded to CMSG_SPACE by the structure alignment"""
+
+    _fields_ = [
+        ("cmsg_len", ctypes.c_size_t),
+        ("cmsg_level", ctypes.c_int),
+        ("cmsg_type", ctypes.c_int),
+        ("ipi_ifindex", ctypes.c_int),
+        ("ipi_spec_dst", ctypes.c_uint32),
+        ("ipi_addr", ctypes.c_uint32),
+    ]
+
+
+# CMSG_LEN(sizeof(struct in_pktinfo))
+_PKTINFO_CMSG_LEN = _pktinfo_cmsg.ipi_ifindex.offset + _IN_PKTINFO.size
+
+# The msg_flags and msg_len a recvmmsg() call fills in, at their offsets in struct mmsghdr
+_MMSGHDR_RESULT = struct.Struct(
+    f"={_msghdr.msg_flags.offset}xi"
+    f"{_mmsghdr.msg_len.offset - _msghdr.msg_flags.offset - 4}xI"
+    f"{ctypes.sizeof(_mmsghdr) - _mmsghdr.msg_len.offset - 4}x"
+)
+
+# Port and address of a struct sockaddr_in
+_SOCKADDR_IN = struct.Struct("!2xH4s8x")
+
+# Plain ints, bitwise operations on the socket module's flag enums are slow
+_MSG_DONTWAIT = int(socket.MSG_DONTWAIT)
+_MSG_TRUNC = int(socket.MSG_TRUNC)
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+_recvmmsg = getattr(_libc, "recvmmsg", None)
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_mmsghdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    _recvmmsg.restype = ctypes.c_int
+
+HAVE_SENDMMSG = _sendmmsg is not None
+HAVE_RECVMMSG = _recvmmsg is not None
+
+
+class Datagram:
+    """A UDP datagram laid out for sendmmsg() once, to be sent any number of times
+
+    :param data: Payload
+    :type data: bytes
+    :param address: ``(host, port)`` to send to
+    :type address: tuple
+    :param source: Local address to send from (IP_PKTINFO), the socket's own by default
+    :type source: str, optional
+    """
+
+    __slots__ = ("data", "address", "source", "_ancillary", "_header", "_buffers")
+
+    def __init__(self, data, address, source=None):
+        self.data = bytes(data)
+        self.address = address
+        self.source = source
+        self._ancillary = []
+        if source is not None:
+            self._ancillary.append(
+                (socket.IPPROTO_IP, IP_PKTINFO, _IN_PKTINFO.pack(0, socket.inet_aton(source), bytes(4)))
+            )
+        if not HAVE_SENDMMSG:
+            return
+        buffer = ctypes.create_string_buffer(self.data, len(self.data))
+        iovec = _iovec(ctypes.addressof(buffer), len(self.data))
+        name = _sockaddr_in(socket.AF_INET, socket.htons(address[1]), _in_addr(address[0]))
+        header = _mmsghdr()
+        header.msg_hdr.msg_name = ctypes.addressof(name)
+        header.msg_hdr.msg_namelen = ctypes.sizeof(name)
+        header.msg_hdr.msg_iov = ctypes.pointer(iovec)
+        header.msg_hdr.msg_iovlen = 1
+        # The header only points at these, they live as long as the datagram
+        self._buffers = [buffer, iovec, name]
+        if source is not None:
+            control = _pktinfo_cmsg(_PKTINFO_CMSG_LEN, socket.IPPROTO_IP, IP_PKTINFO, 0, _in_addr(source))
+            header.msg_hdr.msg_control = ctypes.addressof(control)
+            header.msg_hdr.msg_controllen = ctypes.sizeof(control)
+            self._buffers.append(control)
+        self._header = header
+
+
+def sendmmsg(sock, datagrams):
+    """Send UDP datagrams with as few system calls as possible.
+
+    :param sock: IPv4 datagram socket. When it's non-blocking, the datagrams that don't fit
+        in its send buffer are dropped
+    :type sock: socket.socket
+    :param datagrams: Datagram objects
+    :type datagrams: list
+    :return: Number of datagrams sent
+    :rtype: int
+    """
+    if not HAVE_SENDMMSG:
+        return _send_each(sock, datagrams)
+    sent = 0
+    for start in range(0, len(datagrams), MAX_BATCH):
+        batch = datagrams[start : start + MAX_BATCH]
+        count = _send_batch(sock, batch)
+        sent += count
+        if count < len(batch):
+            break
+    return sent
+
+
+def _send_batch(sock, batch):
+    size = len(batch)
+    messages = (_mmsghdr * size)(*[datagram._header for datagram in batch])
+    count = _sendmmsg(sock.fileno(), messages, size, 0)
+    if count < 0:
+        error = ctypes.get_errno()
+        if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise OSError(error, os.strerror(error))
+    return count
+
+
+def _send_each(sock, datagrams):
+    sent = 0
+    for datagram in datagrams:
+        try:
+            sock.sendmsg([datagram.data], datagram._ancillary, 0, datagram.address)
+        except BlockingIOError:
+            break
+        sent += 1
+    return sent
+
+
+class DatagramReader:
+    """Reads the datagrams queued on a non-blocking UDP socket, up to `count` per recvmmsg()
+    call, into buffers allocated once
+
+    :param sock: Non-blocking IPv4 datagram socket
+    :type sock: socket.socket
+    :param count: Datagrams per call
+    :type count: int, optional
+    :param size: Longest datagram taken, longer ones are dropped
+    :type size: int, optional
+    """
+
+    def __init__(self, sock, count=64, size=512):
+        self.sock = sock
+        self.count = count
+        self.size = size
+        # Dotted quads by packed address, floods tend to come from a few hosts
+        self._hosts = {}
+        if not HAVE_RECVMMSG:
+            return
+        self._buffer = ctypes.create_string_buffer(count * size)
+        self._view = memoryview(self._buffer).cast("B")
+        self._names = (_sockaddr_in * count)()
+        self._iovecs = (_iovec * count)()
+        self._messages = (_mmsghdr * count)()
+        base = ctypes.addressof(self._buffer)
+        for index in range(count):
+            self._iovecs[index].iov_base = base + index * size
+            self._iovecs[index].iov_len = size
+            header = self._messages[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._names[index])
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(self._iovecs[index])
+            header.msg_iovlen = 1
+
+    def read(self):
+        """Return the ``(data, (host, port))`` of up to `count` queued datagrams, an empty
+        list when there are none"""
+        if not HAVE_RECVMMSG:
+            return self._read_each()
+        messages = self._messages
+        count = _recvmmsg(self.sock.fileno(), messages, self.count, _MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(error, os.strerror(error))
+        # Going through the ctypes fields costs more than the system call saves, so the
+        # results are unpacked in bulk from copies of the arrays
+        results = _MMSGHDR_RESULT.iter_unpack(
+            ctypes.string_at(ctypes.addressof(messages), count * _MMSGHDR_RESULT.size)
+        )
+        names = _SOCKADDR_IN.iter_unpack(
+            ctypes.string_at(ctypes.addressof(self._names), count * _SOCKADDR_IN.size)
+        )
+        view = self._view
+        size = self.size
+        hosts = self._hosts
+        if len(hosts) > 1024:
+            hosts.clear()
+        datagrams = []
+        start = 0
+        for (flags, length), (port, host) in zip(results, names):
+            if not flags & _MSG_TRUNC:
+                address = hosts.get(host)
+                if address is None:
+                    address = hosts[host] = socket.inet_ntoa(host)
+                datagrams.append((view[start : start + length].tobytes(), (address, port)))
+            start += size
+        return datagrams
+
+    def _read_each(self):
+        datagrams = []
+        for _ in range(self.count):
+            try:
+                datagrams.append(self.sock.recvfrom(self.size))
+            except (BlockingIOError, InterruptedError):
+                break
+        return datagrams
@@ -0,0 +1,441 @@
+import errno
+import hashlib
+import logging
+import lzma
+import mmap
+import os
+import threading
+import zlib
+from collections import deque
+
+from udsoncan.Response import Response
+
+logger = logging.getLogger("doipserver.sink")
+
+# pwritev() takes at most IOV_MAX buffers
+_IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+def preallocate(fd, size):
+    """Reserve `size` bytes for a file, so writing the image can't run out of space halfway.
+    Falls back to a sparse file where fallocate isn't available"""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # Raised by file systems that don't support it
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+def decompressor(method):
+    """Streaming decompressor for a compression method of lib.constants.COMPRESSION_METHODS.
+    zlib also takes gzip streams, lzma both .xz and .lzma ones"""
+    if method == "zlib":
+        return zlib.decompressobj(wbits=47)
+    if method == "lzma":
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unknown compression method: {method}")
+
+
+def _pwritev(fd, buffers, offset):
+    if hasattr(os, "pwritev"):
+        written = os.pwritev(fd, buffers, offset)
+        if written == sum(len(buffer) for buffer in buffers):
+            return
+        # Short write, finish it one buffer at a time
+        buffers = [memoryview(b"".join(buffers))[written:]]
+        offset += written
+    for buffer in buffers:
+        view = memoryview(buffer)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+
+class ImageWriter:
+    """Writes TransferData blocks to their image files from a background thread.
+
+    Blocks are queued by the event loop and written in the order they were queued. Blocks
+    queued back to back for consecutive offsets of the same image are merged into a single
+    pwritev() call, and the file I/O never holds up the event loop. The queue is bounded by
+    the number of bytes waiting: submit() reports when it's over `max_pending` so the
+    connection can stop reading until notify_when_drained() calls back.
+
+    :param max_pending: Bytes that can be waiting to be written before connections pause
+    :type max_pending: int
+    :param fsync: When to fsync images: "never", "exit" when the download is closed, or
+        "always" after every write
+    :type fsync: str
+    """
+
+    FSYNC_POLICIES = ("never", "exit", "always")
+
+    def __init__(self, max_pending=16 << 20, fsync="never"):
+        self.configure(max_pending, fsync)
+        self._jobs = deque()
+        self._pending = 0
+        self._drained_callbacks = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def configure(self, max_pending=16 << 20, fsync="never"):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.max_pending = max_pending
+        self.fsync = fsync
+
+    def submit(self, sink, offset, data):
+        """Queue a block for writing. Returns True if the queue is full after it, in which
+        case the caller should stop producing more until notify_when_drained() fires"""
+        with self._condition:
+            self._jobs.append((sink, offset, data))
+            self._pending += len(data)
+            self._condition.notify()
+            congested = self._pending >= self.max_pending
+        self._start()
+        return congested
+
+    def close(self, sink, callback=None):
+        """Close the image once the blocks queued before are written, then call
+        callback(error) from the writer thread. `error` is the first error the image ran into
+        (OSError, or ValueError and the decompressors' errors for compressed downloads), if
+        any"""
+        with self._condition:
+            self._jobs.append((sink, None, callback))
+            self._condition.notify()
+        self._start()
+
+    def notify_when_drained(self, callback):
+        """Call `callback` from the writer thread once the queue is down to half of
+        max_pending"""
+        with self._condition:
+            if self._pending > self.max_pending // 2:
+                self._drained_callbacks.append(callback)
+                return
+        callback()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="image-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    self._condition.wait()
+                jobs = list(self._jobs)
+                self._jobs.clear()
+
+            index = 0
+            while index < len(jobs):
+                sink, offset, data = jobs[index]
+                index += 1
+                if offset is None:
+                    sink._close(self.fsync == "exit", data)
+                    continue
+                # Merge what directly follows in the same image
+                buffers = [data]
+                end = offset + len(data)
+                while index < len(jobs) and len(buffers) < _IOV_MAX:
+                    next_sink, next_offset, next_data = jobs[index]
+                    if next_sink is not sink or next_offset != end:
+                        break
+                    buffers.append(next_data)
+                    end += len(next_data)
+                    index += 1
+                sink._write(buffers, offset, self.fsync == "always")
+                self._written(end - offset)
+
+    def _written(self, count):
+        with self._condition:
+            self._pending -= count
+            if self._pending > self.max_pending // 2 or not self._drained_callbacks:
+                return
+            callbacks = self._drained_callbacks
+            self._drained_callbacks = []
+        for callback in callbacks:
+            callback()
+
+
+class ImageSink:
+    """Image file of one RequestDownload, sized to the download and written by an
+    ImageWriter.
+
+    TransferData blocks land at the offset given by their position in the download: the block
+    sequence counter is followed across its wraparound, and the length of the first block is
+    the length of every block but the last. A repeated sequence counter is a retransmission
+    and overwrites the previous block in place.
+
+    A compressed download is one compressed stream cut into blocks of any length. The writer
+    thread decompresses the blocks in order and appends the output to the image, which is
+    memorySize bytes once decompressed. A retransmission was already fed to the decompressor,
+    so it's acknowledged without being written again.
+
+    The writer thread keeps a CRC32 and a SHA-256 of the image as the blocks are written, so
+    digest() is ready as soon as the image is closed. Since only the last block can be
+    retransmitted, each block is hashed once the block after it arrives (or the image is
+    closed), and a retransmission simply replaces the block waiting to be hashed.
+
+    :param path: Image file, created or truncated
+    :type path: str
+    :param memory_address: memoryAddress of the RequestDownload
+    :type memory_address: int
+    :param size: memorySize of the RequestDownload
+    :type size: int
+    :param writer: Writer thread the blocks go through
+    :type writer: ImageWriter
+    :param compression: Compression method of the blocks, see decompressor()
+    :type compression: str, optional
+    """
+
+    __slots__ = (
+        "path",
+        "memory_address",
+        "size",
+        "compression",
+        "block_length",
+        "received",
+        "error",
+        "_writer",
+        "_fd",
+        "_next_block",
+        "_last_sequence",
+        "_decompressor",
+        "_image_end",
+        "_crc32",
+        "_sha256",
+        "_unhashed",
+        "_unhashed_offset",
+    )
+
+    def __init__(self, path, memory_address, size, writer, compression=None):
+        self.path = path
+        self.memory_address = memory_address
+        self.size = size
+        self.compression = compression
+        self.block_length = None
+        # End of the furthest block received so far, in the compressed stream for
+        # compressed downloads
+        self.received = 0
+        # First error the writer ran into
+        self.error = None
+        self._writer = writer
+        self._next_block = 0
+        self._last_sequence = None
+        # Decompressor and end of the image written so far, only touched by the writer thread
+        self._decompressor = decompressor(compression) if compression else None
+        self._image_end = 0
+        # Digest of the image up to _unhashed_offset, only touched by the writer thread
+        self._crc32 = 0
+        self._sha256 = hashlib.sha256()
+        self._unhashed = None
+        self._unhashed_offset = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate(self._fd, size)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def write_block(self, sequence, data):
+        """Queue a TransferData block for writing
+
+        :param sequence: blockSequenceCounter of the request
+        :type sequence: int
+        :param data: transferRequestParameterRecord of the request. It is written later on,
+            so it must not be modified afterwards
+        :type data: bytes-like
+        :return: A negative response code if the block was rejected, True if it was queued
+            and the writer is congested, False otherwise
+        """
+        if self.error is not None:
+            # Reported by the writer for an earlier block
+            return Response.Code.GeneralProgrammingFailure
+        if sequence == (self._next_block + 1) & 0xFF:
+            index = self._next_block
+        elif self._next_block and sequence == self._last_sequence:
+            # Retransmission of the last block
+            if self._decompressor is not None:
+                return False
+            index = self._next_block - 1
+        else:
+            return Response.Code.WrongBlockSequenceCounter
+
+        if self._decompressor is not None:
+            # Compressed blocks follow each other in the stream, whatever their length
+            offset = self.received
+            self._next_block = index + 1
+            self._last_sequence = sequence
+            self.received += len(data)
+            return self._writer.submit(self, offset, data)
+
+        if self.block_length is None:
+            self.block_length = len(data)
+        elif len(data) > self.block_length:
+            return Response.Code.TransferDataSuspended
+        offset = index * self.block_length
+        end = offset + len(data)
+        if end > self.size:
+            return Response.Code.TransferDataSuspended
+
+        self._next_block = index + 1
+        self._last_sequence = sequence
+        self.received = max(self.received, end)
+        return self._writer.submit(self, offset, data)
+
+    def close(self, callback=None):
+        """Close the image after its queued blocks are written. See ImageWriter.close()"""
+        if self._fd is not None:
+            self._writer.close(self, callback)
+
+    def digest(self):
+        """CRC32 (4 bytes, big endian) followed by the SHA-256 of the image. Only complete once
+        the image has been closed"""
+        return self._crc32.to_bytes(4, byteorder="big") + self._sha256.digest()
+
+    # Called from the writer thread
+
+    def _write(self, buffers, offset, fsync):
+        if self.error is not None:
+            return
+        try:
+            if self._decompressor is not None:
+                buffers, offset = self._decompress(buffers)
+                if not buffers:
+                    return
+            # hashlib and zlib release the GIL on large buffers, like the write below
+            block_offset = offset
+            for buffer in buffers:
+                if block_offset != self._unhashed_offset:
+                    self._hash_unhashed()
+                self._unhashed = buffer
+                self._unhashed_offset = block_offset
+                block_offset += len(buffer)
+            _pwritev(self._fd, buffers, offset)
+            if fsync:
+                os.fsync(self._fd)
+        except (OSError, ValueError, zlib.error, lzma.LZMAError) as e:
+            logger.error(f"Image {self.path}: write failed: {e}")
+            self.error = e
+
+    def _decompress(self, buffers):
+        """Decompress blocks of the stream, returning the output and its offset in the image"""
+        offset = self._image_end
+        output = []
+        for buffer in buffers:
+            # Never inflate more than what still fits into the image
+            remaining = self.size - self._image_end
+            data = self._decompressor.decompress(buffer, remaining + 1)
+            if len(data) > remaining:
+                raise ValueError(f"Decompressed image is larger than {self.size} bytes")
+            if data:
+                output.append(data)
+                self._image_end += len(data)
+        return output, offset
+
+    def _hash_unhashed(self):
+        if self._unhashed is not None:
+            self._crc32 = zlib.crc32(self._unhashed, self._crc32)
+            self._sha256.update(self._unhashed)
+            self._unhashed_offset += len(self._unhashed)
+            self._unhashed = None
+
+    def _close(self, fsync, callback):
+        if self._fd is not None:
+            self._hash_unhashed()
+            if self._decompressor is not None and not self._decompressor.eof:
+                self.error = self.error or ValueError("Compressed stream ended early")
+            try:
+                if fsync and self.error is None:
+                    os.fsync(self._fd)
+            except OSError as e:
+                self.error = e
+            os.close(self._fd)
+            self._fd = None
+            received = self.received if self._decompressor is None else self._image_end
+            logger.info(f"Image {self.path}: {received} of {self.size} bytes received")
+        if callback is not None:
+            callback(self.error)
+
+
+class ImageSource:
+    """Image file served by one RequestUpload.
+
+    The file is memory-mapped and every TransferData response carries a memoryview slice of
+    the mapping, so blocks go from the page cache to the socket without being copied into
+    Python objects on the way.
+
+    :param path: Image file
+    :type path: str
+    :param offset: Offset of the uploaded memory in the file
+    :type offset: int
+    :param memory_address: memoryAddress of the RequestUpload
+    :type memory_address: int
+    :param size: memorySize of the RequestUpload
+    :type size: int
+    :param block_length: Bytes of data per TransferData response
+    :type block_length: int
+    :raises ValueError: If the file doesn't cover `size` bytes from `offset`
+    """
+
+    __slots__ = (
+        "path",
+        "memory_address",
+        "size",
+        "block_length",
+        "_map",
+        "_view",
+        "_next_block",
+        "_last_sequence",
+    )
+
+    def __init__(self, path, offset, memory_address, size, block_length):
+        self.path = path
+        self.memory_address = memory_address
+        self.size = size
+        self.block_length = block_length
+        self._next_block = 0
+        self._last_sequence = None
+        with open(path, "rb") as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if offset + size > file_size:
+                raise ValueError(f"{path} has {file_size} bytes, {offset + size} needed")
+            # An empty file can't be mapped
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if file_size else None
+        self._view = memoryview(self._map or b"")[offset : offset + size]
+
+    def read_block(self, sequence):
+        """Return the data of the TransferData response for a blockSequenceCounter, as a
+        memoryview over the image, or a negative response code. A repeated sequence counter
+        gets the previous block again"""
+        if sequence == (self._next_block + 1) & 0xFF:
+            index = self._next_block
+        elif self._next_block and sequence == self._last_sequence:
+            index = self._next_block - 1
+        else:
+            return Response.Code.WrongBlockSequenceCounter
+        offset = index * self.block_length
+        if offset >= self.size:
+            return Response.Code.RequestSequenceError
+        self._next_block = index + 1
+        self._last_sequence = sequence
+        return self._view[offset : offset + self.block_length]
+
+    def close(self):
+        if self._view is None:
+            return
+        self._view.release()
+        self._view = None
+        try:
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            # Blocks are still queued for sending, the mapping goes when they are sent
+            pass
+        self._map = None
+        logger.info(f"Image {self.path}: upload of {self.size} bytes closed")
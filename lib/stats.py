@@ -0,0 +1,54 @@
+class ServerStats:
+    """Counters kept by a server process. They're plain integers that are only touched from
+    the event loop thread, and snapshot() turns them into a dict that can be sent to another
+    process and summed up with merge()
+    """
+
+    __slots__ = (
+        "connections",
+        "connections_refused",
+        "active_connections",
+        "doip_messages",
+        "uds_requests",
+        "bytes_received",
+        "bytes_sent",
+        "cache_hits",
+        "cache_misses",
+    )
+
+    # Gauges describe the current state of a process rather than accumulate over its
+    # lifetime, so they're dropped when a process goes away
+    GAUGES = ("active_connections",)
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @staticmethod
+    def merge(snapshots):
+        """Sum up snapshots, e.g. from all the worker processes
+
+        :param snapshots: Iterable of dicts returned by snapshot()
+        :return: A dict with the same keys holding the totals
+        """
+        totals = dict.fromkeys(ServerStats.__slots__, 0)
+        for snapshot in snapshots:
+            for name, value in snapshot.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    @staticmethod
+    def cache_hit_rate(snapshot):
+        """Share of cacheable UDS requests answered from the response cache"""
+        lookups = snapshot["cache_hits"] + snapshot["cache_misses"]
+        return snapshot["cache_hits"] / lookups if lookups else 0.0
+
+    @staticmethod
+    def retire(snapshot):
+        """Return the part of a snapshot that still counts after its process is gone"""
+        return {
+            name: value for name, value in snapshot.items() if name not in ServerStats.GAUGES
+        }
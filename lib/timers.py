@@ -0,0 +1,138 @@
+import math
+
+# Resolution and size of the wheel. One revolution spans TICK * SLOTS seconds, longer timers
+# go round several times
+TICK = 0.1
+SLOTS = 512
+
+
+class Timer:
+    """A callback scheduled on a TimingWheel, see TimingWheel.schedule()"""
+
+    __slots__ = ("_wheel", "_slot", "rounds", "callback", "args")
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self._wheel = wheel
+        self._slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    @property
+    def active(self):
+        return self._wheel is not None
+
+    def cancel(self):
+        if self._wheel is not None:
+            self._wheel._remove(self)
+
+
+class TimingWheel:
+    """Hashed timing wheel: timeouts for any number of connections driven by one periodic
+    callback on the clock.
+
+    A timer goes into the slot its expiry falls into modulo the wheel size, with the number
+    of whole revolutions left. Scheduling and cancelling are O(1) set operations, and each
+    tick only looks at the timers of one slot. Expiry is rounded up to the next tick, counted
+    from when the next tick is due, so a timer never fires before its delay.
+
+    The wheel only ticks while timers are scheduled. `ticks` counts the ticks so far, which
+    makes a cheap timestamp for activity that a timer checks when it fires, instead of being
+    rescheduled on every message.
+
+    :param clock: Provides callLater() and seconds(), the twisted reactor or an
+        AsyncioClock
+    :param tick: Seconds per tick
+    :type tick: float
+    :param slots: Number of slots
+    :type slots: int
+    """
+
+    __slots__ = ("clock", "tick", "ticks", "_slots", "_cursor", "_count", "_call", "_next_tick", "_advancing")
+
+    def __init__(self, clock, tick=TICK, slots=SLOTS):
+        self.clock = clock
+        self.tick = tick
+        self.ticks = 0
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._count = 0
+        self._call = None
+        self._next_tick = None
+        # Set while ticking. Timers scheduled by callbacks then keep to the ticks already due
+        self._advancing = False
+
+    def __len__(self):
+        return self._count
+
+    def ticks_for(self, delay):
+        return max(1, math.ceil(delay / self.tick - 1e-9))
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) after `delay` seconds, rounded up to a whole tick
+
+        :rtype: Timer
+        """
+        now = self.clock.seconds()
+        if self._call is None and not self._advancing:
+            self._next_tick = now + self.tick
+            self._call = self.clock.callLater(self.tick, self._advance)
+        # The first tick due at or after now + delay. The current one has partly gone by
+        ticks = 1 + max(0, math.ceil((now + delay - self._next_tick) / self.tick - 1e-9))
+        slot = (self._cursor + ticks) % len(self._slots)
+        timer = Timer(self, slot, (ticks - 1) // len(self._slots), callback, args)
+        self._slots[slot].add(timer)
+        self._count += 1
+        return timer
+
+    def _remove(self, timer):
+        self._slots[timer._slot].discard(timer)
+        timer._wheel = None
+        self._count -= 1
+        if not self._count and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _advance(self):
+        self._call = None
+        self._advancing = True
+        # Catch up with the ticks a busy loop was late for
+        now = self.clock.seconds()
+        try:
+            while self._next_tick <= now and self._count:
+                self._next_tick += self.tick
+                self._tick()
+        finally:
+            self._advancing = False
+        if self._count:
+            self._call = self.clock.callLater(max(0.0, self._next_tick - now), self._advance)
+
+    def _tick(self):
+        self.ticks += 1
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        slot = self._slots[self._cursor]
+        expired = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                expired.append(timer)
+        for timer in expired:
+            if timer._wheel is None:
+                # Cancelled by an earlier callback of this tick
+                continue
+            slot.discard(timer)
+            timer._wheel = None
+            self._count -= 1
+            timer.callback(*timer.args)
+
+
+_wheels = {}
+
+
+def timing_wheel(clock):
+    """The timing wheel of a clock, shared by everything scheduled on it"""
+    wheel = _wheels.get(clock)
+    if wheel is None:
+        wheel = _wheels[clock] = TimingWheel(clock)
+    return wheel
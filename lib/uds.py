@@ -0,0 +1,389 @@
+import logging
+
+from udsoncan import Routine
+from udsoncan.Request import Request
+from udsoncan.Response import Response
+
+from lib.sink import ImageSink, ImageSource
+
+logger = logging.getLogger("doipserver.uds")
+
+NEGATIVE_RESPONSE = 0x7F
+POSITIVE_RESPONSE_OFFSET = 0x40
+SUPPRESS_POSITIVE_RESPONSE = 0x80
+
+# P2server_max and P2*server_max announced in the DiagnosticSessionControl response. A
+# response that isn't ready within P2server_max is preceded by ResponsePending, and the next
+# ResponsePending has to go out before P2*server_max expires, so they're sent a margin earlier
+P2_SERVER_MAX = 0.05
+P2_STAR_SERVER_MAX = 5.0
+RESPONSE_PENDING_DELAY = P2_SERVER_MAX - 0.01
+RESPONSE_PENDING_INTERVAL = P2_STAR_SERVER_MAX - 1.0
+
+# Services whose second byte is a subfunction, with the suppressPosRspMsgIndicationBit on top
+SUBFUNCTION_SERVICES = frozenset(
+    (0x10, 0x11, 0x19, 0x27, 0x28, 0x29, 0x2C, 0x31, 0x3E, 0x83, 0x85, 0x87)
+)
+
+
+def negative_response(sid, code):
+    return bytes((NEGATIVE_RESPONSE, sid, code))
+
+
+# UDS service handlers.
+#
+# A handler is called as handler(server, session, payload) with the raw request payload
+# (SID included) and returns the raw response payload, or None to send nothing. `session` is
+# the EcuSession of the addressed ECU on this connection, `server` the DoIPTCPServer it came
+# in on. Handlers work on the raw bytes so the hot services never build udsoncan objects.
+
+
+def diagnostic_session_control(server, session, payload):
+    session.diagnostic_session = payload[1] & 0x7F
+    # p2-default(50ms), p2-star(5000ms)
+    return bytes((0x50, payload[1] & 0x7F)) + b"\x00\x32\x01\xf4"
+
+
+def ecu_reset(server, session, payload):
+    return bytes((0x51, payload[1] & 0x7F))
+
+
+def tester_present(server, session, payload):
+    return bytes((0x7E, payload[1] & 0x7F))
+
+
+def read_data_by_identifier(server, session, payload):
+    if len(payload) < 3 or len(payload) % 2 != 1:
+        return negative_response(0x22, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    ecu = session.ecu
+    response = bytearray(b"\x62")
+    for offset in range(1, len(payload), 2):
+        did = payload[offset : offset + 2]
+        response += did
+        response += ecu.read_data_by_identifier(int.from_bytes(did, byteorder="big"))
+    return bytes(response)
+
+
+def write_data_by_identifier(server, session, payload):
+    if len(payload) < 4:
+        return negative_response(0x2E, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    session.ecu.write_data_by_identifier(int.from_bytes(payload[1:3], byteorder="big"), payload[3:])
+    return b"\x6e" + bytes(payload[1:3])
+
+
+def security_access(server, session, payload):
+    subfunction = payload[1] & 0x7F
+    if subfunction == 0x01:
+        if session.auth_flag:
+            return b"\x67\x01\x00\x00\x00"
+        return b"\x67\x01" + session.seed
+    if subfunction == 0x02:
+        session.auth_flag = True
+        return b"\x67\x02"
+    return b"\x67"
+
+
+def _block_length_response(sid, ecu):
+    # lengthFormatIdentifier: maxNumberOfBlockLength is 4 bytes long, in the high nibble
+    length = ecu.max_number_of_block_length.to_bytes(4, byteorder="big")
+    return bytes((sid + POSITIVE_RESPONSE_OFFSET, 0x40)) + length
+
+
+def _memory_location(payload):
+    """memoryAddress and memorySize of a RequestDownload/RequestUpload, or a negative
+    response code"""
+    if len(payload) < 3:
+        return Response.Code.IncorrectMessageLengthOrInvalidFormat
+    # addressAndLengthFormatIdentifier: memorySize length in the high nibble, memoryAddress
+    # length in the low one
+    size_length = payload[2] >> 4
+    address_length = payload[2] & 0x0F
+    if not size_length or not address_length:
+        return Response.Code.RequestOutOfRange
+    if len(payload) != 3 + address_length + size_length:
+        return Response.Code.IncorrectMessageLengthOrInvalidFormat
+    return (
+        int.from_bytes(payload[3 : 3 + address_length], byteorder="big"),
+        int.from_bytes(payload[3 + address_length :], byteorder="big"),
+    )
+
+
+def request_download(server, session, payload):
+    logger.debug(f"RequestDownload: {bytes(payload[1:]).hex(' ')}")
+    location = _memory_location(payload)
+    if isinstance(location, int):
+        return negative_response(0x34, location)
+    memory_address, memory_size = location
+    # dataFormatIdentifier: compressionMethod in the high nibble, encryptingMethod in the low one
+    compression = None
+    if payload[1] & 0xF0:
+        compression = session.ecu.compression_methods.get(payload[1] >> 4)
+        if compression is None:
+            return negative_response(0x34, Response.Code.RequestOutOfRange)
+    if payload[1] & 0x0F:
+        return negative_response(0x34, Response.Code.RequestOutOfRange)
+
+    session.close_upload()
+    session.close_download()
+    try:
+        session.download = ImageSink(
+            session.image_file_name(memory_address),
+            memory_address,
+            memory_size,
+            server.image_writer,
+            compression,
+        )
+    except OSError as e:
+        logger.error(f"Can't create the image for a {memory_size} bytes download: {e}")
+        return negative_response(0x34, Response.Code.UploadDownloadNotAccepted)
+    return _block_length_response(0x34, session.ecu)
+
+
+def request_upload(server, session, payload):
+    logger.debug(f"RequestUpload: {bytes(payload[1:]).hex(' ')}")
+    location = _memory_location(payload)
+    if isinstance(location, int):
+        return negative_response(0x35, location)
+    memory_address, memory_size = location
+    if payload[1]:
+        # Uploads are neither compressed nor encrypted
+        return negative_response(0x35, Response.Code.RequestOutOfRange)
+
+    session.close_upload()
+    session.close_download()
+    # The ECU's configured images, or what was downloaded to the address on this connection
+    image = session.ecu.find_image(memory_address) or (session.image_file_name(memory_address), 0)
+    try:
+        session.upload = ImageSource(
+            *image,
+            memory_address,
+            memory_size,
+            session.ecu.max_number_of_block_length - 2,
+        )
+    except (OSError, ValueError) as e:
+        logger.error(f"Can't upload {memory_size} bytes from 0x{memory_address:08X}: {e}")
+        return negative_response(0x35, Response.Code.RequestOutOfRange)
+    return _block_length_response(0x35, session.ecu)
+
+
+def transfer_data(server, session, payload):
+    if len(payload) < 2:
+        return negative_response(0x36, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    if session.upload is not None:
+        block = session.upload.read_block(payload[1])
+        if isinstance(block, int):
+            return negative_response(0x36, block)
+        # The block goes out as its own buffer, straight from the mapped image
+        server.send_uds_response_parts(session, (bytes((0x76, payload[1])), block))
+        return None
+    if len(payload) > session.ecu.max_number_of_block_length:
+        return negative_response(0x36, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    if session.download is None:
+        # Without a RequestDownload blocks are appended to the session's file, the way the
+        # simulator always stored them
+        server.append_to_file(session.append_file_name, payload[2:])
+    else:
+        code = session.download.write_block(payload[1], payload[2:])
+        if code is True:
+            # The image writer is behind, stop reading from the tester until it catches up
+            server.pause_for_writer()
+        elif code is not False:
+            return negative_response(0x36, code)
+    return bytes((0x76, payload[1]))
+
+
+class PendingResponse:
+    """A response that is sent later on, while the connection goes on.
+
+    Until finish() is called, ResponsePending goes out after `first_pending` seconds and then
+    every RESPONSE_PENDING_INTERVAL. Everything is scheduled on the server's clock, so nothing
+    blocks the event loop and any number of responses can be pending at the same time. The
+    pending responses of a connection are dropped when it's lost.
+
+    :param server: DoIPTCPServer the request was received on
+    :param session: EcuSession of the addressed ECU
+    :param sid: Service of the request
+    :type sid: int
+    """
+
+    __slots__ = ("server", "session", "_pending", "_pending_call", "_done_call", "pending_sent")
+
+    def __init__(self, server, session, sid):
+        self.server = server
+        self.session = session
+        self._pending = negative_response(
+            sid, Response.Code.RequestCorrectlyReceived_ResponsePending
+        )
+        self._pending_call = None
+        self._done_call = None
+        # Whether ResponsePending went out
+        self.pending_sent = False
+
+    def start(self, first_pending=0.0):
+        self.server.pending_responses.add(self)
+        if first_pending:
+            self._pending_call = self.server.clock.callLater(first_pending, self._send_pending)
+        else:
+            self._send_pending()
+        return self
+
+    def finish(self, response, suppress=False):
+        """Send the final response, None to send nothing.
+
+        :param suppress: The request suppressed the positive response. Once ResponsePending
+            went out, ISO 14229-1 requires the final response anyway, otherwise it's dropped
+        """
+        if self not in self.server.pending_responses:
+            # Cancelled with the connection
+            return
+        self.cancel()
+        if suppress and not self.pending_sent:
+            return
+        if response is not None:
+            self.server.send_uds_response(self.session, response)
+
+    def finish_later(self, delay, response, suppress=False):
+        self._done_call = self.server.clock.callLater(delay, self._done, response, suppress)
+
+    def cancel(self):
+        for call in (self._pending_call, self._done_call):
+            if call is not None:
+                call.cancel()
+        self._pending_call = self._done_call = None
+        self.server.pending_responses.discard(self)
+
+    def _send_pending(self):
+        self.pending_sent = True
+        self.server.send_uds_response(self.session, self._pending)
+        self._pending_call = self.server.clock.callLater(
+            RESPONSE_PENDING_INTERVAL, self._send_pending
+        )
+
+    def _done(self, response, suppress):
+        self._done_call = None
+        self.finish(response, suppress)
+
+
+def request_transfer_exit(server, session, payload):
+    # The response waits until the writer has flushed and closed the image, so a tester that
+    # got it can rely on the whole image being on disk
+    if session.upload is not None:
+        session.close_upload()
+        return b"\x77"
+    download = session.download
+    pending = PendingResponse(server, session, 0x37).start(RESPONSE_PENDING_DELAY)
+
+    def exited(error):
+        if error is not None:
+            pending.finish(negative_response(0x37, Response.Code.GeneralProgrammingFailure))
+        elif download is None:
+            pending.finish(b"\x77")
+        else:
+            # transferResponseParameterRecord: CRC32 and SHA-256 of the image
+            session.image_digest = download.digest()
+            pending.finish(b"\x77" + session.image_digest)
+
+    session.close_download(lambda error: server.clock.callFromThread(exited, error))
+    return None
+
+
+# Routine checking the last downloaded image against the digest in its option record
+CHECK_MEMORY = 0x0202
+
+
+def check_memory(session, payload):
+    """CheckMemory with a CRC32 (4 bytes) or SHA-256 (32 bytes) option record answers with
+    routineStatus 0x00 if it matches the image of the last completed download and 0x01 if it
+    doesn't. Without an option record the status is followed by the CRC32 and SHA-256 of the
+    image, as in the RequestTransferExit response"""
+    if session.image_digest is None:
+        return negative_response(0x31, Response.Code.RequestSequenceError)
+    expected = bytes(payload[4:])
+    response = bytes((0x71, payload[1] & 0x7F)) + bytes(payload[2:4])
+    if not expected:
+        return response + b"\x00" + session.image_digest
+    if len(expected) == 4:
+        actual = session.image_digest[:4]
+    elif len(expected) == 32:
+        actual = session.image_digest[4:]
+    else:
+        return negative_response(0x31, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    return response + (b"\x00" if expected == actual else b"\x01")
+
+
+def routine_control(server, session, payload):
+    if len(payload) < 4:
+        return negative_response(0x31, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+    logger.debug(f"RoutineControl: {bytes(payload[1:]).hex(' ')}")
+    rid = int.from_bytes(payload[2:4], byteorder="big")
+    if rid == CHECK_MEMORY and payload[1] & 0x7F == 0x01:
+        # The digest is kept up to date while the image is written, nothing left to run
+        return check_memory(session, payload)
+    response = bytes((0x71, payload[1] & 0x7F)) + bytes(payload[2:4])
+    if rid == Routine.EraseMemory:
+        response += b"\x10"
+    else:
+        response += b"\x10\x00"
+    suppress = bool(payload[1] & SUPPRESS_POSITIVE_RESPONSE)
+    duration = session.ecu.routine_duration(rid)
+    if not duration:
+        return None if suppress else response
+    # Routines done within P2server get their final response alone. Longer ones get
+    # ResponsePending first, and then the final response even if it was suppressed
+    pending = PendingResponse(server, session, 0x31).start(RESPONSE_PENDING_DELAY)
+    pending.finish_later(duration, response, suppress)
+    # PendingResponse sends the responses
+    return None
+
+
+def other_service(server, session, payload):
+    """Services without a handler get an empty positive response if udsoncan knows them,
+    like the simulator has always done, and no response otherwise"""
+    request = Request.from_payload(bytes(payload))
+    if request is None or request.service is None:
+        logger.debug(f"Unknown service 0x{payload[0]:02X}, no response")
+        return None
+    return bytes((payload[0] + POSITIVE_RESPONSE_OFFSET,))
+
+
+DEFAULT_HANDLERS = {
+    0x10: diagnostic_session_control,
+    0x11: ecu_reset,
+    0x22: read_data_by_identifier,
+    0x27: security_access,
+    0x2E: write_data_by_identifier,
+    0x31: routine_control,
+    0x34: request_download,
+    0x35: request_upload,
+    0x36: transfer_data,
+    0x37: request_transfer_exit,
+    0x3E: tester_present,
+}
+
+
+# Services whose reply, and the session state they leave behind, only depend on the request
+# and the session state before it. The server caches their framed replies
+CACHEABLE_SERVICES = frozenset((0x10, 0x22, 0x3E))
+
+
+def handle_request(server, session, payload):
+    """Run the handler for a UDS request and return the response payload to send, if any
+
+    :param server: DoIPTCPServer the request was received on
+    :param session: EcuSession of the addressed ECU
+    :param payload: Raw UDS request
+    :type payload: bytes-like
+    """
+    if not payload:
+        return None
+    sid = payload[0]
+    handler = session.ecu.handlers.get(sid, other_service)
+    if sid in SUBFUNCTION_SERVICES:
+        if len(payload) < 2:
+            return negative_response(sid, Response.Code.IncorrectMessageLengthOrInvalidFormat)
+        response = handler(server, session, payload)
+        # A suppressed positive response still lets the negative ones through
+        if payload[1] & SUPPRESS_POSITIVE_RESPONSE and response and response[0] != NEGATIVE_RESPONSE:
+            return None
+        return response
+    return handler(server, session, payload)
@@ -1,27 +1,43 @@
 from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol, Factory, Protocol
+from twisted.internet.task import LoopingCall
+import argparse
+import asyncio
 import logging
+import multiprocessing
+import queue
+import resource
+import signal
 import socket
-import struct
 import time
 import sys
 import os
 import json
 import yaml
-from enum import IntEnum
 from lib.constants import (
     A_DOIP_CTRL,
     TCP_DATA_UNSECURED,
     UDP_DISCOVERY,
     A_PROCESSING_TIME,
     LINK_LOCAL_MULTICAST_ADDRESS,
+    T_TCP_GENERAL_INACTIVITY,
+    T_TCP_INITIAL_INACTIVITY,
+    T_TCP_ALIVE_CHECK,
+    MAX_CONCURRENT_SOCKETS,
+    S3_SERVER,
 )
 from lib.messages import *
-
-from udsoncan.Request import Request
-from udsoncan.Response import Response
-from udsoncan.services import *
-from udsoncan import DataIdentifier, Routine
+from lib.framer import DoIPFramer, OversizedMessage
+from lib.engine import BatchedDatagramPort, DatagramProtocolAdapter, StreamProtocolAdapter, loop_clock, new_event_loop
+from lib.stats import ServerStats
+from lib.ecu import EcuSession, Gateway
+from lib.fleet import Fleet
+from lib.sink import ImageWriter
+from lib.timers import timing_wheel
+from lib.announce import JITTER, AnnouncementScheduler
+from lib.mmsg import Datagram, routable_source, sendmmsg
+
+from lib.uds import handle_request
 import random
 import pdb
 
@@ -31,14 +47,23 @@ from pathlib import Path
 script_path = Path(__file__).resolve()
 script_dir = script_path.parent
 
-global logger
+logger = logging.getLogger("doipserver")
+
+# Counters for this process. With --workers every worker reports its own to the supervisor
+stats = ServerStats()
+STATS_REPORT_INTERVAL = 5.0
+
+# Writes the images of RequestDownload/TransferData for every connection of this process
+image_writer = ImageWriter()
 
-def setup_logger():
+def setup_logger(level=logging.DEBUG):
 
+    # The lib modules log to children of this logger ("doipserver.uds" and so on), which
+    # share its level and handler
     logger = logging.getLogger("doipserver")
 
     # set the log level
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(level)
 
     # Create a stream processor and set the level
     stream_handler = logging.StreamHandler(sys.stdout)
@@ -54,184 +79,92 @@ def setup_logger():
     return logger
 
 
-class Parser:
-    """Implements state machine for DoIP transport layer.
+def log_doip_message(description, message):
+    payload_data = message.pack()
+    logger.debug(
+        "Sending DoIP {}: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
+            description,
+            payload_message_to_type[type(message)],
+            len(payload_data),
+            " ".join(f"{byte:02X}" for byte in payload_data),
+        )
+    )
 
-    See Table 16 "Generic DoIP header structure" of ISO 13400-2:2019 (E). While TCP transport
-    is reliable, the UDP broadcasts are not, so the state machine is a little more defensive
-    than one might otherwise expect. When using TCP, reads from the socket aren't guaranteed
-    to be exactly one DoIP message, so the running buffer needs to be maintained across reads
-    """
 
-    class ParserState(IntEnum):
-        READ_PROTOCOL_VERSION = 1
-        READ_INVERSE_PROTOCOL_VERSION = 2
-        READ_PAYLOAD_TYPE = 3
-        READ_PAYLOAD_SIZE = 4
-        READ_PAYLOAD = 5
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.rx_buffer = bytearray()
-        self.protocol_version = None
-        self.payload_type = None
-        self.payload_size = None
-        self.payload = bytearray()
-        self._state = Parser.ParserState.READ_PROTOCOL_VERSION
-
-    def push_bytes(self, data_bytes):
-        self.rx_buffer += data_bytes
-
-    def read_message(self, data_bytes):
-        self.rx_buffer += data_bytes
-        if self._state == Parser.ParserState.READ_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                self.payload = bytearray()
-                self.payload_type = None
-                self.payload_size = None
-                self.protocol_version = int(self.rx_buffer.pop(0))
-                self._state = Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION
-
-        if self._state == Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                inverse_protocol_version = int(self.rx_buffer.pop(0))
-                if inverse_protocol_version != (0xFF ^ self.protocol_version):
-                    logger.warning(
-                        "Bad DoIP Header - Inverse protocol version does not match. Ignoring."
-                    )
-                    # Bad protocol version inverse - shift the buffer forward
-                    self.protocol_version = inverse_protocol_version
-                else:
-                    self._state = Parser.ParserState.READ_PAYLOAD_TYPE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_TYPE:
-            if len(self.rx_buffer) >= 2:
-                self.payload_type = self.rx_buffer.pop(0) << 8
-                self.payload_type |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD_SIZE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_SIZE:
-            if len(self.rx_buffer) >= 4:
-                self.payload_size = self.rx_buffer.pop(0) << 24
-                self.payload_size |= self.rx_buffer.pop(0) << 16
-                self.payload_size |= self.rx_buffer.pop(0) << 8
-                self.payload_size |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD
-
-        if self._state == Parser.ParserState.READ_PAYLOAD:
-            remaining_bytes = self.payload_size - len(self.payload)
-            self.payload += self.rx_buffer[:remaining_bytes]
-            self.rx_buffer = self.rx_buffer[remaining_bytes:]
-            if len(self.payload) == self.payload_size:
-                self._state = Parser.ParserState.READ_PROTOCOL_VERSION
-                logger.debug(
-                    "Received DoIP Message. Type: 0x{:X}, Payload Size: {} bytes, Payload: {}".format(
-                        self.payload_type,
-                        self.payload_size,
-                        " ".join(f"{byte:02X}" for byte in self.payload),
-                    )
-                )
-                try:
-                    return payload_type_to_message[self.payload_type].unpack(
-                        self.payload, self.payload_size
-                    )
-                except KeyError:
-                    return ReservedMessage.unpack(
-                        self.payload_type, self.payload, self.payload_size
-                    )
-
-
-class DoIPVechileAnnouncementMessageBroadcast:
-    def __init__(
-        self,
-        vin_gid_sync_status=None,
-    ):
-        self._vin_sync_status = vin_gid_sync_status
+def log_stats(snapshot, description="Stats"):
+    """Log a stats snapshot (see ServerStats.snapshot()) with its cache hit rate"""
+    logger.info(f"{description}: {snapshot}, cache hit rate: {ServerStats.cache_hit_rate(snapshot):.1%}")
 
-    @staticmethod
-    def _pack_doip(protocol_version, payload_type, payload_data):
-        data_bytes = struct.pack(
-            "!BBHL",
-            protocol_version,
-            0xFF ^ protocol_version,
-            payload_type,
-            len(payload_data),
-        )
-        data_bytes += payload_data
-
-        return data_bytes
-
-    @classmethod
-    def send_vehicle_announcement(
-            cls, vin, logical_address, eid, gid, further_action_required, protocol_version=0x02, interval=1.0):
-        # Create a raw socket
-        sock = socket.socket(
-            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-
-        def send_message():
-            message = VehicleIdentificationResponse(
-                vin, logical_address, eid, gid, further_action_required)
-
-            payload_data = message.pack()
-            payload_type = payload_message_to_type[type(message)]
-
-            data_bytes = cls._pack_doip(
-                protocol_version, payload_type, payload_data)
-
-            # Create UDP header
-            source_port = UDP_DISCOVERY  # Replace with your source port
-            dest_port = UDP_DISCOVERY
-            length = 8 + len(data_bytes)  # UDP Header size + Data size
-            checksum = 0  # Checksum (optional)
-
-            udp_header = struct.pack(
-                '!HHHH', source_port, dest_port, length, checksum)
-
-            # Combine UDP header and data
-            packet = udp_header + data_bytes
-
-            # logger.debug(
-            #     "Sending DoIP Vehicle Announment Message: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-            #         payload_type,
-            #         len(payload_data),
-            #         " ".join(f"{byte:02X}" for byte in payload_data),
-            #     )
-            # )
-            #sock.sendto(packet, ('<broadcast>', dest_port))
-            #sock.sendto(packet, ('10.0.3.255', dest_port))
-            with open(f"{script_dir}/diag-config.json") as f:
-                diag_config = json.loads(f.read())
-                sock.sendto(packet, (diag_config['server']['broadcast_address'], dest_port))
 
-            # Reschedule the function after `interval` seconds
-            # threading.Timer(interval, send_message).start()
+# Where vehicles on loopback aliases announce themselves, they can't reach any other network
+LOOPBACK_BROADCAST = "127.255.255.255"
+
 
-        # Start the thread
-        send_message()
+def broadcast_address():
+    """Address the vehicle announcements are broadcast to, from diag-config.json"""
+    with open(f"{script_dir}/diag-config.json") as f:
+        diag_config = json.loads(f.read())
+    return diag_config['server']['broadcast_address']
 
 
-def send_vehicle_announcement(vin, logical_address, eid, gid, further_action_required=0, protocol_version=0x02, interval=2.0):
-    DoIPVechileAnnouncementMessageBroadcast.send_vehicle_announcement(
-            vin, logical_address, eid, gid, further_action_required, protocol_version, interval)
+def start_periodic_task_send_vehicle_announcement(transport, clock, vin, logical_address, eid, gid, further_action_required=0, protocol_version=0x02, interval=2.0, jitter="uniform"):
+    """Start announcing an entity through its UDP discovery transport, so the announcements
+    come from the UDP_DISCOVERY port like the responses do. The announcement is packed once
+    up front, see AnnouncementScheduler for the schedule
 
-def start_periodic_task_send_vehicle_announcement(vin, logical_address, eid, gid, further_action_required=0, protocol_version=0x02, interval=2.0):
-    send_vehicle_announcement(vin, logical_address, eid, gid, further_action_required, protocol_version, interval)
-    reactor.callLater(interval, start_periodic_task_send_vehicle_announcement, vin, logical_address, eid, gid, further_action_required, protocol_version, interval)
+    :rtype: AnnouncementScheduler
+    """
+    address = (broadcast_address(), UDP_DISCOVERY)
+    transport.setBroadcastAllowed(True)
+
+    def send(packets):
+        for packet in packets:
+            transport.write(packet, address)
+
+    message = VehicleIdentificationResponse(vin, logical_address, eid, gid, further_action_required)
+    scheduler = AnnouncementScheduler(clock, send, interval, jitter)
+    scheduler.add(message.pack_frame(protocol_version))
+    return scheduler
+
+def start_fleet_announcements(fleet, clock, interval=2.0, jitter="uniform"):
+    """Start announcing every vehicle of a fleet from one UDP socket. Announcements that fall
+    due together go out with a single sendmmsg() call, each one from its vehicle's address.
+    Vehicles on loopback addresses announce on LOOPBACK_BROADCAST instead of the broadcast
+    address in diag-config.json
+
+    :return: The scheduler and the socket, for the caller to stop and close
+    :rtype: tuple
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setblocking(False)
+    broadcast = broadcast_address()
+    scheduler = AnnouncementScheduler(clock, lambda datagrams: sendmmsg(sock, datagrams), interval, jitter)
+    for index in range(len(fleet)):
+        host, _ = fleet.bind_address(index)
+        destination = broadcast if routable_source(host, broadcast) else LOOPBACK_BROADCAST
+        message = VehicleIdentificationResponse(
+            fleet.vin(index), fleet.logical_addresses[index], fleet.eid(index), fleet.gid(index), 0)
+        scheduler.add(Datagram(message.pack_frame(), (destination, UDP_DISCOVERY), source=host))
+    return scheduler, sock
 
 class DoIPUDPServer(DatagramProtocol):
-    def __init__(self, vin, logical_address, eid, gid, further_action_required=0):
-        self.host_ip = self.get_host_ip()
-        logger.info(f"Host IP: {self.host_ip}")
+    def __init__(self, vin, logical_address, eid, gid, further_action_required=0, host_ip=None, factory=None):
+        if host_ip is None:
+            host_ip = self.get_host_ip()
+            logger.info(f"Host IP: {host_ip}")
+        self.host_ip = host_ip
         self.vin = vin
         self.logical_address = logical_address
         self.eid = eid
         self.gid = gid
         self.further_action_required = further_action_required
+        # TCP factory of the same entity, the entity status reports its sockets
+        self.factory = factory
+        self._identification_frame = None
 
-    def get_host_ip(self):
+    @staticmethod
+    def get_host_ip():
         try:
             with open(f"{script_dir}/diag-config.json") as f:
                 diag_config = json.loads(f.read())
@@ -246,19 +179,6 @@ class DoIPUDPServer(DatagramProtocol):
             s.close()
         return IP
 
-    @staticmethod
-    def _pack_doip(payload_type, payload_data, protocol_version=0x02):
-        data_bytes = struct.pack(
-            "!BBHL",
-            protocol_version,
-            0xFF ^ protocol_version,
-            payload_type,
-            len(payload_data),
-        )
-        data_bytes += payload_data
-
-        return data_bytes
-
     def startProtocol(self):
         # Called when the UDP server starts
         logger.info("UDP Server started")
@@ -267,310 +187,846 @@ class DoIPUDPServer(DatagramProtocol):
         # Called when the UDP server stops
         logger.info("UDP Server stopped")
 
+    def entity_status(self):
+        factory = self.factory
+        if factory is None:
+            # Without a TCP side to report on, the default limit and no open sockets
+            return EntityStatusResponse(0, MAX_CONCURRENT_SOCKETS, 0, None)
+        return EntityStatusResponse(0, factory.max_sockets, len(factory.protocols), factory.max_data_size)
+
+    def identification_frame(self):
+        """The framed VehicleIdentificationResponse, packed on first use"""
+        if self._identification_frame is None:
+            self._identification_frame = VehicleIdentificationResponse(
+                self.vin, self.logical_address, self.eid, self.gid, self.further_action_required).pack_frame()
+        return self._identification_frame
+
+    def _identify(self, payload):
+        return self.identification_frame()
+
+    def _identify_eid(self, payload):
+        # Requests with an EID or a VIN only get an answer from the entity they name
+        if payload == self.eid:
+            return self.identification_frame()
+        return None
+
+    def _identify_vin(self, payload):
+        if payload.decode("ascii", "replace") == self.vin:
+            return self.identification_frame()
+        return None
+
+    def _report_status(self, payload):
+        return self.entity_status().pack_frame()
+
+    def _ignore(self, payload):
+        return None
+
+    # Requests served on UDP by payload type: the handler, which returns the framed answer or
+    # None, and the payload length the request must have
+    requests = {
+        0x0001: (_identify, 0),
+        0x0002: (_identify_eid, 6),
+        0x0003: (_identify_vin, 17),
+        0x4001: (_report_status, 0),
+        # Other entities' vehicle announcements
+        0x0004: (_ignore, None),
+    }
+
     def datagramReceived(self, datagram, addr):
-        # Filter sessions with a specified port number, for example, source port number 12345
         if addr[0] == self.host_ip:
-            # logger.info(f"Ignored: {datagram} from {addr}")
-            return  # Do not process data fro this port
-
-        # Called when the UDP server receives data
-        logger.info(f"Received: {datagram} from {addr}")
-        parser = Parser()
-        parser.reset()
-        result = parser.read_message(datagram)
-        flag = 0
-        if result:
-            if type(result) == VehicleIdentificationRequest:
-                logger.info(f"Received VehicleIdentificationRequest: {result}")
-                flag = 1
-            elif type(result) == VehicleIdentificationRequestWithEID:
-                logger.info(
-                    f"Received VehicleIdentificationRequestWithEID: {result}")
-                flag = 1
-            elif type(result) == VehicleIdentificationRequestWithVIN:
-                logger.info(
-                    f"Received VehicleIdentificationRequestWithVIN: {result}")
-                flag = 1
-            elif type(result) == DoipEntityStatusRequest:
-                logger.info(f"Received DoipEntityStatusRequest: {result}")
-                flag = 2
-            else:
-                logger.info(f"Received Unknown Message: {result}")
-                flag = 0
-        if flag == 1:
-            message = VehicleIdentificationResponse(
-                self.vin, self.logical_address, self.eid, self.gid, self.further_action_required)
-        elif flag == 2:
-            message = EntityStatusResponse(0, 1, 1)
-        else:
-            message = GenericDoIPNegativeAcknowledge(1)
-
-        payload_data = message.pack()
-        payload_type = payload_message_to_type[type(message)]
-        data_bytes = self._pack_doip(payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP Vehicle Identification Request: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
-            )
-        )
-
-        # Here you can process the received data or reply to the client as needed
-        self.transport.write(data_bytes, addr)
+            # Our own announcements
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received {datagram.hex(' ')} from {addr}")
+        # "Only one DoIP message shall be transmitted by any DoIP entity per datagram", so the
+        # header is decoded in place and the payload is the rest of the datagram
+        if len(datagram) < DOIP_HEADER.size:
+            return self._nack(GenericDoIPNegativeAcknowledge.NackCodes.IncorrectPatternFormat, addr)
+        protocol_version, inverse_protocol_version, payload_type, payload_length = (
+            DOIP_HEADER.unpack_from(datagram))
+        if inverse_protocol_version != (0xFF ^ protocol_version):
+            return self._nack(GenericDoIPNegativeAcknowledge.NackCodes.IncorrectPatternFormat, addr)
+        request = self.requests.get(payload_type)
+        if request is None:
+            return self._nack(GenericDoIPNegativeAcknowledge.NackCodes.UnknownPayloadType, addr)
+        handler, expected_length = request
+        if payload_length != len(datagram) - DOIP_HEADER.size or (
+                expected_length is not None and payload_length != expected_length):
+            return self._nack(GenericDoIPNegativeAcknowledge.NackCodes.InvalidPayloadLength, addr)
+        frame = handler(self, datagram[DOIP_HEADER.size:])
+        if frame is not None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Sending {frame.hex(' ')} to {addr}")
+            self.transport.write(frame, addr)
+
+    def _nack(self, nack_code, addr):
+        message = GenericDoIPNegativeAcknowledge(nack_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            log_doip_message("Vehicle Identification Request", message)
+        self.transport.write(message.pack_frame(), addr)
 
 # TCP server logic
 
 
 class DoIPTCPServer(Protocol):
-    def __init__(self, vin, logical_address, eid, gid, further_action_required=0):
+    # Schedules delayed calls such as running routines. The asyncio engine replaces it with
+    # the event loop
+    clock = reactor
+    # Writer thread the images of downloads go through, shared by the connections
+    image_writer = image_writer
+
+    def __init__(self, vin, logical_address, eid, gid, further_action_required=0, gateway=None):
         self.vin = vin
         self.logical_address = logical_address
         self.eid = eid
         self.gid = gid
         self.further_action_required = further_action_required
-        # [Fix error] due to the python version
-        #self.seed = random.randbytes(3)
-        self.seed = os.urandom(3)
-        #self.max_number_of_block_length = 0x0fa2  # Maximum block length for downloading data to ECU
-        self.max_number_of_block_length = 0x1000  # Maximum block length for downloading data to ECU (4K)
-        #self.max_number_of_block_length = 0x4000  # Maximum block length for downloading data to ECU (16K)
-        #self.max_number_of_block_length = 0x10000  # Maximum block length for downloading data to ECU (64K)
-        self.auth_flag = False
+        # Diagnostic messages are routed to ECU models by target address. Without a gateway
+        # this connection serves a single ECU which answers any target address
+        self.gateway = gateway or Gateway.single(vin, logical_address)
+        # Security access and other per ECU state of this connection, by logical address
+        self.sessions = {}
+        # Responses still to be sent on this connection, such as running routines
+        self.pending_responses = set()
+        # Whether reading is paused until the image writer catches up
+        self.paused_for_writer = False
+        # The framer lives as long as the connection so messages can span TCP reads. UDS
+        # payloads are handed to the handlers as views over the received data. Messages longer
+        # than the entity's max data size are never buffered
+        self.framer = DoIPFramer(zero_copy=True, max_payload_length=self.gateway.max_data_size)
 
     def connectionMade(self):
         peer = self.transport.getPeer()
         logger.info(f"TCP: Connection made from {peer.host}:{peer.port}")
         self.append_file_name = str(peer.host) + '_' + str(peer.port) + '.bin'
         logger.info(f"Append to file: {self.append_file_name}")
-
-    @staticmethod
-    def _pack_doip(payload_type, payload_data, protocol_version=0x02):
-        data_bytes = struct.pack(
-            "!BBHL",
-            protocol_version,
-            0xFF ^ protocol_version,
-            payload_type,
-            len(payload_data),
-        )
-        data_bytes += payload_data
-
-        return data_bytes
+        stats.connections += 1
+        stats.active_connections += 1
+        # The connection's timeouts run on the timing wheel every connection on the clock
+        # shares. Until routing activation T_TCP_Initial_Inactivity applies, then
+        # T_TCP_General_Inactivity, checked against the tick of the last received data
+        self.timers = timing_wheel(self.clock)
+        self.last_activity = self.timers.ticks
+        self.routing_activated = False
+        self.inactivity_timer = self.timers.schedule(T_TCP_INITIAL_INACTIVITY, self._initial_inactivity)
+        self.alive_check_timer = None
+        if self.factory is not None:
+            self.factory.protocols.add(self)
+
+    def connectionLost(self, reason=None):
+        self.connected = 0
+        stats.active_connections -= 1
+        if self.factory is not None:
+            self.factory.protocols.discard(self)
+        self.inactivity_timer.cancel()
+        if self.alive_check_timer is not None:
+            self.alive_check_timer.cancel()
+        for pending in list(self.pending_responses):
+            pending.cancel()
+        for session in self.sessions.values():
+            session.close()
+
+    def _write_message(self, message, description):
+        # The header and payload parts go out as separate buffers, so large payloads such
+        # as UDS responses are never concatenated into a new bytes object
+        if logger.isEnabledFor(logging.DEBUG):
+            log_doip_message(description, message)
+        buffers = message.pack_buffers()
+        stats.bytes_sent += sum(len(buffer) for buffer in buffers)
+        self.transport.writeSequence(buffers)
 
     def _send_routing_activation_response(self, client_logical_address, logical_address, code):
         message = RoutingActivationResponse(
             client_logical_address, logical_address, code)
-        payload_data = message.pack()
-        payload_type = payload_message_to_type[type(message)]
-        data_bytes = self._pack_doip(payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP Routing activation response: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
-            )
-        )
-        self.transport.write(data_bytes)
+        self._write_message(message, "Routing activation response")
 
     def _send_diagnostic_acknowledgement(self, source_address, target_address, ack_code):
         message = DiagnosticMessagePositiveAcknowledgement(
             source_address, target_address, ack_code)
-        payload_data = message.pack()
-        payload_type = payload_message_to_type[type(message)]
-        data_bytes = self._pack_doip(payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP DiagnosticMessagePositiveAcknowledge: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
-            )
-        )
-        self.transport.write(data_bytes)
-        self.transport.doWrite()
+        self._write_message(message, "DiagnosticMessagePositiveAcknowledge")
+
 
+    def _send_diagnostic_negative_acknowledgement(self, source_address, target_address, nack_code):
+        message = DiagnosticMessageNegativeAcknowledgement(
+            source_address, target_address, nack_code)
+        self._write_message(message, "DiagnosticMessageNegativeAcknowledge")
 
     def _send_diagnostic_message(self, source_address, target_address, user_data):
         message = DiagnosticMessage(
             source_address, target_address, user_data)
-        payload_data = message.pack()
-        payload_type = payload_message_to_type[type(message)]
-        data_bytes = self._pack_doip(payload_type, payload_data)
-        logger.debug(
-            "Sending DoIP DiagnosticMessage: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
-            )
-        )
-        self.transport.write(data_bytes)
+        self._write_message(message, "DiagnosticMessage")
     
-    def _send_uds_response(self, source_address, target_address, service, code, data):
-        # Make sure data is of bytes type
-        if isinstance(data, bytearray):
-            data = bytes(data)
-        uds_response = Response(service, code, data).get_payload()
-        logger.info(f"UDS Response: {uds_response}")
-        self._send_diagnostic_message(source_address, target_address, uds_response)
-
-    def append_to_file(self, data):
+    def send_uds_response(self, session, uds_response):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"UDS Response: {bytes(uds_response[:20])}")
+        self._send_diagnostic_message(session.ecu.logical_address, session.tester_address, uds_response)
+
+    def send_uds_response_parts(self, session, parts):
+        """Send a UDS response made up of several buffers, such as a TransferData block served
+        from an uploaded image. The asyncio engine sends them without joining them. Twisted
+        copies them into its write buffer"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"UDS Response: {bytes(parts[0][:20])} + {sum(len(part) for part in parts[1:])} bytes")
+        buffers = DiagnosticMessage.pack_parts(session.ecu.logical_address, session.tester_address, parts)
+        stats.bytes_sent += sum(len(buffer) for buffer in buffers)
+        if not getattr(self.transport, "writes_buffers", False):
+            # Twisted only takes bytes, and joins what it's given before sending anyway
+            buffers = [bytes(buffer) for buffer in buffers]
+        self.transport.writeSequence(buffers)
+
+    def _session(self, ecu, tester_address):
+        session = self.sessions.get(ecu.logical_address)
+        if session is not None:
+            session.tester_address = tester_address
+        else:
+            if self.gateway.default is not None:
+                append_file_name = self.append_file_name
+            else:
+                # Every ECU behind a gateway gets its own image
+                append_file_name = f"{self.append_file_name[:-4]}_{ecu.logical_address:04X}.bin"
+            session = self.sessions[ecu.logical_address] = EcuSession(ecu, tester_address, append_file_name)
+        return session
+
+    def _idle_ticks_left(self, since, timeout):
+        """Ticks until `timeout` seconds have gone by since activity stamped with the tick
+        `since`. The activity may have come just before the next tick, hence the one more"""
+        return self.timers.ticks_for(timeout) + 1 - (self.timers.ticks - since)
+
+    def _initial_inactivity(self):
+        logger.info("TCP: No routing activation within T_TCP_Initial_Inactivity, closing")
+        self.transport.loseConnection()
+
+    def _general_inactivity(self):
+        left = self._idle_ticks_left(self.last_activity, T_TCP_GENERAL_INACTIVITY)
+        if left > 0:
+            self.inactivity_timer = self.timers.schedule(left * self.timers.tick, self._general_inactivity)
+            return
+        logger.info("TCP: T_TCP_General_Inactivity expired, closing")
+        self.transport.loseConnection()
+
+    def _routing_activated(self):
+        if not self.routing_activated:
+            self.routing_activated = True
+            self.inactivity_timer.cancel()
+            self.inactivity_timer = self.timers.schedule(T_TCP_GENERAL_INACTIVITY, self._general_inactivity)
+
+    def alive_check(self):
+        """Send an AliveCheckRequest. The connection is closed unless the tester answers
+        within T_TCP_Alive_Check"""
+        if self.alive_check_timer is None:
+            self.alive_check_timer = self.timers.schedule(T_TCP_ALIVE_CHECK, self._alive_check_expired)
+            self._write_message(AliveCheckRequest(), "Alive check request")
+
+    def _alive_check_expired(self):
+        self.alive_check_timer = None
+        logger.info("TCP: No alive check response within T_TCP_Alive_Check, closing")
+        # Don't wait for what's left in the send buffer of a tester that's gone
+        self.transport.abortConnection()
+
+    def _watch_session(self, session):
+        # S3server: an ECU outside of the default session falls back to it when no request
+        # comes in for S3_SERVER seconds
+        session.last_request = self.timers.ticks
+        if session.diagnostic_session != 0x01 and session.s3_timer is None:
+            session.s3_timer = self.timers.schedule(S3_SERVER, self._s3_expired, session)
+
+    def _s3_expired(self, session):
+        session.s3_timer = None
+        if session.diagnostic_session == 0x01:
+            return
+        left = self._idle_ticks_left(session.last_request, S3_SERVER)
+        if left > 0:
+            session.s3_timer = self.timers.schedule(left * self.timers.tick, self._s3_expired, session)
+            return
+        logger.info(f"{session.ecu}: S3server expired, back to the default session")
+        session.reset_session()
+
+    def pause_for_writer(self):
+        """Stop reading from the tester until the image writer has drained its queue, so a
+        fast tester can't queue up more TransferData than the disk keeps up with"""
+        if self.paused_for_writer:
+            return
+        self.paused_for_writer = True
+        self.transport.pauseProducing()
+        self.image_writer.notify_when_drained(lambda: self.clock.callFromThread(self._writer_drained))
+
+    def _writer_drained(self):
+        self.paused_for_writer = False
+        if self.connected:
+            self.transport.resumeProducing()
+
+    def append_to_file(self, file_path, data):
         """
         Appends data to the specified file. If the file does not exist, it is created
         
         :param file_path: the path of the file
         :param data: data to be written
         """
-        with open(self.append_file_name, 'ab') as file:
+        with open(file_path, 'ab') as file:
             file.write(data)
 
-    def _uds_request_handler(self, source_address, target_address, user_data):
-        logger.info(f"Received UDS Message: {user_data}  len: {len(user_data)} {type(user_data)}")
-        request = Request.from_payload(user_data)
-        if request is not None and request.service is not None and request.suppress_positive_response is not True:
-            code = 0
-            subfunction = request.subfunction
-            data = b''
-            if request.service == ECUReset:
-                logger.info(
-                    f"Received ECUReset, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                data = subfunction.to_bytes(1, byteorder='big')
-
-            elif request.service == TesterPresent:
-                logger.info(
-                    f"Received TesterPresent, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                data = subfunction.to_bytes(1, byteorder='big')
-
-            elif request.service == DiagnosticSessionControl:
-                logger.info(
-                    f"Received DiagnosticSessionControl, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                #data = subfunction.to_bytes(1, byteorder='big') + b'\x00\x19\x01\xf4'  # p2-default(25ms), p2-star(5000ms)
-                data = subfunction.to_bytes(1, byteorder='big') + b'\x00\x32\x01\xf4'   # p2-default(50ms), p2-star(5000ms)
-
-            elif request.service == ReadDataByIdentifier:
-                logger.info(
-                    f"Received ReadDataByIdentifier, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                id_value = b'\x00'
-                id = int.from_bytes(request.data, byteorder='big')
-                if id == DataIdentifier.ActiveDiagnosticSession:
-                    id_value = b'\x02'
-                elif id == DataIdentifier.VIN:
-                    id_value = self.vin.encode()
-                data = request.data + id_value
-            
-            elif request.service == SecurityAccess:
-                logger.info(
-                    f"Received SecurityAccess, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                logger.info(f"SecurityAccess: {request}  {request.data}")
-                if subfunction == 0x01:
-                    if self.auth_flag == False:
-                        data = subfunction.to_bytes(1, byteorder='big') + self.seed
-                    elif self.auth_flag == True:
-                        data = subfunction.to_bytes(1, byteorder='big') + int(0).to_bytes(3, byteorder='big')
-                elif subfunction == 0x02:
-                    data = subfunction.to_bytes(1, byteorder='big')
-                    self.auth_flag = True
-                logger.info(f"request.data: {request.data}")
-            
-            elif request.service == RequestDownload:
-                logger.info(
-                    f"Received RequestDownload, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                logger.info(' '.join([f'{byte:02x}' for byte in request.data]))
-                #data = b'\x20' + self.max_number_of_block_length.to_bytes(2, byteorder='big')
-                data = b'\x20' + self.max_number_of_block_length.to_bytes(4, byteorder='big')
-            
-            elif request.service == TransferData:
-                logger.info(
-                    f"Received TransferData, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                self.append_to_file(request.data[1:])
-                # First send a response is pending message
-                #code = Response.Code.RequestCorrectlyReceived_ResponsePending
-                #data = None
-                #self._send_uds_response(source_address, target_address, request.service, code, data)
-                #self.transport.doWrite()
-                #time.sleep(0.1)
-                code = Response.Code.PositiveResponse
-                data = request.data[0].to_bytes(1, byteorder='big')
-            
-            elif request.service == RequestTransferExit:
-                logger.info(
-                    f"Received RequestTransferExit, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                code = Response.Code.PositiveResponse
-                data = None
-            
-            elif request.service == RoutineControl:
-                logger.info(
-                    f"Received RoutineControl, request.subfunction: {request.subfunction}, suppress_positive_response: {request.suppress_positive_response}")
-                logger.info(' '.join([f'{byte:02x}' for byte in request.data]))
-                rid = int.from_bytes(request.data[:2], byteorder='big')
-                # First send a response is pending message
-                code = Response.Code.RequestCorrectlyReceived_ResponsePending
-                data = None
-                self._send_uds_response(source_address, target_address, request.service, code, data)
-                self.transport.doWrite()
-                time.sleep(0.1)
-                code = Response.Code.PositiveResponse
-                if rid == Routine.EraseMemory:
-                    logger.info("RoutineControl: EraseMemory")
-                    data = subfunction.to_bytes(1, byteorder='big') + request.data[0:2] + b'\x10'
-                else:
-                    data = subfunction.to_bytes(1, byteorder='big') + request.data[0:2] + b'\x10\x00'
-            
-            if request.suppress_positive_response is not True :
-                self._send_uds_response(source_address, target_address, request.service, code, data)
+    def _uds_request_handler(self, session, user_data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received UDS Message: {bytes(user_data[:20])}  len: {len(user_data)}")
+        stats.uds_requests += 1
+        uds_response = handle_request(self, session, user_data)
+        if uds_response is not None:
+            self.send_uds_response(session, uds_response)
+
+    def _cached_uds_request_handler(self, session, user_data):
+        # Replies to cacheable services are kept fully framed, acknowledgement included, and
+        # keyed on everything they depend on. A hit is a single write, and replays the session
+        # state the request left behind the first time
+        ecu = session.ecu
+        key = (session.tester_address, session.state, bytes(user_data))
+        entry = ecu.response_cache.get(key)
+        if entry is None:
+            stats.cache_misses += 1
+            uds_response = handle_request(self, session, user_data)
+            frames = DiagnosticMessagePositiveAcknowledgement(
+                ecu.logical_address, session.tester_address, 0).pack_frame()
+            if uds_response is not None:
+                frames += DiagnosticMessage(
+                    ecu.logical_address, session.tester_address, uds_response).pack_frame()
+            entry = (frames, session.state)
+            ecu.response_cache.put(key, entry)
+        else:
+            stats.cache_hits += 1
+            session.state = entry[1]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"UDS Message: {bytes(user_data[:20])}, reply frames: {entry[0].hex()}")
+        stats.uds_requests += 1
+        stats.bytes_sent += len(entry[0])
+        self.transport.write(entry[0])
 
     def dataReceived(self, data):
-        logger.info(f"TCP: Received {data[:20]}")
-        parser = Parser()
-        parser.reset()
-        result = parser.read_message(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"TCP: Received {data[:20]}")
+        stats.bytes_received += len(data)
+        self.last_activity = self.timers.ticks
+        for result in self.framer.feed(data):
+            stats.doip_messages += 1
+            self._doip_message_handler(result)
+
+    def _doip_message_handler(self, result):
         if result:
+            if type(result) == OversizedMessage:
+                logger.warning(
+                    f"Discarded a message of {result.payload_length} bytes, the max data size is {self.gateway.max_data_size}")
+                self._write_message(
+                    GenericDoIPNegativeAcknowledge(GenericDoIPNegativeAcknowledge.NackCodes.MessageTooLarge),
+                    "Generic DoIP header negative acknowledge")
+                return
+
+            if type(result) == AliveCheckResponse:
+                if self.alive_check_timer is not None:
+                    self.alive_check_timer.cancel()
+                    self.alive_check_timer = None
+                return
+
             # Routing activation request
             if type(result) == RoutingActivationRequest:
                 logger.info(f"Received RoutingActivationRequest: {result}")
                 source_address = result.source_address
                 self._send_routing_activation_response(
-                    source_address, self.logical_address, RoutingActivationResponse.ResponseCode.Success)
+                    source_address, self.gateway.logical_address, RoutingActivationResponse.ResponseCode.Success)
+                self._routing_activated()
 
             # Diagnostic messages
             if type(result) == DiagnosticMessage:
-                logger.info(f"Received DiagnosticMessage: {result}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Received DiagnosticMessage: {result}")
                 source_address = result.source_address
                 user_data = result.user_data  # uds message
 
-                # Diagnostic message reply
-                self._send_diagnostic_acknowledgement(
-                    self.logical_address, source_address, 0)
+                ecu = self.gateway.route(result.target_address)
+                if ecu is None:
+                    logger.warning(f"No ECU with logical address 0x{result.target_address:04X}")
+                    self._send_diagnostic_negative_acknowledgement(
+                        result.target_address, source_address,
+                        DiagnosticMessageNegativeAcknowledgement.NackCodes.UnknownTargetAddress)
+                    return
+
+                session = self._session(ecu, source_address)
+                if user_data and user_data[0] in ecu.cacheable:
+                    self._cached_uds_request_handler(session, user_data)
+                else:
+                    # Diagnostic message reply
+                    self._send_diagnostic_acknowledgement(
+                        ecu.logical_address, source_address, 0)
 
-                # UDS MESSAGE processing
-                self._uds_request_handler(
-                    self.logical_address, source_address, user_data)
+                    # UDS MESSAGE processing
+                    self._uds_request_handler(session, user_data)
+                self._watch_session(session)
 
 class DoIPFactory(Factory):
-    def __init__(self, vin, logical_address, eid, gid, further_action_required=0):
+    """Builds a DoIPTCPServer for every tester connection while the entity has a free socket.
+
+    With all max_sockets in use a new connection is refused, and the existing ones get an
+    alive check. Those whose tester doesn't answer are closed, which frees their sockets for
+    the next attempt
+    """
+
+    def __init__(self, vin, logical_address, eid, gid, further_action_required=0, gateway=None):
         self.vin = vin
         self.logical_address = logical_address
         self.eid = eid
         self.gid = gid
         self.further_action_required = further_action_required
+        self.gateway = gateway or Gateway.single(vin, logical_address)
+        self.max_sockets = self.gateway.max_sockets
+        self.max_data_size = self.gateway.max_data_size
+        # Open connections of the entity
+        self.protocols = set()
 
     def buildProtocol(self, addr):
-        return DoIPTCPServer(self.vin, self.logical_address, self.eid, self.gid, self.further_action_required)
+        if len(self.protocols) >= self.max_sockets:
+            self._refuse()
+            return None
+        protocol = self._build()
+        protocol.factory = self
+        return protocol
+
+    def _build(self):
+        return DoIPTCPServer(self.vin, self.logical_address, self.eid, self.gid, self.further_action_required, self.gateway)
+
+    def _refuse(self):
+        stats.connections_refused += 1
+        logger.info(f"TCP: All {self.max_sockets} sockets in use, refusing a connection")
+        for protocol in self.protocols:
+            protocol.alive_check()
+
+class FleetUDPServer(DoIPUDPServer):
+    """UDP discovery for one vehicle of a fleet. The identity is read from the fleet tables
+    when a request comes in, so an idle vehicle costs no more than its socket"""
+
+    def __init__(self, fleet, index, host_ip, factory, discovery):
+        self.fleet = fleet
+        self.index = index
+        self.host_ip = host_ip
+        self.further_action_required = 0
+        self.factory = factory
+        # Keeps the packed responses of the whole fleet
+        self.discovery = discovery
+
+    def identification_frame(self):
+        return self.discovery.identification_frame(self.index)
+
+    @property
+    def vin(self):
+        return self.fleet.vin(self.index)
+
+    @property
+    def logical_address(self):
+        return self.fleet.logical_addresses[self.index]
+
+    @property
+    def eid(self):
+        return self.fleet.eid(self.index)
+
+    @property
+    def gid(self):
+        return self.fleet.gid(self.index)
+
+    def startProtocol(self):
+        pass
+
+    def stopProtocol(self):
+        pass
+
+class FleetDiscoveryServer(DatagramProtocol):
+    """Answers the vehicle identification requests broadcast to a fleet, for all of its
+    vehicles from one socket.
+
+    The vehicles' own endpoints are bound to their unicast addresses and never see
+    broadcasts. This one is bound to the broadcast address. A request with a VIN or an EID is
+    looked up in the fleet's index and only the vehicles it names answer. A plain request gets
+    an answer from every vehicle, sent in sendmmsg() batches, each from its vehicle's address.
+    Vehicles on loopback addresses can't reach a tester on another network, their answers to
+    one come from an address the kernel picks. Every vehicle's response is packed once, on
+    first use.
+
+    :param fleet: The vehicles
+    :type fleet: Fleet
+    :param sock: The bound socket the protocol is served on, which the answers are sent from.
+        Without one it only keeps the packed responses for the vehicles' own endpoints
+    :type sock: socket.socket, optional
+    """
+
+    def __init__(self, fleet, sock=None):
+        self.fleet = fleet
+        self.sock = sock
+        self._frames = {}
+
+    def identification_frame(self, index):
+        frame = self._frames.get(index)
+        if frame is None:
+            fleet = self.fleet
+            frame = self._frames[index] = VehicleIdentificationResponse(
+                fleet.vin(index), fleet.logical_addresses[index], fleet.eid(index), fleet.gid(index), 0).pack_frame()
+        return frame
+
+    # Vehicle identification requests by payload type: how to find the vehicles that answer
+    # from the payload, and the payload length the request must have. Anything else is
+    # ignored, including the fleet's own announcements
+    requests = {
+        0x0001: (lambda fleet, payload: range(len(fleet)), 0),
+        0x0002: (lambda fleet, payload: fleet.with_eid(payload), 6),
+        0x0003: (lambda fleet, payload: fleet.with_vin(payload.decode("ascii", "replace")), 17),
+    }
 
-def start_server(vin, logical_address, eid, gid, port=13400):
-    reactor.listenUDP(port, DoIPUDPServer(vin, logical_address, eid, gid))
-    logger.info(f"Listening on UDP port {port}")
+    def datagramReceived(self, datagram, addr):
+        if len(datagram) < DOIP_HEADER.size:
+            return
+        protocol_version, inverse_protocol_version, payload_type, payload_length = (
+            DOIP_HEADER.unpack_from(datagram))
+        request = self.requests.get(payload_type)
+        if (request is None or inverse_protocol_version != (0xFF ^ protocol_version)
+                or payload_length != request[1] or payload_length != len(datagram) - DOIP_HEADER.size):
+            return
+        indices = request[0](self.fleet, datagram[DOIP_HEADER.size:])
+        sendmmsg(self.sock, [
+            Datagram(self.identification_frame(index), addr,
+                     routable_source(self.fleet.bind_address(index)[0], addr[0]))
+            for index in indices])
+
+def _fleet_discovery_socket(fleet):
+    """Socket for FleetDiscoveryServer on the broadcast address and the first vehicle's
+    port, or None when the broadcast address isn't local"""
+    address = (broadcast_address(), fleet.bind_address(0)[1])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(address)
+    except OSError as e:
+        sock.close()
+        logger.warning(f"Broadcast vehicle identification isn't served, can't bind {address}: {e}")
+        return None
+    sock.setblocking(False)
+    return sock
+
+class FleetFactory(DoIPFactory):
+    """Builds DoIPTCPServer protocols for one vehicle of a fleet.
+
+    Every vehicle is a copy of the template gateway (see Gateway.for_vehicle()), made when a
+    tester first connects to it, and has the template's limits.
+    """
 
-    factory = DoIPFactory(vin, logical_address, eid, gid)
-    reactor.listenTCP(port, factory)
+    def __init__(self, fleet, index, template):
+        self.fleet = fleet
+        self.index = index
+        self.template = template
+        self.gateway = None
+        self.max_sockets = template.max_sockets
+        self.max_data_size = template.max_data_size
+        self.protocols = set()
+
+    def _build(self):
+        fleet, index = self.fleet, self.index
+        if self.gateway is None:
+            self.gateway = self.template.for_vehicle(fleet.vin(index), fleet.logical_addresses[index])
+        return DoIPTCPServer(fleet.vin(index), fleet.logical_addresses[index], fleet.eid(index), fleet.gid(index),
+                             gateway=self.gateway)
+
+def _raise_open_files_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        soft = hard if hard == resource.RLIM_INFINITY else min(hard, max(needed, soft))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        logger.warning(f"Open files limit is {soft}, the fleet needs at least {needed}")
+
+def start_fleet(fleet, engine="twisted", announce=False, jitter="uniform", gateway=None):
+    """
+    Serve every vehicle of a fleet from this process until interrupted. Each vehicle gets a
+    TCP listener and a UDP discovery endpoint on its own address from the fleet tables.
+    Vehicle identification requests broadcast to the fleet are answered by a
+    FleetDiscoveryServer.
+
+    :param gateway: Template every vehicle is a copy of, by default a single ECU
+    :param announce: Send vehicle announcements for every vehicle, see start_fleet_announcements()
+    :param jitter: Distribution of the random announcement delays, a key of lib.announce.JITTER
+    """
+    # Two listening sockets per vehicle, plus room for tester connections
+    _raise_open_files_limit(2 * len(fleet) + 1024)
+    host_ip = DoIPUDPServer.get_host_ip()
+    if gateway is None:
+        gateway = Gateway.single(fleet.vin(0), fleet.logical_addresses[0])
+
+    if engine == "twisted":
+        discovery = FleetDiscoveryServer(fleet, _fleet_discovery_socket(fleet))
+        if discovery.sock is not None:
+            BatchedDatagramPort(discovery.sock, discovery).start_reactor(reactor)
+        for index in range(len(fleet)):
+            host, port = fleet.bind_address(index)
+            factory = FleetFactory(fleet, index, gateway)
+            reactor.listenUDP(port, FleetUDPServer(fleet, index, host_ip, factory, discovery), interface=host)
+            reactor.listenTCP(port, factory, interface=host)
+        if announce:
+            start_fleet_announcements(fleet, reactor, jitter=jitter)
+        logger.info(f"Serving {len(fleet)} vehicles")
+        reactor.run()
+        return
+
+    loop = new_event_loop(use_uvloop=(engine == "uvloop"))
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve_fleet_asyncio(fleet, host_ip, announce, jitter, gateway))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+async def serve_fleet_asyncio(fleet, host_ip=None, announce=False, jitter="uniform", gateway=None):
+    """
+    Serve every vehicle of a fleet on the running asyncio event loop until cancelled
+    """
+    loop = asyncio.get_running_loop()
+    if host_ip is None:
+        host_ip = DoIPUDPServer.get_host_ip()
+    if gateway is None:
+        gateway = Gateway.single(fleet.vin(0), fleet.logical_addresses[0])
+
+    udp_transports = []
+    tcp_servers = []
+    announcements = None
+    discovery = FleetDiscoveryServer(fleet, _fleet_discovery_socket(fleet))
+    discovery_port = None
+    try:
+        if discovery.sock is not None:
+            discovery_port = BatchedDatagramPort(discovery.sock, discovery)
+            discovery_port.start_loop(loop)
+        for index in range(len(fleet)):
+            host, port = fleet.bind_address(index)
+            factory = FleetFactory(fleet, index, gateway)
+            udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda index=index, factory=factory: DatagramProtocolAdapter(
+                    FleetUDPServer(fleet, index, host_ip, factory, discovery)),
+                local_addr=(host, port))
+            udp_transports.append(udp_transport)
+            tcp_servers.append(await loop.create_server(
+                lambda factory=factory: StreamProtocolAdapter(factory.buildProtocol(None)), host, port))
+        if announce:
+            announcements = start_fleet_announcements(fleet, loop_clock(loop), jitter=jitter)
+        logger.info(f"Serving {len(fleet)} vehicles")
+        await asyncio.Event().wait()
+    finally:
+        if announcements is not None:
+            scheduler, sock = announcements
+            scheduler.stop()
+            sock.close()
+        for tcp_server in tcp_servers:
+            tcp_server.close()
+        for udp_transport in udp_transports:
+            udp_transport.close()
+        if discovery_port is not None:
+            discovery_port.loseConnection()
+
+def _reuse_port_socket(host, port, backlog=50):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def _discovery_socket(host, port):
+    """Bound socket for a BatchedDatagramPort"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def start_server(vin, logical_address, eid, gid, port=13400, engine="twisted",
+                 reuse_port=False, discovery=True, report=None, gateway=None, jitter="uniform"):
+    """
+    Run the simulator until interrupted
+
+    :param engine: "twisted" for the Twisted reactor, "asyncio" for the asyncio event loop or
+        "uvloop" for asyncio on top of uvloop (when it is installed)
+    :param reuse_port: Listen on TCP with SO_REUSEPORT so several processes share the port
+    :param discovery: Serve UDP vehicle discovery and send vehicle announcements
+    :param report: Called with the stats snapshot every STATS_REPORT_INTERVAL seconds
+    :param gateway: ECUs to route diagnostic messages to, a single ECU at logical_address by default
+    :param jitter: Distribution of the random announcement delays, a key of lib.announce.JITTER
+    """
+    if engine == "twisted":
+        factory = DoIPFactory(vin, logical_address, eid, gid, gateway=gateway)
+        if discovery:
+            udp_port = BatchedDatagramPort(
+                _discovery_socket("", port), DoIPUDPServer(vin, logical_address, eid, gid, factory=factory))
+            udp_port.start_reactor(reactor)
+            logger.info(f"Listening on UDP port {port}")
+
+        if reuse_port:
+            sock = _reuse_port_socket("", port)
+            reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+            # The reactor works on its own duplicate of the descriptor
+            sock.close()
+        else:
+            reactor.listenTCP(port, factory)
+        logger.info(f"Listening on TCP port {port}")
+
+        if discovery:
+            start_periodic_task_send_vehicle_announcement(udp_port, reactor, vin, logical_address, eid, gid, jitter=jitter)
+        if report is not None:
+            LoopingCall(lambda: report(stats.snapshot())).start(STATS_REPORT_INTERVAL, now=False)
+        reactor.run()
+        return
+
+    loop = new_event_loop(use_uvloop=(engine == "uvloop"))
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve_asyncio(
+            vin, logical_address, eid, gid, port, announce=discovery, discovery=discovery,
+            reuse_port=reuse_port, report=report, gateway=gateway, jitter=jitter))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+async def serve_asyncio(vin, logical_address, eid, gid, port=13400, announce=True, host="0.0.0.0",
+                        discovery=True, reuse_port=False, report=None, gateway=None, jitter="uniform"):
+    """
+    Serve DoIP on the running asyncio event loop with the same protocol classes as the
+    Twisted engine. Runs until cancelled, so it can be started as a task from existing
+    asyncio code instead of through start_server()
+
+    :param announce: Broadcast vehicle announcements, see start_periodic_task_send_vehicle_announcement() and
+        lib.announce.AnnouncementScheduler
+    :param host: Address the TCP and UDP endpoints bind to
+    :param discovery: Serve UDP vehicle discovery
+    :param reuse_port: Listen on TCP with SO_REUSEPORT so several processes share the port
+    :param report: Called with the stats snapshot every STATS_REPORT_INTERVAL seconds
+    :param gateway: ECUs to route diagnostic messages to, a single ECU at logical_address by default
+    :param jitter: Distribution of the random announcement delays, a key of lib.announce.JITTER
+    """
+    loop = asyncio.get_running_loop()
+    tasks = []
+
+    factory = DoIPFactory(vin, logical_address, eid, gid, gateway=gateway)
+    udp_port = None
+    announcer = None
+    if discovery or announce:
+        # Announcing alone still takes a UDP socket to send from, just not the discovery port
+        udp_port = BatchedDatagramPort(
+            _discovery_socket(host, port if discovery else 0),
+            DoIPUDPServer(vin, logical_address, eid, gid, factory=factory))
+        udp_port.start_loop(loop)
+        if discovery:
+            logger.info(f"Listening on UDP port {port}")
+        if announce:
+            announcer = start_periodic_task_send_vehicle_announcement(
+                udp_port, loop_clock(loop), vin, logical_address, eid, gid, jitter=jitter)
+
+    tcp_server = await loop.create_server(
+        lambda: StreamProtocolAdapter(factory.buildProtocol(None)), host, port,
+        reuse_port=reuse_port or None)
     logger.info(f"Listening on TCP port {port}")
 
-    reactor.callLater(0, start_periodic_task_send_vehicle_announcement, vin, logical_address, eid, gid, 0, 2, 2)
-    reactor.run()
+    async def send_reports():
+        while True:
+            await asyncio.sleep(STATS_REPORT_INTERVAL)
+            report(stats.snapshot())
+
+    if report is not None:
+        tasks.append(loop.create_task(send_reports()))
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if announcer is not None:
+            announcer.stop()
+        if udp_port is not None:
+            udp_port.loseConnection()
+
+def run_worker(worker_id, ecu_conf, port, engine, discovery, reports, log_level=logging.DEBUG, writer_options=None,
+               jitter="uniform"):
+    """Entry point of a --workers process. Every worker serves TCP on the shared port, the one
+    with discovery also owns UDP discovery and the vehicle announcements"""
+    global logger
+    logger = setup_logger(log_level)
+    image_writer.configure(**(writer_options or {}))
+    # Leave Ctrl+C to the supervisor, it stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info(f"Worker {worker_id} started (pid {os.getpid()}, discovery: {discovery})")
+    gateway = Gateway.from_conf(ecu_conf)
+    ecu = ecu_conf['ECU']
+    start_server(ecu['vin'], gateway.logical_address, ecu['eid'], ecu['gid'], port, engine,
+                 reuse_port=True, discovery=discovery,
+                 report=lambda snapshot: reports.put((worker_id, snapshot)), gateway=gateway, jitter=jitter)
+
+def run_supervisor(ecu_conf, port=13400, engine="twisted", workers=2, restart_delay=1.0, log_level=logging.DEBUG,
+                   writer_options=None, jitter="uniform"):
+    """
+    Run `workers` server processes sharing the TCP port through SO_REUSEPORT, restart the
+    ones that die and log their summed up stats every STATS_REPORT_INTERVAL seconds.
+    Worker 0 (and whichever process replaces it) owns UDP discovery and announcements.
+
+    Workers are started with the spawn method, so each one gets a fresh reactor or event
+    loop instead of sharing the parent's poller.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("--workers needs SO_REUSEPORT, which this platform doesn't have")
+
+    context = multiprocessing.get_context("spawn")
+    reports = context.Queue()
+    processes = {}
+    started = {}
+    latest = {}
+    # Totals of the workers that are gone, so restarts don't make the counters go backwards
+    retired = {}
+
+    def start_worker(worker_id):
+        process = context.Process(
+            target=run_worker, name=f"doip-worker-{worker_id}",
+            args=(worker_id, ecu_conf, port, engine, worker_id == 0, reports, log_level, writer_options, jitter),
+            daemon=True)
+        process.start()
+        processes[worker_id] = process
+        started[worker_id] = time.monotonic()
+
+    def stop_supervisor(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop_supervisor)
+    for worker_id in range(workers):
+        start_worker(worker_id)
+
+    next_report = time.monotonic() + STATS_REPORT_INTERVAL
+    try:
+        while True:
+            try:
+                worker_id, snapshot = reports.get(timeout=restart_delay)
+                latest[worker_id] = snapshot
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for worker_id, process in processes.items():
+                if process.is_alive() or now - started[worker_id] < restart_delay:
+                    continue
+                logger.warning(f"Worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                if worker_id in latest:
+                    retired = ServerStats.merge([retired, ServerStats.retire(latest.pop(worker_id))])
+                start_worker(worker_id)
+
+            if now >= next_report:
+                next_report = now + STATS_REPORT_INTERVAL
+                totals = ServerStats.merge([retired, *latest.values()])
+                log_stats(totals, f"Stats ({len(processes)} workers)")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
 
 def load_ecu_conf():
     try:
@@ -590,13 +1046,54 @@ def load_ecu_conf():
 
 
 if __name__ == "__main__":
-    logger = setup_logger()
+    parser = argparse.ArgumentParser(description="DoIP ECU simulator")
+    parser.add_argument("--engine", choices=["twisted", "asyncio", "uvloop"], default="twisted",
+                        help="event loop to serve on (uvloop falls back to asyncio when not installed)")
+    parser.add_argument("--port", type=int, default=13400, help="TCP and UDP port")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="DEBUG also logs every DoIP and UDS message")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve from N processes sharing the port via SO_REUSEPORT")
+    parser.add_argument("--fleet", type=int, default=0,
+                        help="simulate N vehicles generated from the ECU section of yaml.conf")
+    parser.add_argument("--fleet-file",
+                        help="simulate the vehicles listed in a CSV file (vin, eid and optionally logicalAddress, gid)")
+    parser.add_argument("--fleet-bind", choices=["aliases", "ports"], default="aliases",
+                        help="give every vehicle its own loopback address (aliases) or its own port (ports)")
+    parser.add_argument("--fleet-host", default="127.0.1.1", help="address of the first vehicle")
+    parser.add_argument("--fleet-announce", action="store_true",
+                        help="send vehicle announcements for every vehicle of the fleet")
+    parser.add_argument("--announce-jitter", choices=list(JITTER), default="uniform",
+                        help="distribution of the random delays before vehicle announcements")
+    parser.add_argument("--fsync", choices=ImageWriter.FSYNC_POLICIES, default="never",
+                        help="fsync downloaded images never, on RequestTransferExit (exit) or after every write (always)")
+    parser.add_argument("--writer-queue", type=int, default=16, metavar="MB",
+                        help="pause reading from testers while more than MB of TransferData waits to be written")
+    args = parser.parse_args()
+
+    logger = setup_logger(args.log_level)
+    writer_options = {"max_pending": args.writer_queue << 20, "fsync": args.fsync}
+    image_writer.configure(**writer_options)
     ecu_conf = load_ecu_conf()
     if ecu_conf is None:
         exit(1)
+    gateway = Gateway.from_conf(ecu_conf)
     vin = ecu_conf['ECU']['vin']
-    logical_address = ecu_conf['ECU']['logicalAddress']
+    logical_address = gateway.logical_address
     eid = ecu_conf['ECU']['eid']
     gid = ecu_conf['ECU']['gid']
+    logger.info(f"ECUs: {list(gateway.ecus.values())}")
 
-    start_server(vin, logical_address, eid, gid)
+    if args.fleet > 0 or args.fleet_file:
+        if args.fleet_file:
+            fleet = Fleet.load(args.fleet_file, logical_address, gid)
+        else:
+            fleet = Fleet.generate(args.fleet, vin, logical_address, eid, gid)
+        fleet.assign_addresses(args.fleet_host, args.port, args.fleet_bind)
+        start_fleet(fleet, args.engine, args.fleet_announce, args.announce_jitter, gateway)
+    elif args.workers > 0:
+        run_supervisor(ecu_conf, args.port, args.engine, args.workers, log_level=args.log_level,
+                       writer_options=writer_options, jitter=args.announce_jitter)
+    else:
+        start_server(vin, logical_address, eid, gid, args.port, args.engine, gateway=gateway,
+                     report=log_stats, jitter=args.announce_jitter)
@@ -2,7 +2,7 @@
 import os
 import time
 
-py_files = os.listdir(".")
+py_files = [name for name in os.listdir(".") if name.endswith(".py")]
 py_files.remove('test_all.py')
 py_files.sort()
 
@@ -0,0 +1,73 @@
+"""Unit tests for lib.cache.ResponseCache. Run from the repository root:
+
+    python3 -m unittest discover test/unit
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from lib.cache import ResponseCache
+from lib.ecu import EcuModel
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(maxsize=3)
+        for key in "abc":
+            cache.put(key, key.upper())
+        # Reading an entry makes it the most recently used
+        self.assertEqual(cache.get("a"), "A")
+        cache.put("d", "D")
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual([cache.get(key) for key in "acd"], ["A", "C", "D"])
+
+    def test_put_refreshes(self):
+        cache = ResponseCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("a", 3)
+        cache.put("c", 4)
+        self.assertEqual(cache.get("a"), 3)
+        self.assertIsNone(cache.get("b"))
+
+    def test_disabled(self):
+        cache = ResponseCache(maxsize=0)
+        cache.put("a", 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        for number in range(10):
+            cache.put(number, str(number))
+        cache.invalidate(lambda key: key % 2)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual([cache.get(number) for number in (0, 1, 2)], ["0", None, "2"])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_write_data_by_identifier_invalidates_reads(self):
+        ecu = EcuModel("ECU", 0x1001, "L6T7854Z4ND000050")
+        state = (0x01, False)
+        reads = {
+            "vin": (0x0E80, state, b"\x22\xf1\x90"),
+            "vin and session": (0x0E80, state, b"\x22\xf1\x86\xf1\x90"),
+            "other tester": (0x0E81, state, b"\x22\xf1\x90"),
+            "session": (0x0E80, state, b"\x22\xf1\x86"),
+            # 0xF1 0x90 in the middle of two DIDs
+            "misaligned": (0x0E80, state, b"\x22\x12\xf1\x90\x34"),
+            "other service": (0x0E80, state, b"\x3e\x00"),
+        }
+        for key in reads.values():
+            ecu.response_cache.put(key, b"reply")
+        ecu.write_data_by_identifier(0xF190, b"WVWZZZ1JZXW000123")
+        self.assertEqual(ecu.read_data_by_identifier(0xF190), b"WVWZZZ1JZXW000123")
+        kept = [name for name, key in reads.items() if ecu.response_cache.get(key) is not None]
+        self.assertEqual(kept, ["session", "misaligned", "other service"])
+
+
+if __name__ == "__main__":
+    unittest.main()
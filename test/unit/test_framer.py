@@ -0,0 +1,98 @@
+"""Unit tests for lib.framer.DoIPFramer. Run from the repository root:
+
+    python3 -m unittest discover test/unit
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from lib.framer import DoIPFramer, OversizedMessage
+from lib.messages import (
+    AliveCheckRequest,
+    DiagnosticMessage,
+    RoutingActivationRequest,
+)
+
+MESSAGES = [
+    RoutingActivationRequest(0x0E80, 0),
+    DiagnosticMessage(0x0E80, 0x1001, b"\x10\x03"),
+    AliveCheckRequest(),
+    DiagnosticMessage(0x0E80, 0x1001, bytes(range(256)) * 64),
+    DiagnosticMessage(0x0E80, 0x1001, b"\x3e\x00"),
+]
+STREAM = b"".join(message.pack_frame() for message in MESSAGES)
+
+
+def feed_chunks(framer, data, sizes):
+    messages = []
+    offset = 0
+    for size in sizes:
+        messages += framer.feed(data[offset : offset + size])
+        offset += size
+    messages += framer.feed(data[offset:])
+    return messages
+
+
+class DoIPFramerTest(unittest.TestCase):
+    def test_pipelined(self):
+        framer = DoIPFramer()
+        self.assertEqual(framer.feed(STREAM), MESSAGES)
+        self.assertEqual(framer.pending, 0)
+
+    def test_byte_by_byte(self):
+        framer = DoIPFramer()
+        self.assertEqual(feed_chunks(framer, STREAM, [1] * len(STREAM)), MESSAGES)
+        self.assertEqual(framer.pending, 0)
+
+    def test_random_fragments(self):
+        rng = random.Random(1291)
+        for zero_copy in (False, True):
+            for _ in range(200):
+                sizes = [rng.randint(1, 5000) for _ in range(20)]
+                framer = DoIPFramer(zero_copy=zero_copy)
+                self.assertEqual(feed_chunks(framer, STREAM, sizes), MESSAGES)
+
+    def test_partial_message_is_kept(self):
+        framer = DoIPFramer()
+        frame = MESSAGES[3].pack_frame()
+        self.assertEqual(framer.feed(frame[:-1]), [])
+        self.assertEqual(framer.pending, len(frame) - 1)
+        self.assertEqual(framer.feed(frame[-1:]), [MESSAGES[3]])
+
+    def test_zero_copy_views(self):
+        framer = DoIPFramer(zero_copy=True)
+        message = framer.feed(MESSAGES[1].pack_frame())[0]
+        self.assertIsInstance(message.user_data, memoryview)
+        self.assertEqual(bytes(message.user_data), b"\x10\x03")
+
+    def test_oversized(self):
+        framer = DoIPFramer(max_payload_length=100)
+        big = MESSAGES[3]
+        stream = MESSAGES[1].pack_frame() + big.pack_frame() + MESSAGES[4].pack_frame()
+        expected = [MESSAGES[1], OversizedMessage(0x8001, 4 + len(big.user_data)), MESSAGES[4]]
+        self.assertEqual(framer.feed(stream), expected)
+        for size in (1, 7, 64, 1000):
+            framer = DoIPFramer(max_payload_length=100)
+            self.assertEqual(feed_chunks(framer, stream, [size] * (len(stream) // size)), expected)
+            self.assertEqual(framer.pending, 0)
+
+    def test_garbage_prefix(self):
+        framer = DoIPFramer()
+        self.assertEqual(framer.feed(b"\xaa\xbb\xcc" + STREAM), MESSAGES)
+        framer = DoIPFramer()
+        garbage = b"\x02\x00\x00\x01\x00"
+        self.assertEqual(feed_chunks(framer, garbage + STREAM, [1] * 16), MESSAGES)
+
+    def test_reset(self):
+        framer = DoIPFramer()
+        framer.feed(STREAM[:20])
+        framer.reset()
+        self.assertEqual(framer.pending, 0)
+        self.assertEqual(framer.feed(STREAM), MESSAGES)
+
+
+if __name__ == "__main__":
+    unittest.main()
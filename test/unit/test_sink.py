@@ -0,0 +1,144 @@
+"""Unit tests for lib.sink.ImageWriter and ImageSink. Run from the repository root:
+
+    python3 -m unittest discover test/unit
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from udsoncan.Response import Response
+
+from lib import sink as sink_module
+from lib.sink import ImageSink, ImageWriter
+
+BLOCK = 1000
+
+
+def blocks_of(image, block_length=BLOCK):
+    return [image[offset : offset + block_length] for offset in range(0, len(image), block_length)]
+
+
+def digest_of(image):
+    return zlib.crc32(image).to_bytes(4, byteorder="big") + hashlib.sha256(image).digest()
+
+
+class ImageWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.image = os.urandom(300 * BLOCK + 123)
+
+    def path(self, name="image.bin"):
+        return os.path.join(self.directory.name, name)
+
+    def close(self, sink):
+        closed = threading.Event()
+        errors = []
+        sink.close(lambda error: errors.append(error) or closed.set())
+        self.assertTrue(closed.wait(5))
+        return errors[0]
+
+    def read(self, path):
+        with open(path, "rb") as file:
+            return file.read()
+
+    def test_image_and_digest(self):
+        writer = ImageWriter()
+        sink = ImageSink(self.path(), 0x80000, len(self.image), writer)
+        # 301 blocks, so the sequence counter wraps around
+        for index, block in enumerate(blocks_of(self.image)):
+            self.assertFalse(sink.write_block((index + 1) & 0xFF, block))
+        self.assertIsNone(self.close(sink))
+        self.assertEqual(self.read(self.path()), self.image)
+        self.assertEqual(sink.digest(), digest_of(self.image))
+
+    def test_retransmission_replaces_last_block(self):
+        writer = ImageWriter()
+        sink = ImageSink(self.path(), 0, 3 * BLOCK, writer)
+        image = os.urandom(3 * BLOCK)
+        sink.write_block(1, image[:BLOCK])
+        sink.write_block(2, b"\xff" * BLOCK)
+        sink.write_block(2, image[BLOCK : 2 * BLOCK])
+        sink.write_block(3, image[2 * BLOCK :])
+        self.assertEqual(sink.write_block(5, image[:BLOCK]), Response.Code.WrongBlockSequenceCounter)
+        self.assertIsNone(self.close(sink))
+        self.assertEqual(self.read(self.path()), image)
+        self.assertEqual(sink.digest(), digest_of(image))
+
+    def test_consecutive_blocks_merged_in_order(self):
+        writer = ImageWriter()
+        first = ImageSink(self.path("first.bin"), 0, len(self.image), writer)
+        second = ImageSink(self.path("second.bin"), 0, len(self.image), writer)
+        calls = []
+
+        def pwritev(fd, buffers, offset):
+            calls.append((fd, offset, [len(buffer) for buffer in buffers]))
+            original(fd, buffers, offset)
+
+        original = sink_module._pwritev
+        with mock.patch.object(sink_module, "_pwritev", pwritev):
+            # The writer thread waits for the lock, so it finds all of these queued at once
+            with writer._condition:
+                blocks = blocks_of(self.image)
+                for index in range(4):
+                    first.write_block(index + 1, blocks[index])
+                for index in range(2):
+                    second.write_block(index + 1, blocks[index])
+                first.write_block(5, blocks[4])
+            self.assertIsNone(self.close(first))
+            self.assertIsNone(self.close(second))
+        self.assertEqual(
+            [(offset, lengths) for fd, offset, lengths in calls],
+            [(0, [BLOCK] * 4), (0, [BLOCK] * 2), (4 * BLOCK, [BLOCK])],
+        )
+        self.assertEqual(self.read(self.path("first.bin"))[: 5 * BLOCK], self.image[: 5 * BLOCK])
+        self.assertEqual(self.read(self.path("second.bin"))[: 2 * BLOCK], self.image[: 2 * BLOCK])
+
+    def test_backpressure(self):
+        writer = ImageWriter(max_pending=3 * BLOCK)
+        sink = ImageSink(self.path(), 0, len(self.image), writer)
+        drained = threading.Event()
+        blocks = blocks_of(self.image)
+        with writer._condition:
+            self.assertFalse(sink.write_block(1, blocks[0]))
+            self.assertFalse(sink.write_block(2, blocks[1]))
+            # Congested once 3 blocks are waiting
+            self.assertTrue(sink.write_block(3, blocks[2]))
+            writer.notify_when_drained(drained.set)
+            self.assertFalse(drained.is_set())
+        # Called back by the writer thread once the queue is down to half of max_pending
+        self.assertTrue(drained.wait(5))
+        self.assertIsNone(self.close(sink))
+        self.assertEqual(writer._pending, 0)
+        # With nothing waiting, the callback comes right away
+        called = []
+        writer.notify_when_drained(lambda: called.append(True))
+        self.assertEqual(called, [True])
+
+    def test_compressed(self):
+        writer = ImageWriter()
+        stream = zlib.compress(self.image)
+        sink = ImageSink(self.path(), 0, len(self.image), writer, "zlib")
+        for index, block in enumerate(blocks_of(stream, 777)):
+            sink.write_block((index + 1) & 0xFF, block)
+        self.assertIsNone(self.close(sink))
+        self.assertEqual(self.read(self.path()), self.image)
+        self.assertEqual(sink.digest(), digest_of(self.image))
+
+    def test_compressed_stream_ended_early(self):
+        writer = ImageWriter()
+        stream = zlib.compress(self.image)
+        sink = ImageSink(self.path(), 0, len(self.image), writer, "zlib")
+        sink.write_block(1, stream[: len(stream) // 2])
+        self.assertIsInstance(self.close(sink), ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Unit tests for lib.timers.TimingWheel, driven by a fake clock. Run from the repository root:
+
+    python3 -m unittest discover test/unit
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from lib.timers import TimingWheel
+
+
+class FakeCall:
+    def __init__(self, clock, time, callable, args):
+        self.clock = clock
+        self.time = time
+        self.callable = callable
+        self.args = args
+
+    def cancel(self):
+        self.clock.calls.remove(self)
+
+
+class FakeClock:
+    """callLater() and seconds() like the twisted reactor, with every call running `lag`
+    seconds after it was due, like on a busy event loop"""
+
+    def __init__(self, lag=0.0):
+        self.now = 0.0
+        self.lag = lag
+        self.calls = []
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, callable, *args):
+        call = FakeCall(self, self.now + delay, callable, args)
+        self.calls.append(call)
+        return call
+
+    def run_until(self, time):
+        while self.calls:
+            call = min(self.calls, key=lambda call: call.time)
+            if call.time > time:
+                break
+            self.calls.remove(call)
+            self.now = max(self.now, call.time + self.lag)
+            call.callable(*call.args)
+        self.now = max(self.now, time)
+
+
+class TimingWheelTest(unittest.TestCase):
+    def fired_at(self, clock, wheel, delays):
+        fired = {}
+        for delay in delays:
+            wheel.schedule(delay, lambda delay=delay: fired.setdefault(delay, clock.seconds()))
+        clock.run_until(max(delays) + 1)
+        return fired
+
+    def test_never_early(self):
+        clock = FakeClock()
+        wheel = TimingWheel(clock, tick=0.1, slots=8)
+        clock.run_until(0.03)
+        delays = [0.01, 0.1, 0.15, 0.79, 0.8, 0.81, 2.0, 5.55]
+        for delay, fired in self.fired_at(clock, wheel, delays).items():
+            self.assertGreaterEqual(fired - 0.03, delay - 1e-9)
+            self.assertLessEqual(fired - 0.03, delay + 0.1 + 1e-9)
+
+    def test_cancel(self):
+        clock = FakeClock()
+        wheel = TimingWheel(clock, tick=0.1, slots=8)
+        fired = []
+        timer = wheel.schedule(0.5, fired.append, "cancelled")
+        wheel.schedule(0.3, fired.append, "kept")
+        timer.cancel()
+        self.assertFalse(timer.active)
+        timer.cancel()
+        self.assertEqual(len(wheel), 1)
+        clock.run_until(2)
+        self.assertEqual(fired, ["kept"])
+        # An empty wheel doesn't tick
+        self.assertEqual(clock.calls, [])
+
+    def test_cancel_in_callback(self):
+        clock = FakeClock()
+        wheel = TimingWheel(clock, tick=0.1, slots=8)
+        fired = []
+        other = wheel.schedule(0.2, fired.append, "other")
+        wheel.schedule(0.2, lambda: other.cancel() or fired.append("first"))
+        clock.run_until(1)
+        # Timers of a tick run in no particular order. A cancelled one doesn't run after that
+        self.assertIn(fired, (["first"], ["other", "first"]))
+
+    def test_reschedule_in_callback(self):
+        # Timers that reschedule themselves when they fire, like the inactivity timers of
+        # connections, must not shift the ticks of the timers already on the wheel
+        for lag in (0.0, 0.005, 0.03):
+            clock = FakeClock(lag)
+            wheel = TimingWheel(clock, tick=0.1, slots=64)
+            checks = []
+
+            def check():
+                checks.append(clock.seconds())
+                if clock.seconds() < 70:
+                    wheel.schedule(0.25, check)
+
+            fired = []
+            wheel.schedule(0.25, check)
+            wheel.schedule(60.0, lambda: fired.append(clock.seconds()))
+            clock.run_until(71)
+            self.assertEqual(len(fired), 1)
+            self.assertGreaterEqual(fired[0], 60.0)
+            self.assertLessEqual(fired[0], 60.0 + 0.1 + lag + 1e-9)
+            for previous, current in zip(checks, checks[1:]):
+                self.assertGreaterEqual(current - previous, 0.25 - 1e-9)
+            self.assertEqual(clock.calls, [])
+
+    def test_ticks_while_late(self):
+        clock = FakeClock()
+        wheel = TimingWheel(clock, tick=0.1, slots=8)
+        fired = []
+        wheel.schedule(0.1, fired.append, 1)
+        wheel.schedule(0.3, fired.append, 3)
+        # The event loop was busy for half a second
+        clock.now = 0.55
+        clock.run_until(0.55)
+        self.assertEqual(fired, [1, 3])
+        self.assertEqual(wheel.ticks, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()